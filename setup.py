@@ -31,6 +31,12 @@ setuptools.setup(
     author_email="zach@superpowered.ai, justin@superpowered.ai",
     packages=["sprag"],
     install_requires=read("requirements.txt"),
+    extras_require={
+        # local embedding and reranking models (SentenceTransformerEmbedding, CrossEncoderReranker)
+        "local": ["sentence-transformers>=3.2"],
+        # the ONNX Runtime backend of SentenceTransformerEmbedding
+        "onnx": ["sentence-transformers>=3.2", "optimum[onnxruntime]"],
+    },
     include_package_data=True,
     python_requires=">=3.9",
     classifiers=[
@@ -0,0 +1,48 @@
+import os
+import pickle
+
+# a log is only merged into its snapshot once it is larger than both the snapshot and this size, which keeps the total number of bytes written during ingestion linear in the size of the data
+MIN_COMPACTION_SIZE = 32 * 1024 * 1024
+
+
+def append_record(log_path: str, record) -> int:
+    """
+    Append a single pickled record to the end of the log file and return the new size of the log in bytes.
+    """
+    with open(log_path, 'ab') as f:
+        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return f.tell()
+
+def read_records(log_path: str) -> tuple[list, int]:
+    """
+    Read all of the records in a log file, in the order they were written. Returns the records and the size in bytes of the complete records.
+    - a partially written record at the end of the log (e.g. from a crash in the middle of a write) is ignored; call truncate_log with the returned size before appending to the log again, or the new records would be written after it and be unreadable
+    """
+    records = []
+    if not os.path.exists(log_path):
+        return records, 0
+    with open(log_path, 'rb') as f:
+        end = 0
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError, MemoryError, OverflowError):
+                # a clean end of the log is an EOFError too, so a partial record is recognized by there being bytes left after the last complete one
+                break
+            end = f.tell()
+    if end < get_file_size(log_path):
+        print (f"Ignoring a partially written record at the end of {log_path}")
+    return records, end
+
+def truncate_log(log_path: str, size: int):
+    """
+    Cut off anything in the log after the first size bytes (i.e. a partially written record).
+    """
+    if get_file_size(log_path) > size:
+        os.truncate(log_path, size)
+
+def get_file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def should_compact(log_size: int, snapshot_size: int) -> bool:
+    return log_size > max(snapshot_size, MIN_COMPACTION_SIZE)
@@ -1,4 +1,9 @@
 from sprag.llm import LLM
+from sprag.cache import SQLiteCache, get_cache_key, get_hash
+import asyncio
+import functools
+import json
+import re
 import tiktoken
 
 PROMPT = """
@@ -25,13 +30,35 @@ TRUNCATION_MESSAGE = """
 Also note that the document text provided below is just the first ~4500 words of the document. Your response should still pertain to the entire document, not just the text provided below.
 """.strip()
 
-def truncate_content(content: str, max_tokens: int):
-    TOKEN_ENCODER = tiktoken.encoding_for_model('gpt-3.5-turbo')
-    tokens = TOKEN_ENCODER.encode(content, disallowed_special=())
+# a position where the text can be cut without changing how the text before it is tokenized: the end of a run of non-whitespace characters that's followed by a space
+# (with the cl100k_base pre-tokenization pattern, no pre-token can span a non-whitespace character followed by a space, so the tokens of the prefix are exactly the first tokens of the full text)
+SAFE_CUT_PATTERN = re.compile(r'\S(?= )')
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder():
+    return tiktoken.encoding_for_model('gpt-3.5-turbo')
+
+def truncate_content(content: str, max_tokens: int, initial_chars_per_token: int = 8):
+    """
+    Returns the first max_tokens tokens of content (decoded back to text), and the number of tokens in it.
+    - only a prefix of the content is tokenized: starting at initial_chars_per_token characters per token, and doubling until the prefix has at least max_tokens tokens. This gives the same result as tokenizing the whole content, without tokenizing all of a very long document.
+    """
+    token_encoder = get_token_encoder()
+    prefix_length = max_tokens * initial_chars_per_token
+    while prefix_length < len(content):
+        safe_cut = SAFE_CUT_PATTERN.search(content, prefix_length - 1)
+        if safe_cut is None:
+            break
+        tokens = token_encoder.encode(content[:safe_cut.end()], disallowed_special=())
+        if len(tokens) >= max_tokens:
+            return token_encoder.decode(tokens[:max_tokens]), max_tokens
+        prefix_length = 2 * safe_cut.end()
+
+    tokens = token_encoder.encode(content, disallowed_special=())
     truncated_tokens = tokens[:max_tokens]
-    return TOKEN_ENCODER.decode(truncated_tokens), min(len(tokens), max_tokens)
+    return token_encoder.decode(truncated_tokens), min(len(tokens), max_tokens)
 
-def get_document_context(auto_context_model: LLM, text: str, document_title: str, auto_context_guidance: str = ""):
+def get_document_context_chat_messages(text: str, document_title: str, auto_context_guidance: str = ""):
     # truncate the content if it's too long
     max_content_tokens = 6000 # if this number changes, also update the truncation message above
     text, num_tokens = truncate_content(text, max_content_tokens)
@@ -40,10 +67,40 @@ def get_document_context(auto_context_model: LLM, text: str, document_title: str
     else:
         truncation_message = TRUNCATION_MESSAGE
     
-    # get document context
     prompt = PROMPT.format(auto_context_guidance=auto_context_guidance, document=text, document_title=document_title, truncation_message=truncation_message)
-    chat_messages = [{"role": "user", "content": prompt}]
+    return [{"role": "user", "content": prompt}]
+
+def get_document_context_cache_key(auto_context_model: LLM, chat_messages: list[dict], document_title: str, auto_context_guidance: str) -> str:
+    # the prompt includes the truncated document text, so hashing it covers that (and any change to the prompt template)
+    llm_config = json.dumps(auto_context_model.to_dict(), sort_keys=True)
+    return get_cache_key(llm_config, auto_context_guidance, document_title, get_hash(chat_messages[0]["content"]))
+
+def get_document_context(auto_context_model: LLM, text: str, document_title: str, auto_context_guidance: str = "", cache: SQLiteCache = None):
+    """
+    - cache: optional persistent cache of document contexts, keyed by (LLM config, auto_context_guidance, document_title, hash of the truncated text), so the LLM is only called once for each document
+    """
+    chat_messages = get_document_context_chat_messages(text, document_title, auto_context_guidance)
+    if cache is not None:
+        cache_key = get_document_context_cache_key(auto_context_model, chat_messages, document_title, auto_context_guidance)
+        document_context = cache.get(cache_key)
+        if document_context is not None:
+            return document_context
     document_context = auto_context_model.make_llm_call(chat_messages)
+    if cache is not None:
+        cache.set(cache_key, document_context)
+    return document_context
+
+async def aget_document_context(auto_context_model: LLM, text: str, document_title: str, auto_context_guidance: str = "", cache: SQLiteCache = None):
+    # tokenizing a long document takes a while, so keep it off the event loop (and the cache lookups, which do disk I/O)
+    chat_messages = await asyncio.to_thread(get_document_context_chat_messages, text, document_title, auto_context_guidance)
+    if cache is not None:
+        cache_key = get_document_context_cache_key(auto_context_model, chat_messages, document_title, auto_context_guidance)
+        document_context = await asyncio.to_thread(cache.get, cache_key)
+        if document_context is not None:
+            return document_context
+    document_context = await auto_context_model.amake_llm_call(chat_messages)
+    if cache is not None:
+        await asyncio.to_thread(cache.set, cache_key, document_context)
     return document_context
 
 def get_chunk_header(file_name, document_context):
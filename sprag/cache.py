@@ -0,0 +1,214 @@
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def get_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_cache_key(*parts) -> str:
+    """
+    Combine the parts of a cache key (strings, numbers, or None) into a single fixed-length key.
+    """
+    return get_hash('\x1f'.join(repr(part) for part in parts))
+
+
+class SQLiteCache:
+    """
+    Persistent key-value cache stored in a single SQLite file, with least-recently-used eviction once it holds more than max_entries entries.
+    - values can be any picklable object
+    - safe to share between threads
+    """
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used INTEGER NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+            self.num_entries = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get_many(self, keys: list[str]) -> dict:
+        """
+        Return a dictionary with the cached value for each of the keys that are in the cache, and mark them as recently used.
+        """
+        keys = list(dict.fromkeys(keys))
+        results = {}
+        if not keys:
+            return results
+        with self.lock, self.connection:
+            # SQLite limits the number of parameters in a single statement
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                rows = self.connection.execute(f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                for key, value in rows:
+                    results[key] = pickle.loads(value)
+            now = time.time_ns()
+            self.connection.executemany("UPDATE cache SET last_used = ? WHERE key = ?", [(now, key) for key in results])
+        return results
+
+    def set_many(self, items: dict):
+        """
+        Add or replace the cached values for the keys in items, evicting the least recently used entries if the cache is full.
+        """
+        if not items:
+            return
+        now = time.time_ns()
+        rows = [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now) for key, value in items.items()]
+        with self.lock, self.connection:
+            self.num_entries += self.connection.executemany("INSERT OR IGNORE INTO cache (key, value, last_used) VALUES (?, ?, ?)", rows).rowcount
+            self.connection.executemany("UPDATE cache SET value = ?, last_used = ? WHERE key = ?", [(value, last_used, key) for key, value, last_used in rows])
+            if self.num_entries > self.max_entries:
+                num_to_evict = self.num_entries - self.max_entries
+                self.connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)", (num_to_evict,))
+                self.num_entries -= num_to_evict
+
+    def get(self, key: str, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache")
+            self.num_entries = 0
+
+    def __len__(self):
+        return self.num_entries
+
+
+class LRUCache:
+    """
+    In-memory cache with least-recently-used eviction once it holds more than max_entries entries, and an optional time to live for each entry (in seconds).
+    - counts hits and misses, which are reported by stats()
+    - safe to share between threads
+    """
+    def __init__(self, max_entries: int = 10_000, ttl: float = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiration time, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expiration_time = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expiration_time, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'num_entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings, keyed by (embedding model config, input_type, sha256(text)), so the same text is never embedded twice by the same model.
+    - the whole config from the model's to_dict() is part of the key, so settings that change the embeddings (e.g. quantization or normalization) never serve embeddings made with other settings
+    """
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.cache = SQLiteCache(path, max_entries)
+
+    def get_keys(self, embedding_model, texts: list[str], input_type) -> list[str]:
+        model_config = json.dumps(embedding_model.to_dict(), sort_keys=True)
+        return [get_cache_key(model_config, input_type or None, get_hash(text)) for text in texts]
+
+    def get_embeddings(self, embedding_model, texts: list[str], input_type) -> list:
+        """
+        Return the cached embedding for each text, or None for the texts that aren't in the cache.
+        """
+        keys = self.get_keys(embedding_model, texts, input_type)
+        cached_embeddings = self.cache.get_many(keys)
+        return [cached_embeddings[key].tolist() if key in cached_embeddings else None for key in keys]
+
+    def set_embeddings(self, embedding_model, texts: list[str], input_type, embeddings: list):
+        keys = self.get_keys(embedding_model, texts, input_type)
+        # embeddings are stored as float32 arrays, which take half the space of a list of Python floats
+        self.cache.set_many({key: np.asarray(embedding, dtype=np.float32) for key, embedding in zip(keys, embeddings)})
+
+
+# reranker settings that only affect the transform from raw relevance scores to similarities, not the raw scores themselves
+RERANKER_TRANSFORM_PARAMS = ('calibration_center', 'calibration_temperature')
+
+
+class RerankCache:
+    """
+    Cache of the raw relevance scores from a reranker, keyed by (reranker config, query, hash of the candidate chunks).
+    - the raw scores are cached rather than the reranked results, so the reranker's transform is reapplied on every lookup; the config in the key is the reranker's to_dict() without the calibration parameters, which only the transform uses
+    - the candidates are part of the key, so adding or deleting documents (which changes the candidates) never serves stale scores
+    - entries are kept in an in-memory LRU cache, and optionally also in an SQLite file
+    """
+    def __init__(self, max_entries: int = 1000, path: str = None, disk_max_entries: int = 100_000):
+        self.memory_cache = LRUCache(max_entries)
+        self.disk_cache = SQLiteCache(path, disk_max_entries) if path is not None else None
+
+    def get_key(self, reranker, query: str, search_results: list) -> str:
+        candidates_hash = get_cache_key(*[
+            (result['metadata']['doc_id'], result['metadata']['chunk_index'], get_hash(result['metadata']['chunk_header']), get_hash(result['metadata']['chunk_text']))
+            for result in search_results
+        ])
+        reranker_config = json.dumps({key: value for key, value in reranker.to_dict().items() if key not in RERANKER_TRANSFORM_PARAMS}, sort_keys=True)
+        return get_cache_key(reranker_config, query, candidates_hash)
+
+    def get(self, key: str):
+        relevance_scores = self.memory_cache.get(key)
+        if relevance_scores is None and self.disk_cache is not None:
+            relevance_scores = self.disk_cache.get(key)
+            if relevance_scores is not None:
+                self.memory_cache.set(key, relevance_scores)
+        return relevance_scores
+
+    def set(self, key: str, relevance_scores: list[float]):
+        self.memory_cache.set(key, relevance_scores)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, relevance_scores)
+
+    def clear(self):
+        self.memory_cache.clear()
+
+    def stats(self) -> dict:
+        stats = self.memory_cache.stats()
+        if self.disk_cache is not None:
+            stats['num_disk_entries'] = len(self.disk_cache)
+        return stats
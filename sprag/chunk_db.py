@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
 import os
 import pickle
+import re
+from sprag.append_log import append_record, read_records, truncate_log, get_file_size, should_compact
 
 class ChunkDB(ABC):
     subclasses = {}
@@ -30,6 +32,19 @@ class ChunkDB(ABC):
         """
         pass
 
+    def add_documents(self, documents: dict[str, dict]):
+        """
+        Store the chunks for several documents at once (a dictionary of doc_id -> chunks). Subclasses can override this to write them in a single operation.
+        """
+        for doc_id, chunks in documents.items():
+            self.add_document(doc_id, chunks)
+
+    def save(self):
+        """
+        Write anything that isn't written to disk as changes are made. Called at the end of bulk ingestion; databases that write every change as it's made don't need to override this.
+        """
+        pass
+
     @abstractmethod
     def remove_document(self, doc_id: str):
         """
@@ -62,6 +77,7 @@ class ChunkDB(ABC):
 class BasicChunkDB(ChunkDB):
     """
     This is a basic implementation of a ChunkDB that stores chunks in a nested dictionary and persists them to disk by pickling the dictionary.
+    - adds and removes are appended to a log as delta records instead of re-pickling the whole dictionary; compact() merges the log into a new snapshot, which also happens automatically once the log outgrows the snapshot
     """
     def __init__(self, kb_id: str, storage_directory: str = '~/spRAG'):
         self.kb_id = kb_id
@@ -71,13 +87,20 @@ class BasicChunkDB(ChunkDB):
         self.storage_path = os.path.join(self.storage_directory, 'chunk_storage', f'{kb_id}.pkl')
         self.load()
 
+    def get_log_path(self, generation: int) -> str:
+        return os.path.join(self.storage_directory, 'chunk_storage', f'{self.kb_id}.{generation}.log')
+
     def add_document(self, doc_id: str, chunks: dict[dict]):
         self.data[doc_id] = chunks
-        self.save()
+        self.append_to_log(('add', doc_id, chunks))
+
+    def add_documents(self, documents: dict[str, dict]):
+        self.data.update(documents)
+        self.append_to_log(('add_documents', documents))
 
     def remove_document(self, doc_id: str):
-        self.data.pop(doc_id, None)
-        self.save()
+        if self.data.pop(doc_id, None) is not None:
+            self.append_to_log(('remove', doc_id))
 
     def get_chunk_text(self, doc_id: str, chunk_index: int) -> str:
         if doc_id in self.data and chunk_index in self.data[doc_id]:
@@ -92,16 +115,55 @@ class BasicChunkDB(ChunkDB):
     def get_all_doc_ids(self) -> list:
         return list(self.data.keys())
 
+    def append_to_log(self, record: tuple):
+        self.log_size = append_record(self.get_log_path(self.generation), record)
+        if should_compact(self.log_size, self.snapshot_size):
+            self.compact()
+
+    def compact(self):
+        """
+        Merge the log into a new snapshot of the full dictionary.
+        """
+        new_generation = self.generation + 1
+        # swapping in the new snapshot is the commit point - a crash before then leaves the previous snapshot and its log intact
+        with open(self.storage_path + '.tmp', 'wb') as f:
+            pickle.dump((new_generation, self.data), f)
+        os.replace(self.storage_path + '.tmp', self.storage_path)
+        self.generation = new_generation
+        self.log_size = 0
+        self.snapshot_size = get_file_size(self.storage_path)
+        # the chunk_storage directory is shared by all KBs, so only this KB's logs ({kb_id}.{generation}.log) are deleted, and not e.g. those of a KB with the ID {kb_id}.v2
+        log_name_pattern = re.compile(re.escape(self.kb_id) + r'\.\d+\.log')
+        chunk_storage_directory = os.path.join(self.storage_directory, 'chunk_storage')
+        for file_name in os.listdir(chunk_storage_directory):
+            if log_name_pattern.fullmatch(file_name):
+                os.remove(os.path.join(chunk_storage_directory, file_name))
+
     def load(self):
+        self.generation = 0
         try:
             with open(self.storage_path, 'rb') as f:
-                self.data = pickle.load(f)
+                snapshot = pickle.load(f)
+            # older versions pickled the dictionary by itself
+            self.generation, self.data = snapshot if isinstance(snapshot, tuple) else (0, snapshot)
         except FileNotFoundError:
             self.data = {}
+        self.snapshot_size = get_file_size(self.storage_path)
+
+        # replay the changes that were made since the snapshot was taken
+        log_path = self.get_log_path(self.generation)
+        records, self.log_size = read_records(log_path)
+        for record in records:
+            if record[0] == 'add':
+                self.data[record[1]] = record[2]
+            elif record[0] == 'add_documents':
+                self.data.update(record[1])
+            elif record[0] == 'remove':
+                self.data.pop(record[1], None)
+        truncate_log(log_path, self.log_size)
 
     def save(self):
-        with open(self.storage_path, 'wb') as f:
-            pickle.dump(self.data, f)
+        self.compact()
 
     def to_dict(self):
         return {
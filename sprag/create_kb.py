@@ -1,14 +1,26 @@
-from sprag.document_parsing import extract_text_from_pdf, extract_text_from_docx
+from sprag.document_parsing import extract_text_from_file
 from sprag.knowledge_base import KnowledgeBase
+from sprag.rate_limiter import temporary_rate_limit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import os
-import time
 
-def create_kb_from_directory(kb_id: str, directory: str, title: str = None, description: str = "", language: str = 'en', auto_context: bool = True, auto_context_guidance: str = ""):
+SUPPORTED_FILE_TYPES = ('.docx', '.md', '.txt', '.pdf')
+
+def create_kb_from_directory(kb_id: str, directory: str, title: str = None, description: str = "", language: str = 'en', auto_context: bool = True, auto_context_guidance: str = "", max_workers: int = 8, max_parsing_workers: int = None, llm_requests_per_minute: float = None, embedding_requests_per_minute: float = None, write_batch_num_documents: int = 20):
     """
     - kb_id is the name of the knowledge base
     - directory is the absolute path to the directory containing the documents
     - no support for manually defined chunk headers here, because they would have to be defined for each file in the directory
 
+    Ingestion is pipelined:
+    - files are parsed in a process pool of max_parsing_workers processes (defaults to the number of CPUs)
+    - AutoContext and embedding calls for up to max_workers documents are made concurrently, limited to llm_requests_per_minute and embedding_requests_per_minute (None means no limit beyond what was configured with set_rate_limit). These are added with temporary_rate_limit for the duration of the ingestion, so they apply on top of any limits configured with set_rate_limit.
+    - documents are written to the chunk and vector databases in batches of write_batch_num_documents documents
+    - a file that fails to parse, process, or write is skipped (with an error message), and the rest are still added
+
+    With the spawn start method (the default on Windows and macOS), the parsing processes import the calling script, so it needs an `if __name__ == '__main__':` guard around the call to this function. If the process pool can't be started, files are parsed in threads instead.
+
     Supported file types: .docx, .md, .txt, .pdf
     """
     if not title:
@@ -17,31 +29,97 @@ def create_kb_from_directory(kb_id: str, directory: str, title: str = None, desc
     # create a new KB
     kb = KnowledgeBase(kb_id, title=title, description=description, language=language, exists_ok=False)
 
-    # add documents
-    for root, dirs, files in os.walk(directory):
-        for file_name in files:
-            if file_name.endswith(('.docx', '.md', '.txt', '.pdf')):
-                try:
-                    file_path = os.path.join(root, file_name)
-                    clean_file_path = file_path.replace(directory, "")
-                    
-                    if file_name.endswith('.docx'):
-                        text = extract_text_from_docx(file_path)
-                    elif file_name.endswith('.pdf'):
-                        text = extract_text_from_pdf(file_path)
-                    elif file_name.endswith('.md') or file_name.endswith('.txt'):
-                        with open(file_path, 'r') as f:
-                            text = f.read()
-
-                    kb.add_document(clean_file_path, text, auto_context=auto_context, auto_context_guidance=auto_context_guidance)
-                    time.sleep(1) # pause for 1 second to avoid hitting API rate limits
-                except:
-                    print (f"Error reading {file_name}")
-                    continue
+    # find the documents to add
+    files = []
+    for root, dirs, file_names in os.walk(directory):
+        for file_name in file_names:
+            if file_name.endswith(SUPPORTED_FILE_TYPES):
+                file_path = os.path.join(root, file_name)
+                clean_file_path = file_path.replace(directory, "")
+                files.append((file_path, clean_file_path))
             else:
                 print (f"Unsupported file type: {file_name}")
-                continue
-    
+
+    def process_document(doc_id: str, text: str) -> dict:
+        document = kb.prepare_document(doc_id, text, auto_context=auto_context, auto_context_guidance=auto_context_guidance)
+        document["chunk_embeddings"] = kb.embed_document_chunks(document["chunks"], document["chunk_header"])
+        return document
+
+    def write_documents(documents: list[dict]):
+        try:
+            kb.write_documents(documents)
+        except Exception as e:
+            # write the documents one at a time, so one bad document doesn't lose the rest of the batch
+            print (f"Error writing a batch of {len(documents)} documents: {e}. Writing them one at a time instead.")
+            for document in documents:
+                try:
+                    kb.write_documents([document])
+                except Exception as e:
+                    print (f"Error adding {document['doc_id']}: {e}")
+
+    parsing_executor = ProcessPoolExecutor(max_workers=max_parsing_workers)
+    parsing_in_processes = True
+
+    def submit_parsing(file_path: str):
+        nonlocal parsing_executor, parsing_in_processes
+        if parsing_in_processes:
+            try:
+                return parsing_executor.submit(extract_text_from_file, file_path)
+            except BrokenProcessPool:
+                pass
+            # the worker processes couldn't be started (or died), e.g. because the calling script has no __main__ guard under the spawn start method
+            print ("The parsing process pool is not working, so files will be parsed in threads instead. If you're using the spawn start method, put the call to create_kb_from_directory under an `if __name__ == '__main__':` guard.")
+            parsing_executor.shutdown(wait=False)
+            parsing_executor = ThreadPoolExecutor(max_workers=max_parsing_workers)
+            parsing_in_processes = False
+        return parsing_executor.submit(extract_text_from_file, file_path)
+
+    # keep a bounded number of documents in flight (being parsed or processed) so memory usage doesn't grow with the size of the directory
+    max_documents_in_flight = 2 * max_workers
+    files = iter(files)
+    in_flight = {} # future -> (stage, file_path, doc_id)
+    documents_to_write = []
+    # the API calls go through the shared rate limiters, so the limits also cover retries and any other KBs using the same models
+    llm_rate_limit = temporary_rate_limit(type(kb.auto_context_model).__name__, getattr(kb.auto_context_model, 'model', None), requests_per_minute=llm_requests_per_minute)
+    embedding_rate_limit = temporary_rate_limit(type(kb.embedding_model).__name__, getattr(kb.embedding_model, 'model', None), requests_per_minute=embedding_requests_per_minute)
+    try:
+        with llm_rate_limit, embedding_rate_limit, ThreadPoolExecutor(max_workers=max_workers) as processing_executor:
+            while True:
+                # start parsing more files if there's room
+                while len(in_flight) < max_documents_in_flight:
+                    file_path, doc_id = next(files, (None, None))
+                    if file_path is None:
+                        break
+                    in_flight[submit_parsing(file_path)] = ("parse", file_path, doc_id)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, file_path, doc_id = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # parse the file again (submit_parsing switches to threads, since the process pool is broken)
+                        in_flight[submit_parsing(file_path)] = ("parse", file_path, doc_id)
+                        continue
+                    except Exception as e:
+                        print (f"Error {'reading' if stage == 'parse' else 'adding'} {file_path}: {e}")
+                        continue
+                    if stage == "parse":
+                        in_flight[processing_executor.submit(process_document, doc_id, result)] = ("process", file_path, doc_id)
+                    else:
+                        documents_to_write.append(result)
+                        if len(documents_to_write) >= write_batch_num_documents:
+                            write_documents(documents_to_write)
+                            documents_to_write = []
+    finally:
+        parsing_executor.shutdown()
+
+    if documents_to_write:
+        write_documents(documents_to_write)
+    kb.compact()
+
     return kb
 
 def create_kb_from_file(kb_id: str, file_path: str, title: str = None, description: str = "", language: str = 'en', auto_context: bool = True, auto_context_guidance: str = ""):
@@ -62,21 +140,13 @@ def create_kb_from_file(kb_id: str, file_path: str, title: str = None, descripti
     file_name = os.path.basename(file_path)
 
     # add document
-    if file_path.endswith(('.docx', '.md', '.txt', '.pdf')):
+    if file_path.endswith(SUPPORTED_FILE_TYPES):
         # define clean file path as just the file name here since we're not using a directory
         clean_file_path = file_name
-        
-        if file_path.endswith('.docx'):
-            text = extract_text_from_docx(file_path)
-        elif file_name.endswith('.pdf'):
-            text = extract_text_from_pdf(file_path)
-        elif file_path.endswith('.md') or file_path.endswith('.txt'):
-            with open(file_path, 'r') as f:
-                text = f.read()
-
+        text = extract_text_from_file(file_path)
         kb.add_document(clean_file_path, text, auto_context=auto_context, auto_context_guidance=auto_context_guidance)
     else:
         print (f"Unsupported file type: {file_name}")
         return
     
-    return kb
\ No newline at end of file
+    return kb
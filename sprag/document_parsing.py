@@ -20,4 +20,18 @@ def extract_text_from_pdf(file_path):
     return extracted_text
 
 def extract_text_from_docx(file_path):
-    return docx2txt.process(file_path)
\ No newline at end of file
+    return docx2txt.process(file_path)
+
+def extract_text_from_file(file_path):
+    """
+    Extract the text from a .docx, .pdf, .md, or .txt file.
+    """
+    if file_path.endswith('.docx'):
+        return extract_text_from_docx(file_path)
+    elif file_path.endswith('.pdf'):
+        return extract_text_from_pdf(file_path)
+    elif file_path.endswith('.md') or file_path.endswith('.txt'):
+        with open(file_path, 'r') as f:
+            return f.read()
+    else:
+        raise ValueError(f"Unsupported file type: {file_path}")
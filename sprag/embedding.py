@@ -1,9 +1,14 @@
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import cohere
 import voyageai
 import ollama
+from sprag.rate_limiter import rate_limited, estimate_num_tokens
+from sprag.auto_context import get_token_encoder
 
 
 dimensionality = {
@@ -20,8 +25,13 @@ dimensionality = {
     "nomic-embed-text": 768,
 }
 
+def count_embedding_tokens(embedding_model, text, input_type=None) -> int:
+    return estimate_num_tokens(text)
+
 class Embedding(ABC):
     subclasses = {}
+    max_batch_size = 50 # max number of texts that get embedded in a single request; subclasses set this to their provider's limit
+    max_tokens_per_request = None # max total number of tokens in a single request, for providers that have one
 
     def __init__(self, dimension=None):
         self.dimension = dimension
@@ -29,6 +39,10 @@ class Embedding(ABC):
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.subclasses[cls.__name__] = cls
+        # every subclass's API calls go through the shared rate limiter and retry layer
+        for method_name in ('get_embeddings', 'aget_embeddings'):
+            if method_name in cls.__dict__:
+                setattr(cls, method_name, rate_limited(cls.__dict__[method_name], count_embedding_tokens))
 
     def to_dict(self):
         return {
@@ -49,7 +63,22 @@ class Embedding(ABC):
     def get_embeddings(self, text, input_type=None):
         pass
 
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        """
+        Count the tokens in each text, for packing texts into requests that fit in max_tokens_per_request. Uses the cl100k_base tokenizer; subclasses can override this with their provider's tokenizer.
+        """
+        return [len(tokens) for tokens in get_token_encoder().encode_ordinary_batch(texts)]
+
+    async def aget_embeddings(self, text, input_type=None):
+        """
+        Async version of get_embeddings. Subclasses should override this with their provider's async client; by default the blocking call is run in a worker thread.
+        """
+        return await asyncio.to_thread(self.get_embeddings, text, input_type)
+
 class OpenAIEmbedding(Embedding):
+    max_batch_size = 2048
+    max_tokens_per_request = 300_000
+
     def __init__(self, model: str = "text-embedding-3-small", dimension: int = 768):
         """
         Only v3 models are supported.
@@ -57,11 +86,17 @@ class OpenAIEmbedding(Embedding):
         super().__init__(dimension)
         self.model = model
         self.client = OpenAI()
+        self.async_client = AsyncOpenAI()
 
     def get_embeddings(self, text, input_type=None):
         response = self.client.embeddings.create(input=text, model=self.model, dimensions=int(self.dimension))
         embeddings = [embedding_item.embedding for embedding_item in response.data]
         return embeddings[0] if isinstance(text, str) else embeddings
+
+    async def aget_embeddings(self, text, input_type=None):
+        response = await self.async_client.embeddings.create(input=text, model=self.model, dimensions=int(self.dimension))
+        embeddings = [embedding_item.embedding for embedding_item in response.data]
+        return embeddings[0] if isinstance(text, str) else embeddings
     
     def to_dict(self):
         base_dict = super().to_dict()
@@ -71,10 +106,13 @@ class OpenAIEmbedding(Embedding):
         return base_dict
 
 class CohereEmbedding(Embedding):
+    max_batch_size = 96
+
     def __init__(self, model: str = "embed-english-v3.0", dimension: int = None):
         super().__init__()
         self.model = model
         self.client = cohere.Client(os.environ['CO_API_KEY'])
+        self.async_client = cohere.AsyncClient(os.environ['CO_API_KEY'])
         
         # Set dimension if not provided
         if dimension is None:
@@ -85,12 +123,19 @@ class CohereEmbedding(Embedding):
         else:
             self.dimension = dimension
 
-    def get_embeddings(self, text, input_type=None):
+    def get_input_type(self, input_type):
         if input_type == "query":
-            input_type = "search_query"
+            return "search_query"
         elif input_type == "document":
-            input_type = "search_document"
-        response = self.client.embed(texts=[text] if isinstance(text, str) else text, input_type=input_type, model=self.model)
+            return "search_document"
+        return input_type
+
+    def get_embeddings(self, text, input_type=None):
+        response = self.client.embed(texts=[text] if isinstance(text, str) else text, input_type=self.get_input_type(input_type), model=self.model)
+        return response.embeddings[0] if isinstance(text, str) else response.embeddings
+
+    async def aget_embeddings(self, text, input_type=None):
+        response = await self.async_client.embed(texts=[text] if isinstance(text, str) else text, input_type=self.get_input_type(input_type), model=self.model)
         return response.embeddings[0] if isinstance(text, str) else response.embeddings
     
     def to_dict(self):
@@ -101,10 +146,14 @@ class CohereEmbedding(Embedding):
         return base_dict
 
 class VoyageAIEmbedding(Embedding):
+    max_batch_size = 128
+    max_tokens_per_request = 120_000 # the limit for voyage-large-2; Voyage's tokenizer isn't the same as the one used by count_tokens, so requests that are still too large get split automatically
+
     def __init__(self, model: str = "voyage-large-2", dimension: int = None):
         super().__init__()
         self.model = model
         self.client = voyageai.Client()
+        self.async_client = voyageai.AsyncClient()
 
         # Set dimension if not provided
         if dimension is None:
@@ -118,6 +167,10 @@ class VoyageAIEmbedding(Embedding):
     def get_embeddings(self, text, input_type=None):
         response = self.client.embed(texts=[text] if isinstance(text, str) else text, model=self.model, input_type=input_type)
         return response.embeddings[0] if isinstance(text, str) else response.embeddings
+
+    async def aget_embeddings(self, text, input_type=None):
+        response = await self.async_client.embed(texts=[text] if isinstance(text, str) else text, model=self.model, input_type=input_type)
+        return response.embeddings[0] if isinstance(text, str) else response.embeddings
         
     def to_dict(self):
         base_dict = super().to_dict()
@@ -129,13 +182,24 @@ class VoyageAIEmbedding(Embedding):
 
 
 class OllamaEmbedding(Embedding):
+    max_batch_size = 256 # the server is local, so this only limits how much work goes into each call
 
     def __init__(
-        self, model: str = "llama3", dimension: int = None, client: ollama.Client = None
+        self, model: str = "llama3", dimension: int = None, client: ollama.Client = None, async_client: ollama.AsyncClient = None,
+        max_workers: int = 8, use_batch_endpoint: bool = None
     ):
+        """
+        - max_workers: max number of concurrent requests to the Ollama server when embedding a list of texts one at a time
+        - use_batch_endpoint: whether to embed a list of texts in a single request with Ollama's batch embed endpoint. None (the default) uses it if the server supports it, and falls back to concurrent single-text requests otherwise.
+        """
         super().__init__(dimension)
         self.model = model
         self.client = client or ollama.Client()
+        self.async_client = async_client or ollama.AsyncClient()
+        self.max_workers = max_workers
+        self.use_batch_endpoint = use_batch_endpoint
+        # older Ollama servers and clients (before 0.3) don't have the batch endpoint; this gets set to False the first time it's missing
+        self.batch_endpoint_available = use_batch_endpoint is not False and hasattr(self.client, "embed")
         ollama.pull(model)
 
         if dimension is None:
@@ -148,18 +212,142 @@ class OllamaEmbedding(Embedding):
         else:
             self.dimension = dimension
 
+    def is_missing_batch_endpoint_error(self, error: Exception) -> bool:
+        # a missing model is also a 404, but its error message names the model
+        return self.use_batch_endpoint is None and isinstance(error, ollama.ResponseError) and error.status_code == 404 and self.model not in str(error)
+
     def get_embeddings(self, text, input_type=None):
-        if isinstance(text, list):
-            responses = []
-            for text in text:
-                response = self.client.embeddings(model=self.model, prompt=text)
-                responses.append(response["embedding"])
-            return responses
-        else:
+        if not isinstance(text, list):
             response = self.client.embeddings(model=self.model, prompt=text)
             return response["embedding"]
+        if self.batch_endpoint_available:
+            try:
+                return self.client.embed(model=self.model, input=text)["embeddings"]
+            except Exception as e:
+                if not self.is_missing_batch_endpoint_error(e):
+                    raise
+                print ("Ollama server doesn't support the batch embed endpoint. Falling back to one request per text.")
+                self.batch_endpoint_available = False
+        # one request per text, several at a time; map returns the results in the same order as the texts
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(text)))) as executor:
+            responses = list(executor.map(lambda t: self.client.embeddings(model=self.model, prompt=t), text))
+        return [response["embedding"] for response in responses]
+
+    async def aget_embeddings(self, text, input_type=None):
+        if not isinstance(text, list):
+            response = await self.async_client.embeddings(model=self.model, prompt=text)
+            return response["embedding"]
+        if self.batch_endpoint_available:
+            try:
+                response = await self.async_client.embed(model=self.model, input=text)
+                return response["embeddings"]
+            except Exception as e:
+                if not self.is_missing_batch_endpoint_error(e):
+                    raise
+                print ("Ollama server doesn't support the batch embed endpoint. Falling back to one request per text.")
+                self.batch_endpoint_available = False
+        semaphore = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def get_embedding(t):
+            async with semaphore:
+                response = await self.async_client.embeddings(model=self.model, prompt=t)
+            return response["embedding"]
+
+        # gather returns the results in the same order as the texts
+        return list(await asyncio.gather(*[get_embedding(t) for t in text]))
 
     def to_dict(self):
         base_dict = super().to_dict()
-        base_dict.update({"model": self.model})
+        base_dict.update({"model": self.model, "max_workers": self.max_workers, "use_batch_endpoint": self.use_batch_endpoint})
+        return base_dict
+
+
+class SentenceTransformerEmbedding(Embedding):
+    """
+    Runs a sentence-transformers model locally (on CPU by default), so embedding doesn't need a network call. Requires `pip install sprag[local]` (sentence-transformers), or `pip install sprag[onnx]` for the ONNX backend.
+    """
+    max_batch_size = 256 # max number of texts per get_embeddings call; they're run through the model batch_size at a time
+
+    def __init__(
+        self, model: str = "sentence-transformers/all-MiniLM-L6-v2", dimension: int = None, backend: str = "torch", device: str = "cpu",
+        batch_size: int = 32, num_threads: int = None, quantize: bool = False, onnx_file_name: str = None, normalize_embeddings: bool = True
+    ):
+        """
+        - backend: "torch" or "onnx" (ONNX Runtime, which is usually faster on CPU)
+        - batch_size: number of texts that go through the model at once
+        - num_threads: number of CPU threads used for inference (None uses the library default). With the torch backend, this is a process-wide setting.
+        - quantize: use int8 weights. With the torch backend, the linear layers are quantized dynamically when the model is loaded; with the ONNX backend, the quantized ONNX file that ships with the model is loaded (onnx_file_name, "onnx/model_qint8_avx512.onnx" by default).
+        - onnx_file_name: ONNX file to load from the model repo with the ONNX backend
+        - dimension: defaults to the model's embedding dimension; a smaller value truncates the embeddings (only useful for models trained for it, like nomic-embed-text-v1.5)
+        """
+        super().__init__(dimension)
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unknown backend: {backend}. Must be 'torch' or 'onnx'.")
+        self.model = model
+        self.backend = backend
+        self.device = device
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.quantize = quantize
+        self.onnx_file_name = onnx_file_name
+        self.normalize_embeddings = normalize_embeddings
+        # the model uses all of its threads for each call, so concurrent calls (e.g. from the async API) take turns instead of competing for the CPU
+        self.lock = threading.Lock()
+        self.sentence_transformer = self.load_model()
+        if dimension is None:
+            self.dimension = self.sentence_transformer.get_sentence_embedding_dimension()
+
+    def load_model(self):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("SentenceTransformerEmbedding requires the sentence-transformers package. Install it with `pip install sentence-transformers`.")
+
+        model_kwargs = {}
+        if self.backend == "onnx":
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            if self.num_threads is not None:
+                session_options.intra_op_num_threads = self.num_threads
+            model_kwargs["session_options"] = session_options
+            model_kwargs["provider"] = "CPUExecutionProvider" if self.device == "cpu" else "CUDAExecutionProvider"
+            onnx_file_name = self.onnx_file_name or ("onnx/model_qint8_avx512.onnx" if self.quantize else None)
+            if onnx_file_name is not None:
+                model_kwargs["file_name"] = onnx_file_name
+            return SentenceTransformer(self.model, device=self.device, backend="onnx", model_kwargs=model_kwargs, truncate_dim=self.dimension)
+
+        import torch
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        sentence_transformer = SentenceTransformer(self.model, device=self.device, truncate_dim=self.dimension)
+        if self.quantize:
+            sentence_transformer = torch.ao.quantization.quantize_dynamic(sentence_transformer, {torch.nn.Linear}, dtype=torch.qint8)
+        return sentence_transformer
+
+    def get_prompt_name(self, input_type):
+        # models that need a prefix on queries or documents (e.g. E5, BGE) define it as a named prompt
+        prompts = getattr(self.sentence_transformer, "prompts", None) or {}
+        return input_type if input_type in prompts else None
+
+    def get_embeddings(self, text, input_type=None):
+        texts = [text] if isinstance(text, str) else text
+        with self.lock:
+            embeddings = self.sentence_transformer.encode(
+                texts, batch_size=self.batch_size, prompt_name=self.get_prompt_name(input_type), normalize_embeddings=self.normalize_embeddings,
+                convert_to_numpy=True, show_progress_bar=False
+            )
+        return embeddings[0].tolist() if isinstance(text, str) else embeddings.tolist()
+
+    def to_dict(self):
+        base_dict = super().to_dict()
+        base_dict.update({
+            'model': self.model,
+            'backend': self.backend,
+            'device': self.device,
+            'batch_size': self.batch_size,
+            'num_threads': self.num_threads,
+            'quantize': self.quantize,
+            'onnx_file_name': self.onnx_file_name,
+            'normalize_embeddings': self.normalize_embeddings,
+        })
         return base_dict
@@ -3,19 +3,95 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 import os
 import time
 import json
-from sprag.auto_context import get_document_context, get_chunk_header
+import asyncio
+import threading
+import copy
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from sprag.auto_context import get_document_context, aget_document_context, get_chunk_header
 from sprag.rse import get_relevance_values, get_best_segments, get_meta_document
 from sprag.vector_db import VectorDB, BasicVectorDB
 from sprag.chunk_db import ChunkDB, BasicChunkDB
 from sprag.embedding import Embedding, OpenAIEmbedding
 from sprag.reranker import Reranker, CohereReranker
 from sprag.llm import LLM, AnthropicChatAPI
+from sprag.cache import SQLiteCache, EmbeddingCache, LRUCache, RerankCache
+from sprag.rate_limiter import is_request_too_large_error
+
+DEFAULT_RSE_PARAMS = {
+    'max_length': 10,
+    'overall_max_length': 20,
+    'minimum_value': 0.6,
+    'irrelevant_chunk_penalty': 0.15,
+    'overall_max_length_extension': 5,
+    'decay_rate': 30,
+    'top_k_for_document_selection': 7
+}
+
+DEFAULT_CACHE_PARAMS = {
+    'embedding_cache': False, # persist embeddings in an SQLite file under storage_directory, so the same text never gets embedded twice (e.g. when rebuilding a KB)
+    'embedding_cache_max_entries': 1_000_000,
+    'query_embedding_cache_max_entries': 10_000, # in-memory cache of query embeddings, so repeated queries don't need an embedding call; set to 0 to disable
+    'query_embedding_cache_ttl': None, # seconds; None means query embeddings stay cached until they're evicted
+    'rerank_cache_max_entries': 1000, # in-memory cache of reranker relevance scores, keyed by the query and the candidate chunks; set to 0 to disable
+    'rerank_cache_on_disk': False, # also persist the reranker relevance scores in an SQLite file under storage_directory
+    'rerank_cache_disk_max_entries': 100_000,
+    'auto_context_cache': False, # persist AutoContext document contexts in an SQLite file under storage_directory, so the LLM isn't called again for unchanged documents (e.g. when rebuilding a KB)
+    'auto_context_cache_max_entries': 100_000,
+    'query_result_cache_max_entries': 0, # in-memory cache of query results, keyed by the queries, the RSE parameters, and the KB version; 0 disables it
+}
+
+class ReadWriteLock:
+    """
+    Lock that can be held by any number of readers at once, or by a single writer. Waiting writers go first, so a steady stream of readers can't starve them.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.num_readers = 0
+        self.num_waiting_writers = 0
+        self.writing = False
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.num_waiting_writers > 0:
+                self.condition.wait()
+            self.num_readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.num_readers -= 1
+                if self.num_readers == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.condition:
+            self.num_waiting_writers += 1
+            while self.writing or self.num_readers > 0:
+                self.condition.wait()
+            self.num_waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
 
 
 class KnowledgeBase:
-    def __init__(self, kb_id: str, title: str = "", description: str = "", language: str = "en", storage_directory: str = '~/spRAG', embedding_model: Embedding = None, reranker: Reranker = None, auto_context_model: LLM = None, vector_db: VectorDB = None, chunk_db: ChunkDB = None, exists_ok: bool = True):
+    def __init__(self, kb_id: str, title: str = "", description: str = "", language: str = "en", storage_directory: str = '~/spRAG', embedding_model: Embedding = None, reranker: Reranker = None, auto_context_model: LLM = None, vector_db: VectorDB = None, chunk_db: ChunkDB = None, exists_ok: bool = True, cache_params: dict = None):
+        """
+        - cache_params: dictionary of caching options (see DEFAULT_CACHE_PARAMS). These are runtime settings, so they aren't saved with the KB.
+        """
         self.kb_id = kb_id
         self.storage_directory = os.path.expanduser(storage_directory)
+        # writes can come from worker threads (see aadd_document) while searches run in others, and the databases can't be read while they're being modified
+        self.lock = ReadWriteLock()
+        self.version = 0 # incremented every time documents are added or deleted, so cached query results are never served for a KB that has changed since
+        self.initialize_caches(cache_params or {})
 
         # load the KB if it exists; otherwise, initialize it and save it to disk
         metadata_path = self.get_metadata_path()
@@ -47,6 +123,55 @@ class KnowledgeBase:
     def get_metadata_path(self):
         return os.path.join(self.storage_directory, 'metadata', f'{self.kb_id}.json')
 
+    def initialize_caches(self, cache_params: dict):
+        self.cache_params = {key: cache_params.get(key, default_value) for key, default_value in DEFAULT_CACHE_PARAMS.items()}
+        cache_directory = os.path.join(self.storage_directory, 'cache')
+        if self.cache_params['embedding_cache']:
+            self.embedding_cache = EmbeddingCache(os.path.join(cache_directory, 'embeddings.sqlite'), max_entries=self.cache_params['embedding_cache_max_entries'])
+        else:
+            self.embedding_cache = None
+        if self.cache_params['auto_context_cache']:
+            self.auto_context_cache = SQLiteCache(os.path.join(cache_directory, 'auto_context.sqlite'), max_entries=self.cache_params['auto_context_cache_max_entries'])
+        else:
+            self.auto_context_cache = None
+        if self.cache_params['query_embedding_cache_max_entries'] > 0:
+            self.query_embedding_cache = LRUCache(self.cache_params['query_embedding_cache_max_entries'], ttl=self.cache_params['query_embedding_cache_ttl'])
+        else:
+            self.query_embedding_cache = None
+        if self.cache_params['rerank_cache_max_entries'] > 0:
+            rerank_cache_path = os.path.join(cache_directory, 'rerank.sqlite') if self.cache_params['rerank_cache_on_disk'] else None
+            self.rerank_cache = RerankCache(self.cache_params['rerank_cache_max_entries'], path=rerank_cache_path, disk_max_entries=self.cache_params['rerank_cache_disk_max_entries'])
+        else:
+            self.rerank_cache = None
+        if self.cache_params['query_result_cache_max_entries'] > 0:
+            self.query_result_cache = LRUCache(self.cache_params['query_result_cache_max_entries'])
+        else:
+            self.query_result_cache = None
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns the hit and miss counts and the size of each of the in-memory caches
+        """
+        stats = {}
+        if self.query_embedding_cache is not None:
+            stats['query_embedding_cache'] = self.query_embedding_cache.stats()
+        if self.rerank_cache is not None:
+            stats['rerank_cache'] = self.rerank_cache.stats()
+        if self.query_result_cache is not None:
+            stats['query_result_cache'] = self.query_result_cache.stats()
+        return stats
+
+    def clear_caches(self):
+        """
+        Clear the in-memory caches. The persistent caches are left as is, since they're shared with other KBs and never go stale.
+        """
+        if self.query_embedding_cache is not None:
+            self.query_embedding_cache.clear()
+        if self.rerank_cache is not None:
+            self.rerank_cache.clear()
+        if self.query_result_cache is not None:
+            self.query_result_cache.clear()
+
     def initialize_components(self, embedding_model, reranker, auto_context_model, vector_db, chunk_db):
         self.embedding_model = embedding_model if embedding_model else OpenAIEmbedding()
         self.reranker = reranker if reranker else CohereReranker()
@@ -97,20 +222,44 @@ class KnowledgeBase:
         os.remove(self.get_metadata_path())
 
     def add_document(self, doc_id: str, text: str, auto_context: bool = True, chunk_header: str = None, auto_context_guidance: str = ""):
+        # verify that the document does not already exist in the KB
+        if doc_id in self.chunk_db.get_all_doc_ids():
+            print (f"Document with ID {doc_id} already exists in the KB. Skipping...")
+            return
+
+        document = self.prepare_document(doc_id, text, auto_context=auto_context, chunk_header=chunk_header, auto_context_guidance=auto_context_guidance)
+        print (f'Adding {len(document["chunks"])} chunks to the database')
+        document["chunk_embeddings"] = self.embed_document_chunks(document["chunks"], document["chunk_header"])
+        self.write_documents([document])
+
+    async def aadd_document(self, doc_id: str, text: str, auto_context: bool = True, chunk_header: str = None, auto_context_guidance: str = ""):
+        """
+        Async version of add_document. The AutoContext and embedding calls are made with the providers' async clients, and the embedding batches are sent concurrently.
+        """
+        if doc_id in self.chunk_db.get_all_doc_ids():
+            print (f"Document with ID {doc_id} already exists in the KB. Skipping...")
+            return
+
+        document = await self.aprepare_document(doc_id, text, auto_context=auto_context, chunk_header=chunk_header, auto_context_guidance=auto_context_guidance)
+        print (f'Adding {len(document["chunks"])} chunks to the database')
+        document["chunk_embeddings"] = await self.aembed_document_chunks(document["chunks"], document["chunk_header"])
+        await asyncio.to_thread(self.write_documents, [document])
+
+    def prepare_document(self, doc_id: str, text: str, auto_context: bool = True, chunk_header: str = None, auto_context_guidance: str = "") -> dict:
+        """
+        Run AutoContext (if enabled) and split the document into chunks.
+
+        Returns a dictionary with the doc_id, chunks, and chunk_header of the document
+        """
         # verify that only one of auto_context and chunk_header is set
         try:
             assert auto_context != (chunk_header is not None)
         except:
             print ("Error in add_document: only one of auto_context and chunk_header can be set")
-
-        # verify that the document does not already exist in the KB
-        if doc_id in self.chunk_db.get_all_doc_ids():
-            print (f"Document with ID {doc_id} already exists in the KB. Skipping...")
-            return
         
         # AutoContext
         if auto_context:
-            document_context = get_document_context(self.auto_context_model, text, document_title=doc_id, auto_context_guidance=auto_context_guidance)
+            document_context = get_document_context(self.auto_context_model, text, document_title=doc_id, auto_context_guidance=auto_context_guidance, cache=self.auto_context_cache)
             chunk_header = get_chunk_header(file_name=doc_id, document_context=document_context)
         elif chunk_header:
             pass
@@ -118,40 +267,202 @@ class KnowledgeBase:
             chunk_header = ""
 
         chunks = self.split_into_chunks(text)
-        print (f'Adding {len(chunks)} chunks to the database')
+        return {"doc_id": doc_id, "chunks": chunks, "chunk_header": chunk_header}
 
+    async def aprepare_document(self, doc_id: str, text: str, auto_context: bool = True, chunk_header: str = None, auto_context_guidance: str = "") -> dict:
+        """
+        Async version of prepare_document
+        """
+        if auto_context:
+            if chunk_header is not None:
+                print ("Error in add_document: only one of auto_context and chunk_header can be set")
+            document_context = await aget_document_context(self.auto_context_model, text, document_title=doc_id, auto_context_guidance=auto_context_guidance, cache=self.auto_context_cache)
+            chunk_header = get_chunk_header(file_name=doc_id, document_context=document_context)
+        return self.prepare_document(doc_id, text, auto_context=False, chunk_header=chunk_header)
+
+    def get_embedding_batches(self, texts: list[str]) -> list[tuple[int, int]]:
+        """
+        Split texts into (start, end) ranges that each fit in a single embedding request
+        - texts are packed greedily, up to the embedding model's max_batch_size texts and max_tokens_per_request tokens per request
+        """
+        max_batch_size = self.embedding_model.max_batch_size
+        max_tokens_per_request = self.embedding_model.max_tokens_per_request
+        if max_tokens_per_request is None:
+            return [(i, min(i + max_batch_size, len(texts))) for i in range(0, len(texts), max_batch_size)]
+
+        batches = []
+        start = 0
+        num_tokens = 0
+        for i, num_text_tokens in enumerate(self.embedding_model.count_tokens(texts)):
+            if i > start and (i - start >= max_batch_size or num_tokens + num_text_tokens > max_tokens_per_request):
+                batches.append((start, i))
+                start = i
+                num_tokens = 0
+            num_tokens += num_text_tokens
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def shrink_embedding_batches(self, rejected_texts: list[str]):
+        """
+        Lower the embedding model's batch limits after the provider rejected a request with rejected_texts (more than one text) as too large, so later requests are packed smaller
+        """
+        self.embedding_model.max_batch_size = max(1, min(self.embedding_model.max_batch_size, len(rejected_texts) // 2))
+        if self.embedding_model.max_tokens_per_request is not None:
+            self.embedding_model.max_tokens_per_request = max(1, min(self.embedding_model.max_tokens_per_request, sum(self.embedding_model.count_tokens(rejected_texts)) // 2))
+        print (f"Embedding request with {len(rejected_texts)} texts was too large. Reducing the batch size to {self.embedding_model.max_batch_size} texts and {self.embedding_model.max_tokens_per_request} tokens.")
+
+    def get_chunks_to_embed(self, chunks: list[str], chunk_header: str) -> list[str]:
         # add chunk headers to the chunks before embedding them
         chunks_to_embed = []
         for i, chunk in enumerate(chunks):
             chunk_to_embed = f'[{chunk_header}]\n{chunk}'
             chunks_to_embed.append(chunk_to_embed)
+        return chunks_to_embed
 
-        # embed the chunks
-        if len(chunks) <= 50:
-            # if the document is short, we can get all the embeddings at once
-            chunk_embeddings = self.get_embeddings(chunks_to_embed, input_type="document")
-        else:
-            # if the document is long, we need to get the embeddings in chunks
-            chunk_embeddings = []
-            for i in range(0, len(chunks), 50):
-                chunk_embeddings += self.get_embeddings(chunks_to_embed[i:i+50], input_type="document")
+    def embed_chunks(self, chunks_to_embed: list[str]) -> list:
+        """
+        Embed a list of chunks (with their headers already added), packing as many of them into each embedding request as the embedding model allows
+        """
+        chunk_embeddings = []
+        for start, end in self.get_embedding_batches(chunks_to_embed):
+            chunk_embeddings += self.embed_batch(chunks_to_embed[start:end])
+        assert len(chunk_embeddings) == len(chunks_to_embed)
+        return chunk_embeddings
 
-        assert len(chunks) == len(chunk_embeddings) == len(chunks_to_embed)
-        self.chunk_db.add_document(doc_id, {i: {'chunk_text': chunk, 'chunk_header': chunk_header} for i, chunk in enumerate(chunks)})
+    def embed_batch(self, texts: list[str]) -> list:
+        try:
+            return self.get_embeddings(texts, input_type="document")
+        except Exception as e:
+            if len(texts) == 1 or not is_request_too_large_error(e):
+                raise
+        # the request was too large, so split it in half
+        self.shrink_embedding_batches(texts)
+        return self.embed_batch(texts[:len(texts) // 2]) + self.embed_batch(texts[len(texts) // 2:])
+
+    async def aembed_chunks(self, chunks_to_embed: list[str]) -> list:
+        # embed all of the batches concurrently
+        batch_embeddings = await asyncio.gather(*[self.aembed_batch(chunks_to_embed[start:end]) for start, end in self.get_embedding_batches(chunks_to_embed)])
+        chunk_embeddings = [embedding for embeddings in batch_embeddings for embedding in embeddings]
+        assert len(chunk_embeddings) == len(chunks_to_embed)
+        return chunk_embeddings
+
+    async def aembed_batch(self, texts: list[str]) -> list:
+        try:
+            return await self.aget_embeddings(texts, input_type="document")
+        except Exception as e:
+            if len(texts) == 1 or not is_request_too_large_error(e):
+                raise
+        self.shrink_embedding_batches(texts)
+        first_half, second_half = await asyncio.gather(self.aembed_batch(texts[:len(texts) // 2]), self.aembed_batch(texts[len(texts) // 2:]))
+        return first_half + second_half
 
-        # create metadata list
-        metadata = []
-        for i, chunk in enumerate(chunks):
-            metadata.append({'doc_id': doc_id, 'chunk_index': i, 'chunk_header': chunk_header, 'chunk_text': chunk})
+    def embed_document_chunks(self, chunks: list[str], chunk_header: str) -> list:
+        return self.embed_chunks(self.get_chunks_to_embed(chunks, chunk_header))
 
-        # add the vectors and metadata to the vector database
-        self.vector_db.add_vectors(vectors=chunk_embeddings, metadata=metadata)
+    async def aembed_document_chunks(self, chunks: list[str], chunk_header: str) -> list:
+        return await self.aembed_chunks(self.get_chunks_to_embed(chunks, chunk_header))
 
-        self.save() # save the database to disk after adding a document
+    def add_documents(self, documents, auto_context: bool = True, auto_context_guidance: str = "", write_batch_size: int = 2000):
+        """
+        Add many documents at once. Chunks from different documents are packed together into the same embedding requests, and the documents are written to the chunk and vector databases in batches instead of one at a time.
+        - documents: iterable of dictionaries with doc_id and text keys, and optionally chunk_header, auto_context, and auto_context_guidance keys to override the defaults for that document
+        - write_batch_size: the documents are embedded and written once at least this many chunks are waiting
+        """
+        existing_doc_ids = set(self.chunk_db.get_all_doc_ids())
+        prepared_documents = []
+        num_chunks = 0
+        for document in documents:
+            doc_id = document["doc_id"]
+            if doc_id in existing_doc_ids:
+                print (f"Document with ID {doc_id} already exists in the KB. Skipping...")
+                continue
+            existing_doc_ids.add(doc_id)
+
+            chunk_header = document.get("chunk_header")
+            prepared_document = self.prepare_document(doc_id, document["text"], auto_context=document.get("auto_context", auto_context and chunk_header is None), chunk_header=chunk_header, auto_context_guidance=document.get("auto_context_guidance", auto_context_guidance))
+            prepared_documents.append(prepared_document)
+            num_chunks += len(prepared_document["chunks"])
+            if num_chunks >= write_batch_size:
+                self.embed_and_write_documents(prepared_documents)
+                prepared_documents = []
+                num_chunks = 0
+
+        if prepared_documents:
+            self.embed_and_write_documents(prepared_documents)
+        self.compact()
+
+    def embed_and_write_documents(self, documents: list[dict]):
+        """
+        Embed the chunks of a batch of prepared documents (see prepare_document) together, then write them all to the databases at once
+        """
+        chunks_to_embed = [chunk for document in documents for chunk in self.get_chunks_to_embed(document["chunks"], document["chunk_header"])]
+        print (f'Adding {len(chunks_to_embed)} chunks from {len(documents)} documents to the database')
+        chunk_embeddings = self.embed_chunks(chunks_to_embed)
+
+        # split the embeddings back up by document
+        start = 0
+        for document in documents:
+            document["chunk_embeddings"] = chunk_embeddings[start:start + len(document["chunks"])]
+            start += len(document["chunks"])
+        self.write_documents(documents)
+
+    def write_documents(self, documents: list[dict]):
+        """
+        Write a batch of prepared and embedded documents (see prepare_document and embed_document_chunks) to the chunk and vector databases, with a single write to each database for the whole batch.
+        - each document is a dictionary with the keys doc_id, chunks, chunk_header, and chunk_embeddings
+        """
+        vectors = []
+        metadata = []
+        with self.lock.write():
+            try:
+                # checked again here since concurrent calls (e.g. to aadd_document) can prepare the same document at the same time
+                existing_doc_ids = set(self.chunk_db.get_all_doc_ids())
+                chunk_db_documents = {}
+                for document in documents:
+                    doc_id, chunks, chunk_header = document["doc_id"], document["chunks"], document["chunk_header"]
+                    if doc_id in existing_doc_ids or doc_id in chunk_db_documents:
+                        print (f"Document with ID {doc_id} already exists in the KB. Skipping...")
+                        continue
+                    chunk_db_documents[doc_id] = {i: {'chunk_text': chunk, 'chunk_header': chunk_header} for i, chunk in enumerate(chunks)}
+
+                    # create metadata list
+                    for i, chunk in enumerate(chunks):
+                        metadata.append({'doc_id': doc_id, 'chunk_index': i, 'chunk_header': chunk_header, 'chunk_text': chunk})
+                    vectors.extend(document["chunk_embeddings"])
+
+                if not chunk_db_documents:
+                    return
+                # add the chunks to the chunk database and the vectors and metadata to the vector database
+                self.chunk_db.add_documents(chunk_db_documents)
+                try:
+                    self.vector_db.add_vectors(vectors=vectors, metadata=metadata)
+                except Exception:
+                    # undo the chunk database write, so the documents aren't left half written and can be written again
+                    for doc_id in chunk_db_documents:
+                        self.chunk_db.remove_document(doc_id)
+                    raise
+
+                self.save() # save the database to disk after adding documents
+            finally:
+                # bumped after the write (even a failed one), so results computed while it was in progress are never served afterwards
+                self.version += 1
+
+    def compact(self):
+        """
+        Merge the chunk and vector databases' logs into new snapshots (which also saves the vector index), so loading the KB doesn't have to replay the logs or rebuild the index. Called at the end of add_documents and create_kb_from_directory.
+        """
+        with self.lock.write():
+            self.chunk_db.save()
+            self.vector_db.save()
 
     def delete_document(self, doc_id: str):
-        self.chunk_db.remove_document(doc_id)
-        self.vector_db.remove_document(doc_id)
+        with self.lock.write():
+            try:
+                self.chunk_db.remove_document(doc_id)
+                self.vector_db.remove_document(doc_id)
+            finally:
+                self.version += 1
 
     def get_chunk_text(self, doc_id: str, chunk_index: int) -> str:
         return self.chunk_db.get_chunk_text(doc_id, chunk_index)
@@ -160,7 +471,65 @@ class KnowledgeBase:
         return self.chunk_db.get_chunk_header(doc_id, chunk_index)
 
     def get_embeddings(self, text: str or list[str], input_type: str = ""):
-        return self.embedding_model.get_embeddings(text, input_type)
+        if self.embedding_cache is None and (self.query_embedding_cache is None or input_type != "query"):
+            return self.embedding_model.get_embeddings(text, input_type)
+        # only embed the texts that aren't in one of the caches
+        texts = [text] if isinstance(text, str) else text
+        embeddings = self.get_cached_embeddings(texts, input_type)
+        texts_to_embed = list(dict.fromkeys(t for t, embedding in zip(texts, embeddings) if embedding is None))
+        if texts_to_embed:
+            new_embeddings = self.embedding_model.get_embeddings(texts_to_embed, input_type)
+            embeddings = self.add_to_embedding_caches(texts, embeddings, texts_to_embed, new_embeddings, input_type)
+        return embeddings[0] if isinstance(text, str) else embeddings
+
+    async def aget_embeddings(self, text: str or list[str], input_type: str = ""):
+        if self.embedding_cache is None and (self.query_embedding_cache is None or input_type != "query"):
+            return await self.embedding_model.aget_embeddings(text, input_type)
+        texts = [text] if isinstance(text, str) else text
+        # the persistent cache does disk I/O, so keep it off the event loop
+        if self.embedding_cache is None:
+            embeddings = self.get_cached_embeddings(texts, input_type)
+        else:
+            embeddings = await asyncio.to_thread(self.get_cached_embeddings, texts, input_type)
+        texts_to_embed = list(dict.fromkeys(t for t, embedding in zip(texts, embeddings) if embedding is None))
+        if texts_to_embed:
+            new_embeddings = await self.embedding_model.aget_embeddings(texts_to_embed, input_type)
+            embeddings = await asyncio.to_thread(self.add_to_embedding_caches, texts, embeddings, texts_to_embed, new_embeddings, input_type)
+        return embeddings[0] if isinstance(text, str) else embeddings
+
+    def get_cached_embeddings(self, texts: list[str], input_type: str) -> list:
+        """
+        Look up each text in the query embedding cache (for queries) and then in the persistent embedding cache. Returns None for the texts that aren't in either.
+        """
+        embeddings = [None] * len(texts)
+        use_query_embedding_cache = self.query_embedding_cache is not None and input_type == "query"
+        if use_query_embedding_cache:
+            for i, text in enumerate(texts):
+                embedding = self.query_embedding_cache.get(text)
+                if embedding is not None:
+                    embeddings[i] = embedding.tolist()
+        if self.embedding_cache is not None:
+            missing_indices = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            cached_embeddings = self.embedding_cache.get_embeddings(self.embedding_model, [texts[i] for i in missing_indices], input_type)
+            for i, embedding in zip(missing_indices, cached_embeddings):
+                if embedding is not None:
+                    embeddings[i] = embedding
+                    if use_query_embedding_cache:
+                        self.query_embedding_cache.set(texts[i], np.asarray(embedding, dtype=np.float32))
+        return embeddings
+
+    def add_to_embedding_caches(self, texts: list[str], embeddings: list, texts_to_embed: list[str], new_embeddings: list, input_type: str) -> list:
+        """
+        Save the newly computed embeddings to the caches, and fill them in to the list of embeddings for texts
+        """
+        if self.embedding_cache is not None:
+            self.embedding_cache.set_embeddings(self.embedding_model, texts_to_embed, input_type, new_embeddings)
+        if self.query_embedding_cache is not None and input_type == "query":
+            # stored as float32 arrays to keep the memory footprint small
+            for t, embedding in zip(texts_to_embed, new_embeddings):
+                self.query_embedding_cache.set(t, np.asarray(embedding, dtype=np.float32))
+        new_embeddings = dict(zip(texts_to_embed, new_embeddings))
+        return [embedding if embedding is not None else new_embeddings[t] for t, embedding in zip(texts, embeddings)]
     
     def split_into_chunks(self, text):
         text_splitter = RecursiveCharacterTextSplitter(chunk_size = self.kb_metadata['chunk_size'], chunk_overlap = 0, length_function = len)
@@ -171,25 +540,95 @@ class KnowledgeBase:
     def cosine_similarity(self, v1, v2):
         return np.dot(v1, v2) # since the embeddings are normalized
 
+    def rerank_search_results(self, query: str, search_results: list) -> list:
+        """
+        Rerank the search results, using the reranker's cached relevance scores if this query has already been reranked with the same candidates
+        """
+        if self.rerank_cache is None or not self.reranker.supports_relevance_scores():
+            return self.reranker.rerank_search_results(query, search_results)
+        key = self.rerank_cache.get_key(self.reranker, query, search_results)
+        relevance_scores = self.rerank_cache.get(key)
+        if relevance_scores is None:
+            relevance_scores = self.reranker.get_relevance_scores(query, search_results)
+            self.rerank_cache.set(key, relevance_scores)
+        return self.reranker.apply_relevance_scores(search_results, relevance_scores)
+
+    async def arerank_search_results(self, query: str, search_results: list) -> list:
+        if self.rerank_cache is None or not self.reranker.supports_relevance_scores():
+            return await self.reranker.arerank_search_results(query, search_results)
+        key = self.rerank_cache.get_key(self.reranker, query, search_results)
+        relevance_scores = self.rerank_cache.get(key) if self.rerank_cache.disk_cache is None else await asyncio.to_thread(self.rerank_cache.get, key)
+        if relevance_scores is None:
+            relevance_scores = await self.reranker.aget_relevance_scores(query, search_results)
+            await asyncio.to_thread(self.rerank_cache.set, key, relevance_scores)
+        return self.reranker.apply_relevance_scores(search_results, relevance_scores)
+
+    def search_vector_db(self, query_vector, top_k: int) -> list:
+        with self.lock.read():
+            return self.vector_db.search(query_vector, top_k)
+
+    def search_vector_db_batch(self, query_vectors, top_k: int) -> list:
+        with self.lock.read():
+            return self.vector_db.search_batch(query_vectors, top_k)
+
     def search(self, query: str, top_k: int) -> list:
         """
         Get top k most relevant chunks for a given query. This is where we interface with the vector database.
         - returns a list of dictionaries, where each dictionary has the following keys: `metadata` (which contains 'doc_id', 'chunk_index', 'chunk_text', and 'chunk_header') and `similarity`
         """
         query_vector = self.get_embeddings(query, input_type="query") # embed the query
-        search_results = self.vector_db.search(query_vector, top_k) # do a vector database search
-        search_results = self.reranker.rerank_search_results(query, search_results) # rerank search results using a reranker
+        search_results = self.search_vector_db(query_vector, top_k) # do a vector database search
+        search_results = self.rerank_search_results(query, search_results) # rerank search results using a reranker
+        return search_results
+
+    async def asearch(self, query: str, top_k: int) -> list:
+        """
+        Async version of search
+        """
+        query_vector = await self.aget_embeddings(query, input_type="query")
+        search_results = await asyncio.to_thread(self.search_vector_db, query_vector, top_k)
+        search_results = await self.arerank_search_results(query, search_results)
         return search_results
     
-    def get_all_ranked_results(self, search_queries: list[str]):
+    def get_all_ranked_results(self, search_queries: list[str], max_rerank_workers: int = 8):
         """
         - search_queries: list of search queries
+        - max_rerank_workers: maximum number of queries that get reranked concurrently (reranking is usually a network call per query)
+
+        Returns a list of ranked results for each query, in the same order as search_queries
         """
-        all_ranked_results = []
-        for query in search_queries:
-            ranked_results = self.search(query, 200)
-            all_ranked_results.append(ranked_results)
+        if not search_queries:
+            return []
+        query_vectors = self.get_embeddings(search_queries, input_type="query") # embed all of the queries in a single batch
+        all_search_results = self.search_vector_db_batch(query_vectors, 200) # search for all of the queries at once
+
+        # rerank the search results for each query concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(max_rerank_workers, len(search_queries)))) as executor:
+            futures = [executor.submit(self.rerank_search_results, query, search_results) for query, search_results in zip(search_queries, all_search_results)]
+            all_ranked_results = []
+            for query, future in zip(search_queries, futures):
+                try:
+                    all_ranked_results.append(future.result())
+                except Exception as e:
+                    raise RuntimeError(f"Error in get_all_ranked_results: reranking failed for query '{query}'") from e
         return all_ranked_results
+
+    async def aget_all_ranked_results(self, search_queries: list[str]):
+        """
+        Async version of get_all_ranked_results, with all of the queries reranked concurrently
+        """
+        if not search_queries:
+            return []
+        query_vectors = await self.aget_embeddings(search_queries, input_type="query")
+        all_search_results = await asyncio.to_thread(self.search_vector_db_batch, query_vectors, 200)
+
+        async def rerank(query: str, search_results: list) -> list:
+            try:
+                return await self.arerank_search_results(query, search_results)
+            except Exception as e:
+                raise RuntimeError(f"Error in get_all_ranked_results: reranking failed for query '{query}'") from e
+
+        return list(await asyncio.gather(*[rerank(query, search_results) for query, search_results in zip(search_queries, all_search_results)]))
     
     def get_segment_text_from_database(self, doc_id: str, chunk_start: int, chunk_end: int) -> str:
         segment = f"[{self.get_chunk_header(doc_id, chunk_start)}]\n" # initialize the segment with the chunk header
@@ -218,32 +657,66 @@ class KnowledgeBase:
         - text: the full text of the segment
         """
 
-        default_rse_params = {
-            'max_length': 10,
-            'overall_max_length': 20,
-            'minimum_value': 0.6,
-            'irrelevant_chunk_penalty': 0.15,
-            'overall_max_length_extension': 5,
-            'decay_rate': 30,
-            'top_k_for_document_selection': 7
-        }
-
-        # set the RSE parameters
-        max_length = rse_params.get('max_length', default_rse_params['max_length'])
-        overall_max_length = rse_params.get('overall_max_length', default_rse_params['overall_max_length'])
-        minimum_value = rse_params.get('minimum_value', default_rse_params['minimum_value'])
-        irrelevant_chunk_penalty = rse_params.get('irrelevant_chunk_penalty', default_rse_params['irrelevant_chunk_penalty'])
-        overall_max_length_extension = rse_params.get('overall_max_length_extension', default_rse_params['overall_max_length_extension'])
-        decay_rate = rse_params.get('decay_rate', default_rse_params['decay_rate'])
-        top_k_for_document_selection = rse_params.get('top_k_for_document_selection', default_rse_params['top_k_for_document_selection'])
-
-        overall_max_length += (len(search_queries) - 1) * overall_max_length_extension # increase the overall max length for each additional query
+        rse_params = self.get_rse_params(rse_params)
+        cache_key = self.get_query_result_cache_key(search_queries, rse_params)
+        if cache_key is not None and (cached_results := self.query_result_cache.get(cache_key)) is not None:
+            return copy.deepcopy(cached_results)
 
         start_time = time.time()
         all_ranked_results = self.get_all_ranked_results(search_queries=search_queries)
         if latency_profiling:
             print(f"get_all_ranked_results took {time.time() - start_time} seconds to run for {len(search_queries)} queries")
 
+        relevant_segment_info = self.get_relevant_segment_info(all_ranked_results, rse_params, num_queries=len(search_queries))
+        if cache_key is not None:
+            self.query_result_cache.set(cache_key, copy.deepcopy(relevant_segment_info))
+        return relevant_segment_info
+
+    async def aquery(self, search_queries: list[str], rse_params: dict = {}, latency_profiling: bool = False) -> list[dict]:
+        """
+        Async version of query. The queries are embedded in a single call, and the reranking calls for all of the queries are made concurrently.
+        """
+        rse_params = self.get_rse_params(rse_params)
+        cache_key = self.get_query_result_cache_key(search_queries, rse_params)
+        if cache_key is not None and (cached_results := self.query_result_cache.get(cache_key)) is not None:
+            return copy.deepcopy(cached_results)
+
+        start_time = time.time()
+        all_ranked_results = await self.aget_all_ranked_results(search_queries=search_queries)
+        if latency_profiling:
+            print(f"aget_all_ranked_results took {time.time() - start_time} seconds to run for {len(search_queries)} queries")
+
+        relevant_segment_info = self.get_relevant_segment_info(all_ranked_results, rse_params, num_queries=len(search_queries))
+        if cache_key is not None:
+            self.query_result_cache.set(cache_key, copy.deepcopy(relevant_segment_info))
+        return relevant_segment_info
+
+    def get_query_result_cache_key(self, search_queries: list[str], rse_params: dict):
+        """
+        Returns the query result cache key for the queries (with whitespace normalized), the resolved RSE parameters, and the current version of the KB, or None if the query result cache is disabled
+        """
+        if self.query_result_cache is None:
+            return None
+        normalized_queries = tuple(" ".join(query.split()) for query in search_queries)
+        return (normalized_queries, tuple(sorted(rse_params.items())), self.version)
+
+    def get_rse_params(self, rse_params: dict) -> dict:
+        """
+        Fill in the default value for any RSE parameter that isn't set in rse_params
+        """
+        return {key: rse_params.get(key, default_value) for key, default_value in DEFAULT_RSE_PARAMS.items()}
+
+    def get_relevant_segment_info(self, all_ranked_results: list, rse_params: dict, num_queries: int) -> list[dict]:
+        """
+        Run RSE on the ranked results for each query and return the relevant segments (see query)
+        """
+        max_length = rse_params['max_length']
+        minimum_value = rse_params['minimum_value']
+        irrelevant_chunk_penalty = rse_params['irrelevant_chunk_penalty']
+        decay_rate = rse_params['decay_rate']
+        top_k_for_document_selection = rse_params['top_k_for_document_selection']
+        overall_max_length = rse_params['overall_max_length'] + (num_queries - 1) * rse_params['overall_max_length_extension'] # increase the overall max length for each additional query
+
         document_splits, document_start_points, unique_document_ids = get_meta_document(all_ranked_results=all_ranked_results, top_k_for_document_selection=top_k_for_document_selection)
 
         # verify that we have a valid meta-document - otherwise return an empty list of segments
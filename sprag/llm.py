@@ -1,14 +1,24 @@
 from abc import ABC, abstractmethod
+import asyncio
 import os
 import ollama
+from sprag.rate_limiter import rate_limited, estimate_num_tokens
 
 
+def count_llm_tokens(llm, chat_messages: list[dict]) -> int:
+    # providers count the maximum number of output tokens against the budget when the request is made
+    return estimate_num_tokens([message["content"] for message in chat_messages]) + getattr(llm, 'max_tokens', 0)
+
 class LLM(ABC):
     subclasses = {}
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.subclasses[cls.__name__] = cls
+        # every subclass's API calls go through the shared rate limiter and retry layer
+        for method_name in ('make_llm_call', 'amake_llm_call'):
+            if method_name in cls.__dict__:
+                setattr(cls, method_name, rate_limited(cls.__dict__[method_name], count_llm_tokens))
 
     def to_dict(self):
         return {
@@ -31,10 +41,17 @@ class LLM(ABC):
         """
         pass
 
+    async def amake_llm_call(self, chat_messages: list[dict]) -> str:
+        """
+        Async version of make_llm_call. Subclasses should override this with their provider's async client; by default the blocking call is run in a worker thread.
+        """
+        return await asyncio.to_thread(self.make_llm_call, chat_messages)
+
 class OpenAIChatAPI(LLM):
     def __init__(self, model: str = "gpt-3.5-turbo", temperature: float = 0.2, max_tokens: int = 1000):
-        from openai import OpenAI
+        from openai import OpenAI, AsyncOpenAI
         self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
@@ -48,6 +65,16 @@ class OpenAIChatAPI(LLM):
         )
         llm_output = response.choices[0].message.content.strip()
         return llm_output
+
+    async def amake_llm_call(self, chat_messages: list[dict]) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=chat_messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        llm_output = response.choices[0].message.content.strip()
+        return llm_output
     
     def to_dict(self):
         base_dict = super().to_dict()
@@ -60,13 +87,17 @@ class OpenAIChatAPI(LLM):
 
 class AnthropicChatAPI(LLM):
     def __init__(self, model: str = "claude-3-haiku-20240307", temperature: float = 0.2, max_tokens: int = 1000):
-        from anthropic import Anthropic
+        from anthropic import Anthropic, AsyncAnthropic
         self.client = Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
+        self.async_client = AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
 
-    def make_llm_call(self, chat_messages: list[dict]) -> str:
+    def split_system_message(self, chat_messages: list[dict]) -> tuple[str, list[dict]]:
+        """
+        The Anthropic API takes the system message as a separate argument
+        """
         system_message = ""
         num_system_messages = 0
         normal_chat_messages = []
@@ -78,7 +109,10 @@ class AnthropicChatAPI(LLM):
                 num_system_messages += 1
             else:
                 normal_chat_messages.append(message)
+        return system_message, normal_chat_messages
 
+    def make_llm_call(self, chat_messages: list[dict]) -> str:
+        system_message, normal_chat_messages = self.split_system_message(chat_messages)
         message = self.client.messages.create(
             system=system_message,
             messages=normal_chat_messages,
@@ -87,6 +121,17 @@ class AnthropicChatAPI(LLM):
             temperature=self.temperature,
         )
         return message.content[0].text
+
+    async def amake_llm_call(self, chat_messages: list[dict]) -> str:
+        system_message, normal_chat_messages = self.split_system_message(chat_messages)
+        message = await self.async_client.messages.create(
+            system=system_message,
+            messages=normal_chat_messages,
+            model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        return message.content[0].text
     
     def to_dict(self):
         base_dict = super().to_dict()
@@ -99,9 +144,10 @@ class AnthropicChatAPI(LLM):
 
 class OllamaAPI(LLM):
     def __init__(
-        self, model: str = "llama3", temperature: float = 0.2, max_tokens: int = 1000, client: ollama.Client = None
+        self, model: str = "llama3", temperature: float = 0.2, max_tokens: int = 1000, client: ollama.Client = None, async_client: ollama.AsyncClient = None
     ):
         self.client = client or ollama.Client()
+        self.async_client = async_client or ollama.AsyncClient()
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
@@ -118,6 +164,17 @@ class OllamaAPI(LLM):
         )
         return response["message"]["content"].strip()
 
+    async def amake_llm_call(self, chat_messages: list[dict]) -> str:
+        response = await self.async_client.chat(
+            model=self.model,
+            messages=chat_messages,
+            options={
+                "num_predict": self.max_tokens,
+                "temperature": self.temperature,
+            },
+        )
+        return response["message"]["content"].strip()
+
     def to_dict(self):
         base_dict = super().to_dict()
         base_dict.update(
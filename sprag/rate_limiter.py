@@ -0,0 +1,317 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import random
+import threading
+import time
+
+# retry parameters for requests that fail with a rate limit (429) or server (5xx) error
+DEFAULT_RETRY_PARAMS = {
+    'max_retries': 6,
+    'initial_delay': 1.0, # seconds
+    'max_delay': 60.0, # seconds
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously at capacity_per_minute tokens per minute. Not thread-safe on its own; RateLimiter holds a lock around it.
+    - the bucket starts full, so short bursts of up to capacity_per_minute tokens go through immediately
+    """
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.available = capacity_per_minute
+        self.last_refill_time = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.last_refill_time) * self.capacity / 60)
+        self.last_refill_time = now
+
+    def get_wait_time(self, amount: float) -> float:
+        """
+        Return how many seconds it will take until amount tokens are available.
+        - amounts larger than the bucket would never fit, so they only wait for a full bucket
+        """
+        self.refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) * 60 / self.capacity)
+
+    def consume(self, amount: float):
+        self.available -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Limits how many requests and tokens can be used per minute. Safe to share between threads.
+    - requests_per_minute=None or tokens_per_minute=None means no limit on that budget
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.lock = threading.Lock()
+
+    def reserve(self, num_requests: int = 1, num_tokens: int = 0) -> float:
+        """
+        Take num_requests requests and num_tokens tokens from the budgets if they are available, and return 0. Otherwise, take nothing and return how many seconds to wait before trying again.
+        """
+        with self.lock:
+            wait_time = 0.0
+            if self.request_bucket is not None and num_requests > 0:
+                wait_time = max(wait_time, self.request_bucket.get_wait_time(num_requests))
+            if self.token_bucket is not None and num_tokens > 0:
+                wait_time = max(wait_time, self.token_bucket.get_wait_time(num_tokens))
+            if wait_time == 0:
+                if self.request_bucket is not None:
+                    self.request_bucket.consume(num_requests)
+                if self.token_bucket is not None:
+                    self.token_bucket.consume(num_tokens)
+            return wait_time
+
+    def acquire(self, num_requests: int = 1, num_tokens: int = 0):
+        """
+        Block until num_requests requests using num_tokens tokens can be made without going over either budget.
+        """
+        if self.request_bucket is None and self.token_bucket is None:
+            return
+        while (wait_time := self.reserve(num_requests, num_tokens)) > 0:
+            time.sleep(wait_time)
+
+    async def aacquire(self, num_requests: int = 1, num_tokens: int = 0):
+        """
+        Async version of acquire that waits without blocking the event loop.
+        """
+        if self.request_bucket is None and self.token_bucket is None:
+            return
+        while (wait_time := self.reserve(num_requests, num_tokens)) > 0:
+            await asyncio.sleep(wait_time)
+
+
+# rate limiters configured with set_rate_limit, keyed by (provider, model)
+rate_limiters = {}
+# rate limiters added with temporary_rate_limit, keyed by (provider, model); each key has a list of them, which apply on top of the one configured with set_rate_limit
+temporary_rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def set_rate_limit(provider: str, model: str = None, requests_per_minute: float = None, tokens_per_minute: float = None):
+    """
+    Configure the rate limit for a provider, or for a single model of a provider.
+    - provider is the name of the Embedding, Reranker, or LLM subclass (e.g. "OpenAIEmbedding", "CohereReranker", "AnthropicChatAPI")
+    - a limit set without a model is shared by all models of that provider; a limit set for a model only applies to that model. When both are set, a request has to fit in both.
+    - setting both limits to None removes the limit
+    """
+    key = (provider, model)
+    with rate_limiters_lock:
+        if requests_per_minute is None and tokens_per_minute is None:
+            rate_limiters.pop(key, None)
+        else:
+            rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+
+def get_rate_limiters(provider: str, model: str = None) -> list:
+    """
+    Return the rate limiters that apply to a request to the given provider and model.
+    """
+    with rate_limiters_lock:
+        keys = [(provider, None)] if model is None else [(provider, None), (provider, model)]
+        limiters = []
+        for key in keys:
+            limiters.append(rate_limiters.get(key))
+            limiters.extend(temporary_rate_limiters.get(key, []))
+    return [limiter for limiter in limiters if limiter is not None]
+
+@contextlib.contextmanager
+def temporary_rate_limit(provider: str, model: str = None, requests_per_minute: float = None, tokens_per_minute: float = None):
+    """
+    Add a rate limit for the duration of a with block.
+    - the limit applies on top of the limits configured with set_rate_limit (and any other temporary ones), rather than replacing them, so a request has to fit in all of them; this is also the case when model is None, where the limit applies to all models of the provider
+    - does nothing if both limits are None
+    """
+    if requests_per_minute is None and tokens_per_minute is None:
+        yield
+        return
+    key = (provider, model)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    with rate_limiters_lock:
+        temporary_rate_limiters.setdefault(key, []).append(limiter)
+    try:
+        yield
+    finally:
+        with rate_limiters_lock:
+            temporary_rate_limiters[key].remove(limiter)
+            if not temporary_rate_limiters[key]:
+                del temporary_rate_limiters[key]
+
+def estimate_num_tokens(text) -> int:
+    """
+    Cheap estimate of the number of tokens in a string (or list of strings), for the tokens per minute budget.
+    - about 4 characters per token for English text; this avoids running a tokenizer before every request
+    """
+    if isinstance(text, str):
+        return len(text) // 4 + 1
+    return sum(len(t) // 4 + 1 for t in text)
+
+
+def get_status_code(error: Exception):
+    for attribute in ('status_code', 'http_status', 'status'):
+        status_code = getattr(error, attribute, None)
+        if isinstance(status_code, int):
+            return status_code
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code if isinstance(status_code, int) else None
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Rate limit (429) and server (5xx) errors are retried; any other error is raised right away.
+    - the provider SDKs use different exception classes, so this looks at the status code they attach to the error, and falls back to the name of the exception class
+    """
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    error_name = type(error).__name__
+    return any(name in error_name for name in ('RateLimit', 'TooManyRequests', 'ServiceUnavailable', 'Overloaded', 'InternalServer'))
+
+# phrases the providers use when a request has too many inputs or too many tokens in total (e.g. "max 300000 tokens per request", "The max allowed tokens per submitted batch is 120000", "total number of texts must be at most 96", "The batch size limit is 128")
+BATCH_TOO_LARGE_PHRASES = ('per request', 'per submitted batch', 'batch size', 'your batch has', 'number of texts', 'too many inputs', 'too many texts', 'array too long')
+# phrases for a single input that is too long (e.g. "This model's maximum context length is 8192 tokens"), which splitting the request can't fix
+INPUT_TOO_LONG_PHRASES = ('context length', 'context window', 'input length', 'input is too long', 'text is too long')
+
+def is_request_too_large_error(error: Exception) -> bool:
+    """
+    Whether the provider rejected a request because it had too many inputs or too many tokens in total, in which case it should be split up rather than retried as is
+    - an error about a single input being too long is not one of these, since every request that contains that input would fail the same way
+    """
+    status_code = get_status_code(error)
+    if status_code == 413:
+        return True
+    if status_code is not None and status_code != 400:
+        return False
+    message = str(error).lower()
+    if any(phrase in message for phrase in INPUT_TOO_LONG_PHRASES):
+        return False
+    return any(phrase in message for phrase in BATCH_TOO_LARGE_PHRASES)
+
+def get_retry_after(error: Exception):
+    """
+    Return the number of seconds the server asked us to wait (Retry-After header), if any.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def get_retry_delay(error: Exception, attempt: int, retry_params: dict):
+    """
+    Return how many seconds to wait before retrying a request that failed with error, or None if it shouldn't be retried.
+    """
+    if attempt >= retry_params['max_retries'] or not is_retryable_error(error):
+        return None
+    # full jitter: wait a random amount of time between 0 and the exponential backoff delay
+    delay = random.uniform(0, min(retry_params['max_delay'], retry_params['initial_delay'] * 2 ** attempt))
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, retry_params['max_delay']))
+    print (f"{type(error).__name__}: retrying in {delay:.1f} seconds")
+    return delay
+
+def call_with_retry(func, *args, retry_params: dict = None, **kwargs):
+    """
+    Call func, retrying with jittered exponential backoff when it fails with a retryable error.
+    """
+    retry_params = {**DEFAULT_RETRY_PARAMS, **(retry_params or {})}
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            delay = get_retry_delay(e, attempt, retry_params)
+            if delay is None:
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+async def acall_with_retry(func, *args, retry_params: dict = None, **kwargs):
+    """
+    Async version of call_with_retry, for coroutine functions.
+    """
+    retry_params = {**DEFAULT_RETRY_PARAMS, **(retry_params or {})}
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            delay = get_retry_delay(e, attempt, retry_params)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+# ids of the objects that are currently inside a rate limited call, in this thread or task
+active_rate_limited_calls = contextvars.ContextVar('active_rate_limited_calls', default=frozenset())
+
+def rate_limited(method, count_tokens=None):
+    """
+    Wrap a method (or async method) of an Embedding, Reranker, or LLM subclass so every call waits for the provider's rate limiters and is retried on rate limit and server errors.
+    - count_tokens(self, *args, **kwargs) estimates the number of tokens the call will use
+    - the provider is the name of the class and the model is its model attribute, if it has one
+    - retry parameters can be overridden per instance with a retry_params attribute
+    - calls made from inside another rate limited call on the same object (e.g. a subclass override that calls super(), or an async method that calls the sync one) go straight through, so each request is only counted and retried once
+    """
+    if getattr(method, 'is_rate_limited', False):
+        return method
+
+    def get_limiters_and_num_tokens(self, args, kwargs):
+        limiters = get_rate_limiters(type(self).__name__, getattr(self, 'model', None))
+        num_tokens = count_tokens(self, *args, **kwargs) if limiters and count_tokens is not None else 0
+        return limiters, num_tokens
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            active_calls = active_rate_limited_calls.get()
+            if id(self) in active_calls:
+                return await method(self, *args, **kwargs)
+            limiters, num_tokens = get_limiters_and_num_tokens(self, args, kwargs)
+
+            async def make_request():
+                for limiter in limiters:
+                    await limiter.aacquire(1, num_tokens)
+                return await method(self, *args, **kwargs)
+
+            token = active_rate_limited_calls.set(active_calls | {id(self)})
+            try:
+                return await acall_with_retry(make_request, retry_params=getattr(self, 'retry_params', None))
+            finally:
+                active_rate_limited_calls.reset(token)
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            active_calls = active_rate_limited_calls.get()
+            if id(self) in active_calls:
+                return method(self, *args, **kwargs)
+            limiters, num_tokens = get_limiters_and_num_tokens(self, args, kwargs)
+
+            def make_request():
+                # retried requests count against the budgets too, since the provider counts them
+                for limiter in limiters:
+                    limiter.acquire(1, num_tokens)
+                return method(self, *args, **kwargs)
+
+            token = active_rate_limited_calls.set(active_calls | {id(self)})
+            try:
+                return call_with_retry(make_request, retry_params=getattr(self, 'retry_params', None))
+            finally:
+                active_rate_limited_calls.reset(token)
+
+    wrapper.is_rate_limited = True
+    return wrapper
@@ -1,15 +1,31 @@
-from abc import ABC, abstractmethod
+from abc import ABC
+import asyncio
 import cohere
+import inspect
 import os
+import threading
+from scipy.special import expit
 from scipy.stats import beta
+from sprag.rate_limiter import rate_limited, estimate_num_tokens
 
 
+def count_rerank_tokens(reranker, query: str, search_results: list) -> int:
+    texts = [result['metadata']['chunk_header'] + result['metadata']['chunk_text'] for result in search_results]
+    return estimate_num_tokens(query) * len(search_results) + estimate_num_tokens(texts)
+
 class Reranker(ABC):
     subclasses = {}
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
+        # rerank_search_results and get_relevance_scores each have a default that calls the other, so a subclass has to implement at least one of them
+        if cls.rerank_search_results is Reranker.rerank_search_results and cls.get_relevance_scores is Reranker.get_relevance_scores:
+            raise TypeError(f"{cls.__name__} must implement rerank_search_results or get_relevance_scores")
         cls.subclasses[cls.__name__] = cls
+        # every subclass's API calls go through the shared rate limiter and retry layer
+        for method_name in ('rerank_search_results', 'arerank_search_results', 'get_relevance_scores', 'aget_relevance_scores'):
+            if method_name in cls.__dict__:
+                setattr(cls, method_name, rate_limited(cls.__dict__[method_name], count_rerank_tokens))
 
     def to_dict(self):
         return {
@@ -25,15 +41,61 @@ class Reranker(ABC):
         else:
             raise ValueError(f"Unknown subclass: {subclass_name}")
 
-    @abstractmethod
     def rerank_search_results(self, query: str, search_results: list) -> list:
-        pass
+        """
+        Rerank the search results for a query and set their similarity to the reranker's (transformed) relevance scores.
+        - subclasses implement either this, or get_relevance_scores (and optionally transform). Only the latter can be cached by the KnowledgeBase, since the raw scores are what gets cached.
+        """
+        return self.apply_relevance_scores(search_results, self.get_relevance_scores(query, search_results))
+
+    async def arerank_search_results(self, query: str, search_results: list) -> list:
+        """
+        Async version of rerank_search_results. Subclasses should override this (or aget_relevance_scores) with their provider's async client; by default the blocking call is run in a worker thread.
+        """
+        if self.supports_relevance_scores():
+            return self.apply_relevance_scores(search_results, await self.aget_relevance_scores(query, search_results))
+        return await asyncio.to_thread(self.rerank_search_results, query, search_results)
+
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        """
+        Returns the raw relevance score of each search result for the query, in the same order as search_results
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not implement get_relevance_scores")
+
+    async def aget_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        return await asyncio.to_thread(self.get_relevance_scores, query, search_results)
+
+    def get_documents(self, search_results: list) -> list[str]:
+        """
+        The text of each search result that gets scored against the query: the chunk header followed by the chunk text
+        """
+        return [f"[{result['metadata']['chunk_header']}]\n{result['metadata']['chunk_text']}" for result in search_results]
+
+    def supports_relevance_scores(self) -> bool:
+        return type(self).get_relevance_scores is not Reranker.get_relevance_scores
+
+    def transform(self, x):
+        """
+        Maps a raw relevance score to the similarity value used by RSE
+        """
+        return x
+
+    def apply_relevance_scores(self, search_results: list, relevance_scores: list[float]) -> list:
+        """
+        Sort the search results by relevance score (highest first) and set their similarity to the transformed relevance scores
+        """
+        order = sorted(range(len(search_results)), key=lambda i: relevance_scores[i], reverse=True)
+        reranked_search_results = [search_results[i] for i in order]
+        for i, result in zip(order, reranked_search_results):
+            result['similarity'] = self.transform(relevance_scores[i])
+        return reranked_search_results
 
 class CohereReranker(Reranker):
     def __init__(self, model: str = "rerank-english-v3.0"):
         self.model = model
         cohere_api_key = os.environ['CO_API_KEY']
         self.client = cohere.Client(f'{cohere_api_key}')
+        self.async_client = cohere.AsyncClient(f'{cohere_api_key}')
 
     def transform(self, x):
         """
@@ -44,19 +106,23 @@ class CohereReranker(Reranker):
         a, b = 0.4, 0.4  # These can be adjusted to change the distribution shape
         return beta.cdf(x, a, b)
 
-    def rerank_search_results(self, query: str, search_results: list) -> list:
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
         """
-        Use Cohere Rerank API to rerank the search results
+        Use Cohere Rerank API to get the relevance score of each search result
         """
-        documents = [f"[{result['metadata']['chunk_header']}]\n{result['metadata']['chunk_text']}" for result in search_results]
-        reranked_results = self.client.rerank(model=self.model, query=query, documents=documents)
-        results = reranked_results.results
-        reranked_indices = [result.index for result in results]
-        reranked_similarity_scores = [result.relevance_score for result in results]
-        reranked_search_results = [search_results[i] for i in reranked_indices]
-        for i, result in enumerate(reranked_search_results):
-            result['similarity'] = self.transform(reranked_similarity_scores[i])
-        return reranked_search_results
+        reranked_results = self.client.rerank(model=self.model, query=query, documents=self.get_documents(search_results))
+        return self.get_scores_in_original_order(reranked_results.results, len(search_results))
+
+    async def aget_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        reranked_results = await self.async_client.rerank(model=self.model, query=query, documents=self.get_documents(search_results))
+        return self.get_scores_in_original_order(reranked_results.results, len(search_results))
+
+    def get_scores_in_original_order(self, results: list, num_search_results: int) -> list[float]:
+        # Cohere returns the results sorted by relevance, with the index of each one in the original list
+        relevance_scores = [0.0] * num_search_results
+        for result in results:
+            relevance_scores[result.index] = result.relevance_score
+        return relevance_scores
     
     def to_dict(self):
         base_dict = super().to_dict()
@@ -65,6 +131,87 @@ class CohereReranker(Reranker):
         })
         return base_dict
     
+def identity(x):
+    return x
+
+class CrossEncoderReranker(Reranker):
+    """
+    Runs a cross-encoder model locally (on CPU by default), so reranking doesn't need a network call. Requires `pip install sprag[local]` (sentence-transformers).
+    """
+    def __init__(
+        self, model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", device: str = "cpu", batch_size: int = 32, num_threads: int = None,
+        max_candidates: int = 100, max_length: int = 512, calibration_center: float = 0.0, calibration_temperature: float = 3.0
+    ):
+        """
+        - batch_size: number of (query, chunk) pairs that go through the model at once
+        - num_threads: number of CPU threads used for inference (None uses the PyTorch default). This is a process-wide setting.
+        - max_candidates: only the first max_candidates search results (i.e. the top ones from the vector search) are scored, since the cost is linear in the number of pairs. The rest are ranked after them, with a similarity of 0. None scores all of them.
+        - max_length: max number of tokens in each (query, chunk) pair; longer pairs are truncated
+        - calibration_center, calibration_temperature: see transform. The defaults are a rough starting point, not fit to any dataset: the ms-marco cross-encoders' logits mostly fall between about -10 and 10, which a temperature of 3 spreads over most of the 0-1 range. Calibrate them on your own labeled queries if the absolute relevance values matter.
+        """
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.max_candidates = max_candidates
+        self.max_length = max_length
+        self.calibration_center = calibration_center
+        self.calibration_temperature = calibration_temperature
+        # the model uses all of its threads for each call, so concurrent calls (e.g. from the async API) take turns instead of competing for the CPU
+        self.lock = threading.Lock()
+        self.cross_encoder = self.load_model()
+
+    def load_model(self):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise ImportError("CrossEncoderReranker requires the sentence-transformers package. Install it with `pip install sentence-transformers`.")
+        import torch
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        return CrossEncoder(self.model, device=self.device, max_length=self.max_length)
+
+    def transform(self, x):
+        """
+        transformation function to map the raw relevance score (a logit) to a value between 0 and 1, like CohereReranker.transform does for the Cohere scores
+        - this is critical for RSE to work properly, because it utilizes the absolute relevance values to calculate the similarity scores
+        - the model's own sigmoid puts nearly every score very close to 0 or 1, so the logit is centered and divided by a temperature first (i.e. temperature scaling)
+        """
+        return float(expit((x - self.calibration_center) / self.calibration_temperature))
+
+    def predict(self, pairs: list[list[str]]) -> list[float]:
+        # get the raw logits rather than the probabilities; the name of this argument depends on the sentence-transformers version
+        predict_parameters = inspect.signature(self.cross_encoder.predict).parameters
+        activation_argument = "activation_fn" if "activation_fn" in predict_parameters else "activation_fct"
+        with self.lock:
+            scores = self.cross_encoder.predict(
+                pairs, batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False, **{activation_argument: identity}
+            )
+        return [float(score) for score in scores]
+
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        """
+        Score each (query, chunk) pair with the cross-encoder. Search results past max_candidates get a score of -inf, which the transform maps to 0.
+        """
+        num_candidates = len(search_results) if self.max_candidates is None else min(self.max_candidates, len(search_results))
+        documents = self.get_documents(search_results[:num_candidates])
+        relevance_scores = self.predict([[query, document] for document in documents]) if documents else []
+        return relevance_scores + [float("-inf")] * (len(search_results) - num_candidates)
+
+    def to_dict(self):
+        base_dict = super().to_dict()
+        base_dict.update({
+            'model': self.model,
+            'device': self.device,
+            'batch_size': self.batch_size,
+            'num_threads': self.num_threads,
+            'max_candidates': self.max_candidates,
+            'max_length': self.max_length,
+            'calibration_center': self.calibration_center,
+            'calibration_temperature': self.calibration_temperature,
+        })
+        return base_dict
+
 class NoReranker(Reranker):
     def __init__(self, ignore_absolute_relevance: bool = False):
         """
@@ -78,6 +225,9 @@ class NoReranker(Reranker):
                 result['similarity'] = 0.8 # default similarity score (represents a moderately relevant chunk)
         return search_results
 
+    async def arerank_search_results(self, query: str, search_results: list) -> list:
+        return self.rerank_search_results(query, search_results) # no network call, so there's no need for a worker thread
+
     def to_dict(self):
         base_dict = super().to_dict()
         base_dict.update({
@@ -15,6 +15,12 @@ def get_best_segments(all_relevance_values: list[list], document_splits: list[in
     total_length = 0
     rv_index = 0
     bad_rv_indices = []
+
+    # the value and static validity of every candidate segment only depend on the query, so compute them once per query
+    all_segment_candidates = [get_segment_candidates(relevance_values, document_splits, max_length) for relevance_values in all_relevance_values]
+    meta_document_length = max((len(relevance_values) for relevance_values in all_relevance_values), default=0)
+    occupied = np.zeros(meta_document_length + max(max_length, 0), dtype=bool) # chunks that are already part of one of the best segments (padded so windows never run off the end)
+
     while total_length < overall_max_length:
         # cycle through the queries
         if rv_index >= len(all_relevance_values):
@@ -28,30 +34,22 @@ def get_best_segments(all_relevance_values: list[list], document_splits: list[in
             continue
         
         # find the best remaining segment for this query
-        relevance_values = all_relevance_values[rv_index] # get the relevance values for this query
+        segment_values, valid_segments, window_indices = all_segment_candidates[rv_index]
+        # a segment can't overlap with any of the best segments, i.e. it can't contain any occupied chunks
+        overlaps_best_segments = np.logical_or.accumulate(occupied[window_indices], axis=1)
+        # a segment can't push us over the overall max length
+        segment_lengths = np.arange(1, segment_values.shape[1] + 1)
+        candidates = valid_segments & ~overlaps_best_segments & (segment_lengths <= overall_max_length - total_length)[None, :]
+        # segments are compared in order of (start, end) and only a strictly better value replaces the current best, so take the first maximum
+        candidate_values = np.where(candidates, segment_values, -np.inf)
         best_segment = None
         best_value = -1000
-        for start in range(len(relevance_values)):
-            # skip over negative value starting points
-            if relevance_values[start] < 0:
-                continue
-            for end in range(start+1, min(start+max_length+1, len(relevance_values)+1)):
-                # skip over negative value ending points
-                if relevance_values[end-1] < 0:
-                    continue
-                # check if this segment overlaps with any of the best segments
-                if any(start < seg_end and end > seg_start for seg_start, seg_end in best_segments):
-                    continue
-                # check if this segment overlaps with any of the document splits
-                if any(start < split and end > split for split in document_splits):
-                    continue
-                # check if this segment would push us over the overall max length
-                if total_length + end - start > overall_max_length:
-                    continue
-                segment_value = sum(relevance_values[start:end]) # define segment value as the sum of the relevance values of its chunks
-                if segment_value > best_value:
-                    best_value = segment_value
-                    best_segment = (start, end)
+        if candidate_values.size > 0:
+            best_index = np.argmax(candidate_values)
+            if candidate_values.flat[best_index] > best_value:
+                start, length_index = np.unravel_index(best_index, candidate_values.shape)
+                best_value = segment_values[start, length_index]
+                best_segment = (int(start), int(start + length_index + 1))
         
         # if we didn't find a valid segment, mark this query as done
         if best_segment is None or best_value < minimum_value:
@@ -62,29 +60,67 @@ def get_best_segments(all_relevance_values: list[list], document_splits: list[in
         # otherwise, add the segment to the list of best segments
         best_segments.append(best_segment)
         scores.append(best_value)
+        occupied[best_segment[0]:best_segment[1]] = True
         total_length += best_segment[1] - best_segment[0]
         rv_index += 1
     
     return best_segments, scores
 
+def get_segment_candidates(relevance_values: list[float], document_splits: list[int], max_length: int) -> tuple:
+    """
+    Compute the value of every candidate segment for a single query, using a (start, length) grid so all of the work is vectorized and O(n·max_length).
+
+    Returns
+    - segment_values: array of shape (n, max_length), where segment_values[start, k] is the value of the segment (start, start + k + 1), defined as the sum of the relevance values of its chunks
+    - valid_segments: boolean array of the same shape that marks the segments that stay inside the meta-document, don't cross a document split, and don't start or end on a negative value chunk
+    - window_indices: array of the same shape with the index of the last chunk of each segment (used for the overlap checks)
+    """
+    relevance_values = np.asarray(relevance_values, dtype=float)
+    n = len(relevance_values)
+    num_lengths = max(min(max_length, n), 0)
+    window_indices = np.arange(n)[:, None] + np.arange(num_lengths)[None, :]
+    in_bounds = window_indices < n
+    window_values = np.concatenate([relevance_values, np.zeros(num_lengths)])[window_indices]
+
+    # accumulating along each row adds the chunks in the same left-to-right order as summing the segment directly, so the values are bitwise identical
+    segment_values = np.add.accumulate(window_values, axis=1) if num_lengths > 0 else window_values
+
+    # segments can't start or end on a negative value chunk
+    valid_segments = in_bounds & ~(window_values < 0) & ~(relevance_values < 0)[:, None]
+    # segments can't cross a document split, so they have to end at or before the first split after their start
+    sorted_splits = np.sort(np.asarray(document_splits, dtype=np.int64))
+    next_split_positions = np.searchsorted(sorted_splits, np.arange(n), side='right')
+    next_splits = np.append(sorted_splits, np.iinfo(np.int64).max)[next_split_positions]
+    valid_segments &= (window_indices + 1) <= next_splits[:, None]
+    # NaN values are never better than the current best
+    valid_segments &= ~np.isnan(segment_values)
+
+    return segment_values, valid_segments, window_indices
+
 def get_meta_document(all_ranked_results: list[list], top_k_for_document_selection: int):
-    # get the top_k results for each query - and the document IDs for the top results across all queries
-    top_document_ids = []
+    # get the document IDs for the top results across all queries, mapped to their position in the meta-document (in order of first appearance)
+    document_indices = {}
     for ranked_results in all_ranked_results:
-        top_document_ids.extend([result["metadata"]["doc_id"] for result in ranked_results[:top_k_for_document_selection]]) # get document IDs for top results for each query
-    unique_document_ids = list(set(top_document_ids)) # get the unique document IDs for the top results across all queries
-
-    # get the max chunk index for each document and use this to get the document splits and document start points for the meta-document (i.e. the concatenation of all the documents)
-    document_splits = [] # indices that represent the (non-inclusive) end of each document in the meta-document
-    document_start_points = {} # index of the first chunk of each document in the meta-document, keyed on document_id
-    for document_id in unique_document_ids:
-        max_chunk_index = -1
-        for ranked_results in all_ranked_results:
-            for result in ranked_results:
-                if result["metadata"]["doc_id"] == document_id:
-                    max_chunk_index = max(max_chunk_index, result["metadata"]["chunk_index"])
-        document_start_points[document_id] = document_splits[-1] if document_splits else 0
-        document_splits.append(int(max_chunk_index + document_splits[-1] + 1 if document_splits else max_chunk_index + 1)) # basically the start point of the next document
+        for result in ranked_results[:top_k_for_document_selection]:
+            document_indices.setdefault(result["metadata"]["doc_id"], len(document_indices))
+    unique_document_ids = list(document_indices)
+
+    # get the max chunk index for each document in a single pass over the results
+    result_document_indices = []
+    result_chunk_indices = []
+    for ranked_results in all_ranked_results:
+        for result in ranked_results:
+            document_index = document_indices.get(result["metadata"]["doc_id"])
+            if document_index is not None:
+                result_document_indices.append(document_index)
+                result_chunk_indices.append(result["metadata"]["chunk_index"])
+    max_chunk_indices = np.full(len(unique_document_ids), -1, dtype=np.int64)
+    np.maximum.at(max_chunk_indices, np.array(result_document_indices, dtype=np.int64), np.array(result_chunk_indices, dtype=np.int64))
+
+    # use the max chunk indices to get the document splits and document start points for the meta-document (i.e. the concatenation of all the documents)
+    document_ends = np.cumsum(max_chunk_indices + 1)
+    document_splits = [int(split) for split in document_ends] # indices that represent the (non-inclusive) end of each document in the meta-document
+    document_start_points = {document_id: int(document_end - (max_chunk_index + 1)) for document_id, document_end, max_chunk_index in zip(unique_document_ids, document_ends, max_chunk_indices)} # index of the first chunk of each document in the meta-document, keyed on document_id
 
     return document_splits, document_start_points, unique_document_ids
 
@@ -106,35 +142,42 @@ def get_chunk_value(chunk_info: dict, irrelevant_chunk_penalty: float, decay_rat
     return v
 
 def get_relevance_values(all_ranked_results: list[list], meta_document_length: int, document_start_points: dict[str, int], unique_document_ids: list[str], irrelevant_chunk_penalty: float, decay_rate: int = 20):
-    # get the relevance values for each chunk in the meta-document, separately for each query
+    """
+    Get the relevance values for each chunk in the meta-document, separately for each query. See get_chunk_value for how the value of each chunk is defined.
+
+    Returns a list with one array of relevance values (of length meta_document_length) per query
+    """
+    unique_document_ids = set(unique_document_ids)
     all_relevance_values = []
     for ranked_results in all_ranked_results:
-        #print([result["similarity"] for result in ranked_results[:20]]) # print the similarity scores for the top results for each query
-        
-        # loop through the top results for each query and add their rank to the relevance ranks list
-        all_chunk_info = [{} for _ in range(meta_document_length)]
+        # collect the meta-document index, rank, absolute relevance value, and length of each result
+        meta_document_indices = []
+        ranks = []
+        absolute_relevance_values = []
+        result_chunk_lengths = []
         for rank, result in enumerate(ranked_results):
             document_id = result["metadata"]["doc_id"]
             if document_id not in unique_document_ids:
                 continue
-            
-            chunk_index = int(result["metadata"]["chunk_index"])
-            meta_document_index = int(document_start_points[document_id] + chunk_index) # find the correct index for this chunk in the meta-document
-            absolute_relevance_value = result["similarity"]
-            chunk_length = len(result["metadata"]["chunk_text"]) # get the length of the chunk in characters
-            all_chunk_info[meta_document_index] = {'rank': rank, 'absolute_relevance_value': absolute_relevance_value, 'chunk_length': chunk_length}
-
-        # convert the relevance ranks and other info to chunk values
-        relevance_values = [get_chunk_value(chunk_info, irrelevant_chunk_penalty, decay_rate) for chunk_info in all_chunk_info]
-
-        # adjust the relevance values for the length of the chunks
-        chunk_lengths = [chunk_info.get('chunk_length', 0.0) for chunk_info in all_chunk_info]
+            meta_document_indices.append(document_start_points[document_id] + int(result["metadata"]["chunk_index"])) # find the correct index for this chunk in the meta-document
+            ranks.append(rank)
+            absolute_relevance_values.append(result["similarity"])
+            result_chunk_lengths.append(len(result["metadata"]["chunk_text"])) # get the length of the chunk in characters
+
+        # scatter them into the meta-document - chunks that weren't in the results keep the default rank of 1000, absolute relevance value of 0, and length of 0
+        meta_document_indices = np.array(meta_document_indices, dtype=np.int64)
+        chunk_ranks = np.full(meta_document_length, 1000.0)
+        chunk_ranks[meta_document_indices] = ranks
+        chunk_absolute_relevance_values = np.zeros(meta_document_length)
+        chunk_absolute_relevance_values[meta_document_indices] = absolute_relevance_values
+        chunk_lengths = np.zeros(meta_document_length)
+        chunk_lengths[meta_document_indices] = result_chunk_lengths
+
+        # convert the relevance ranks and other info to chunk values, and adjust them for the length of the chunks
+        relevance_values = np.exp(-chunk_ranks / decay_rate) * chunk_absolute_relevance_values - irrelevant_chunk_penalty
         relevance_values = adjust_relevance_values_for_chunk_length(relevance_values, chunk_lengths)
 
         all_relevance_values.append(relevance_values)
-
-        #print ("Adjusted relevance values")
-        #print ([round(value, 4) for value in relevance_values])
     
     return all_relevance_values
 
@@ -144,7 +187,4 @@ def adjust_relevance_values_for_chunk_length(relevance_values: list[float], chun
     - reference_length is the length of a standard chunk, measured in number of characters
     """
     assert len(relevance_values) == len(chunk_lengths), "The length of relevance_values and chunk_lengths must be the same"
-    adjusted_relevance_values = []
-    for relevance_value, chunk_length in zip(relevance_values, chunk_lengths):
-        adjusted_relevance_values.append(relevance_value * (chunk_length / reference_length))
-    return adjusted_relevance_values
\ No newline at end of file
+    return np.asarray(relevance_values, dtype=float) * (np.asarray(chunk_lengths, dtype=float) / reference_length)
\ No newline at end of file
@@ -1,7 +1,47 @@
 from abc import ABC, abstractmethod
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
 import pickle
 import os
+import glob
+from sprag.append_log import append_record, read_records, truncate_log, get_file_size, should_compact
+
+
+# default parameters for the approximate nearest neighbour indexes
+# - hnsw_m: number of neighbours per node in the HNSW graph (more is more accurate but uses more memory)
+# - hnsw_ef_construction: size of the candidate list used while building the HNSW graph (higher is more accurate but slower to build)
+# - hnsw_ef_search: size of the candidate list used at search time (higher gives better recall but slower searches)
+# - ivf_nlist: number of clusters for the IVF index
+# - ivf_nprobe: number of clusters that get searched at search time (higher gives better recall but slower searches)
+# - pq_m: number of sub-vectors for product quantization (each one is stored in pq_nbits bits, so a vector takes pq_m * pq_nbits / 8 bytes); must divide the dimension
+# - pq_nbits: number of bits per sub-vector for product quantization
+# - min_training_vectors_per_centroid: indexes that need training (IVF, PQ, and int8) are trained (and used) once there are at least this many vectors per centroid (int8 counts as 256 centroids, one per quantization level); exhaustive search is used until then
+# - max_training_vectors: the index is retrained on a fresh sample each time the number of vectors doubles, until it has been trained on at least this many, so its training reflects the whole KB and not just the first documents
+# - rescore_factor: with quantization, this many times top_k candidates are retrieved from the index and then re-scored exactly using the full-precision vectors (set to 0 to return the approximate scores directly)
+DEFAULT_INDEX_PARAMS = {
+    'hnsw_m': 32,
+    'hnsw_ef_construction': 64,
+    'hnsw_ef_search': 64,
+    'ivf_nlist': 1024,
+    'ivf_nprobe': 16,
+    'pq_m': 16,
+    'pq_nbits': 8,
+    'min_training_vectors_per_centroid': 39,
+    'max_training_vectors': 262_144,
+    'rescore_factor': 4,
+}
+
+
+# number of rows that are read into memory at a time when all of the rows are copied into a new vectors file or an index
+ROW_BLOCK_SIZE = 65_536
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale each row to unit length (rows that are all zeros are left as is).
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
 
 
 class VectorDB(ABC):
@@ -57,82 +97,484 @@ class VectorDB(ABC):
         """
         pass
 
+    def search_batch(self, query_vectors, top_k=10):
+        """
+        Retrieve the top-k closest vectors for each of a list of query vectors.
+        - returns a list with one list of results per query vector, in the same order as the query vectors, with each result in the same format as search()
+        - subclasses should override this if the underlying database can search for multiple query vectors at once
+        """
+        return [self.search(query_vector, top_k) for query_vector in query_vectors]
+
+    def save(self):
+        """
+        Write anything that isn't written to disk as changes are made (e.g. an index). Called at the end of bulk ingestion; databases that write every change as it's made don't need to override this.
+        """
+        pass
+
 
 class BasicVectorDB(VectorDB):
-    def __init__(self, kb_id: str, storage_directory: str = '~/spRAG', use_faiss: bool = True):
+    """
+    A basic implementation of a VectorDB that keeps all of the vectors in a single contiguous float32 matrix.
+    - on disk the matrix is a raw float32 file that is memory-mapped (read-only), so loading is near-instant and processes that open the same KB share the OS page cache; added vectors are appended to the end of the file and the matrix is mapped again, so it never has to be copied into memory
+    - vectors are normalized when they're added, so the similarity scores (cosine similarity) come straight out of the inner product search
+    - the metadata of each add and each remove is appended to a log as a delta record (the log record is what commits the rows appended to the vectors file); compact() merges the log into a new snapshot of the metadata, which also happens automatically once the log outgrows the snapshot
+    - removing a document doesn't move any rows: the document's rows stay in the matrix and are skipped by searches until the next compact(), which writes a new vectors file without them (and rebuilds the index once for all of the documents removed since the last compaction). With an index, IVF and flat indexes remove the document's vectors by ID, and HNSW indexes (which can't remove vectors) filter them out at search time.
+    - by default searches are exhaustive, but index_type can be set to 'hnsw' or 'ivf' to use an approximate nearest neighbour faiss index instead (sub-linear search time for very large KBs); the index is updated incrementally as vectors are added, and is saved each time it doubles in size and on each compaction, so loading only has to add the rows since the last save to it
+    - quantization can be set to 'int8' (scalar quantization, 4x smaller than float32) or 'pq' (product quantization, typically 30x+ smaller) to search over compressed vectors instead; the full-precision vectors are only read back from the memory-mapped file to re-score the top candidates, so only the compressed index has to stay in memory
+    """
+    def __init__(self, kb_id: str, storage_directory: str = '~/spRAG', use_faiss: bool = True, index_type: str = 'flat', index_params: dict = None, quantization: str = None):
+        """
+        - use_faiss: use faiss (rather than numpy) for exhaustive searches
+        - index_type: 'flat' (exhaustive search), 'hnsw', or 'ivf'
+        - index_params: overrides for DEFAULT_INDEX_PARAMS, which control the recall/speed tradeoff of the approximate indexes
+        - quantization: None (full precision), 'int8', or 'pq'
+        """
+        if index_type not in ('flat', 'hnsw', 'ivf'):
+            raise ValueError(f"Unknown index_type: {index_type}. Must be one of 'flat', 'hnsw', or 'ivf'.")
+        if quantization not in (None, 'int8', 'pq'):
+            raise ValueError(f"Unknown quantization: {quantization}. Must be one of None, 'int8', or 'pq'.")
         self.kb_id = kb_id
         self.storage_directory = storage_directory
         self.use_faiss = use_faiss
-        self.vector_storage_path = os.path.join(self.storage_directory, 'vector_storage', f'{kb_id}.pkl')
+        self.index_type = index_type
+        self.quantization = quantization
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+        # the metadata file is the commit point for each snapshot: it records the snapshot generation (which names the log that goes with it) and the generation of the vectors file
+        self.vector_storage_directory = os.path.join(self.storage_directory, 'vector_storage', kb_id)
+        self.metadata_path = os.path.join(self.vector_storage_directory, 'metadata.pkl')
+        self.legacy_vector_storage_path = os.path.join(self.storage_directory, 'vector_storage', f'{kb_id}.pkl')
         self.load()
 
+    def get_vectors_path(self, generation: int) -> str:
+        return os.path.join(self.vector_storage_directory, f'vectors_{generation}.f32')
+
+    def get_log_path(self, generation: int) -> str:
+        return os.path.join(self.vector_storage_directory, f'log_{generation}.pkl')
+
+    def get_index_path(self, generation: int, index_size: int = None) -> str:
+        # indexes saved between compactions are named after the number of rows they have
+        if index_size is None:
+            return os.path.join(self.vector_storage_directory, f'index_{generation}.faiss')
+        return os.path.join(self.vector_storage_directory, f'index_{generation}_{index_size}.faiss')
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self.num_vectors]
+
+    def map_vectors(self):
+        """
+        Memory-map the rows of the vectors file (read-only).
+        """
+        if self.num_vectors == 0:
+            self._vectors = np.empty((0, self.dimension or 0), dtype=np.float32)
+        else:
+            self._vectors = np.memmap(self.get_vectors_path(self.vectors_generation), dtype=np.float32, mode='r', shape=(self.num_vectors, self.dimension))
+
     def add_vectors(self, vectors, metadata):
         try:
             assert len(vectors) == len(metadata)
         except AssertionError:
             raise ValueError('Error in add_vectors: the number of vectors and metadata items must be the same.')
-        self.vectors.extend(vectors)
+        if len(vectors) == 0:
+            return
+        vectors = normalize_vectors(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+        if self.dimension is not None and self.num_vectors > 0 and vectors.shape[1] != self.dimension:
+            raise ValueError(f'Error in add_vectors: expected vectors of dimension {self.dimension}, got {vectors.shape[1]}.')
+        os.makedirs(self.vector_storage_directory, exist_ok=True)  # Ensure the directory exists
+        with open(self.get_vectors_path(self.vectors_generation), 'ab') as f:
+            f.write(vectors.tobytes())
+        self.dimension = vectors.shape[1]
         self.metadata.extend(metadata)
-        self.save()
+        self.num_vectors += len(vectors)
+        self.map_vectors()
+        self.update_index()
+        self.append_to_log(('add', self.dimension, metadata))
+        if self.should_save_index():
+            self.save_index()
+
+    def uses_index(self) -> bool:
+        return self.index_type != 'flat' or self.quantization is not None
+
+    def create_index(self, dimension: int):
+        import faiss
+        if self.quantization == 'int8':
+            encoding = 'SQ8'
+        elif self.quantization == 'pq':
+            if dimension % self.index_params['pq_m'] != 0:
+                raise ValueError(f"pq_m ({self.index_params['pq_m']}) must divide the vector dimension ({dimension}).")
+            encoding = f"PQ{self.index_params['pq_m']}x{self.index_params['pq_nbits']}"
+        else:
+            encoding = 'Flat'
+
+        if self.index_type == 'hnsw':
+            index = faiss.index_factory(dimension, f"HNSW{self.index_params['hnsw_m']},{encoding}", faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.index_params['hnsw_ef_construction']
+        elif self.index_type == 'ivf':
+            index = faiss.index_factory(dimension, f"IVF{self.index_params['ivf_nlist']},{encoding}", faiss.METRIC_INNER_PRODUCT)
+        else:
+            # flat indexes can only remove vectors by ID through an ID map
+            index = faiss.index_factory(dimension, f"IDMap2,{encoding}", faiss.METRIC_INNER_PRODUCT)
+        return index
+
+    def can_remove_from_index(self) -> bool:
+        return self.index_type != 'hnsw'
+
+    def get_min_training_vectors(self) -> int:
+        num_centroids = 0
+        if self.index_type == 'ivf':
+            num_centroids = self.index_params['ivf_nlist']
+        if self.quantization == 'pq':
+            num_centroids = max(num_centroids, 2 ** self.index_params['pq_nbits'])
+        elif self.quantization == 'int8':
+            # the value range of each dimension is learned from the training vectors, and values outside of it get clipped, so it needs a sample of the whole KB and not just the first document
+            num_centroids = max(num_centroids, 256)
+        return num_centroids * self.index_params['min_training_vectors_per_centroid']
+
+    def get_num_live_vectors(self) -> int:
+        return self.num_vectors - len(self.removed_rows)
+
+    def get_live_rows(self, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        The rows from start to end that don't belong to removed documents
+        """
+        rows = np.arange(start, self.num_vectors if end is None else end)
+        if self.removed_rows:
+            rows = rows[~np.isin(rows, list(self.removed_rows))]
+        return rows
+
+    def should_retrain_index(self) -> bool:
+        if self.index_type != 'ivf' and self.quantization is None:
+            return False # HNSW without quantization doesn't need training
+        return self.index_training_size < self.index_params['max_training_vectors'] and self.get_num_live_vectors() >= 2 * self.index_training_size
+
+    def train_index(self):
+        live_rows = self.get_live_rows()
+        max_training_vectors = self.index_params['max_training_vectors']
+        if len(live_rows) > max_training_vectors:
+            live_rows = np.sort(np.random.default_rng(0).choice(live_rows, max_training_vectors, replace=False))
+        self.index.train(np.ascontiguousarray(self.vectors[live_rows]))
+        self.index_training_size = self.get_num_live_vectors()
+
+    def update_index(self):
+        """
+        Bring the index up to date with the matrix. The index IDs are the row numbers in the matrix, so only the rows that aren't in the index yet (from index_size on) need to be added.
+        """
+        if not self.uses_index() or self.num_vectors == 0:
+            return
+        if self.index is None:
+            self.index = self.create_index(self.dimension)
+            self.index_size = 0
+        if not self.index.is_trained:
+            if self.get_num_live_vectors() < self.get_min_training_vectors():
+                return # not enough vectors to train the index yet, so searches stay exhaustive
+            self.train_index()
+        elif self.should_retrain_index():
+            # retrain a new index on the larger sample and re-add all of the rows to it; the KB doubles in size between retrainings, so this is amortized O(1) per vector
+            self.index = self.create_index(self.dimension)
+            self.index_size = 0
+            self.live_rows_selector = None
+            self.train_index()
+        if self.index_size < self.num_vectors:
+            self.add_rows_to_index(self.index_size)
+
+    def add_rows_to_index(self, start: int):
+        # a block of rows at a time, so only one block has to be read into memory from the memory-mapped file
+        for block_start in range(start, self.num_vectors, ROW_BLOCK_SIZE):
+            block_end = min(block_start + ROW_BLOCK_SIZE, self.num_vectors)
+            if self.can_remove_from_index():
+                rows = self.get_live_rows(block_start, block_end)
+                self.index.add_with_ids(np.ascontiguousarray(self.vectors[rows]), rows.astype(np.int64))
+            else:
+                # HNSW assigns sequential IDs, which are the row numbers since nothing is ever removed from it
+                self.index.add(np.ascontiguousarray(self.vectors[block_start:block_end]))
+        self.index_size = self.num_vectors
+
+    def rebuild_index(self):
+        """
+        Re-add all of the rows to the index (e.g. after the rows have moved). The index keeps its training.
+        """
+        self.index.reset()
+        self.index_size = 0
+        self.live_rows_selector = None
+        self.update_index()
+
+    def is_index_ready(self) -> bool:
+        return self.index is not None and self.index.is_trained and self.index_size == self.num_vectors
+
+    def should_save_index(self) -> bool:
+        # each time the index doubles in size (amortized O(1) per vector), so a load never has to add more than half of its rows
+        return self.is_index_ready() and self.index_size >= 2 * self.saved_index_size
+
+    def save_index(self):
+        """
+        Save the index between compactions. The log record commits it and says how many rows of the matrix it has, so a load only has to add the rows after those.
+        """
+        import faiss
+        index_path = self.get_index_path(self.generation, self.index_size)
+        faiss.write_index(self.index, index_path)
+        self.saved_index_size = self.index_size
+        self.append_to_log(('index', self.index_size, self.index_training_size))
+        # the index that this one replaces isn't needed anymore
+        for path in glob.glob(os.path.join(self.vector_storage_directory, f'index_{self.generation}_*.faiss')):
+            if path != index_path:
+                os.remove(path)
+
+    def get_live_rows_selector(self):
+        """
+        faiss ID selector that excludes the removed rows, for searching an HNSW index that still contains them
+        """
+        import faiss
+        if self.live_rows_selector is None:
+            live_rows = np.ones(self.num_vectors, dtype=bool)
+            live_rows[list(self.removed_rows)] = False
+            # the selector only holds a pointer to the bitmap, so it's kept alongside it
+            bitmap = np.packbits(live_rows, bitorder='little')
+            self.live_rows_selector = (faiss.IDSelectorBitmap(self.num_vectors, faiss.swig_ptr(bitmap)), bitmap)
+        return self.live_rows_selector[0]
 
     def search(self, query_vector, top_k=10):
-        if not self.vectors:
+        return self.search_batch([query_vector], top_k)[0]
+
+    def search_batch(self, query_vectors, top_k=10):
+        if len(query_vectors) == 0:
             return []
-        
-        if self.use_faiss:
-            return self.search_faiss(query_vector, top_k)
-
-        similarities = cosine_similarity([query_vector], self.vectors)[0]
-        indexed_similarities = sorted(enumerate(similarities), key=lambda x: x[1], reverse=True)
-        results = []
-        for i, similarity in indexed_similarities[:top_k]:
-            result = {
-                'metadata': self.metadata[i],
-                'similarity': similarity,
-            }
-            results.append(result)
-        return results
+        if self.num_vectors == 0:
+            return [[] for _ in query_vectors]
+
+        # the stored vectors are normalized, so the inner product with a normalized query vector is the cosine similarity
+        query_vectors_array = normalize_vectors(np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1))
+        if self.is_index_ready():
+            similarities, indices = self.search_batch_index(query_vectors_array, top_k)
+        else:
+            # the rows of removed documents are still in the matrix until the next compaction, so exhaustive searches get enough extra results to make up for them
+            num_results = min(top_k + len(self.removed_rows), self.num_vectors)
+            if self.use_faiss:
+                similarities, indices = self.search_batch_faiss(query_vectors_array, num_results)
+            else:
+                similarities, indices = self.search_batch_numpy(query_vectors_array, num_results)
+
+        all_results = []
+        for query_similarities, query_indices in zip(similarities, indices):
+            results = []
+            for similarity, i in zip(query_similarities, query_indices):
+                if i < 0 or self.metadata[i] is None: # faiss pads with -1 when there are fewer than top_k vectors
+                    continue
+                result = {
+                    'metadata': self.metadata[i],
+                    'similarity': float(similarity),
+                }
+                results.append(result)
+                if len(results) == top_k:
+                    break
+            all_results.append(results)
+        return all_results
+
+    def search_batch_numpy(self, query_vectors_array: np.ndarray, top_k=10):
+        """
+        Exhaustive search with a single matrix-matrix product for all of the queries. Returns the similarities and indices of the top_k results for each query, sorted by similarity.
+        """
+        similarities = query_vectors_array @ self.vectors.T
+        top_k = min(top_k, self.num_vectors)
+        top_indices = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+        top_similarities = np.take_along_axis(similarities, top_indices, axis=1)
+        order = np.argsort(-top_similarities, axis=1, kind='stable')
+        return np.take_along_axis(top_similarities, order, axis=1), np.take_along_axis(top_indices, order, axis=1)
     
-    def search_faiss(self, query_vector, top_k=10):
+    def search_batch_faiss(self, query_vectors_array: np.ndarray, top_k=10):
+        """
+        Exhaustive search with faiss. Returns the similarities and indices of the top_k results for each query, sorted by similarity.
+        """
+        import faiss
         from faiss.contrib.exhaustive_search import knn
-        import numpy as np
-
-        # faiss expects 2D arrays of vectors
-        vectors_array = np.array(self.vectors).astype('float32').reshape(len(self.vectors), -1)
-        query_vector_array = np.array(query_vector).astype('float32').reshape(1, -1)
-        
-        _, I = knn(query_vector_array, vectors_array, top_k) # I is a list of indices in the corpus_vectors array
-        results = []
-        for i in I[0][:top_k]:
-            result = {
-                'metadata': self.metadata[i],
-                'similarity': cosine_similarity([query_vector], [self.vectors[i]])[0][0],
-            }
-            results.append(result)
-        return results
+
+        return knn(query_vectors_array, self.vectors, top_k, metric=faiss.METRIC_INNER_PRODUCT)
+
+    def search_batch_index(self, query_vectors_array: np.ndarray, top_k=10):
+        """
+        Search with the index (approximate nearest neighbour and/or quantized). Returns the similarities and indices of the top_k results for each query, sorted by similarity.
+        """
+        import faiss
+        rescore_factor = self.index_params['rescore_factor'] if self.quantization is not None else 0
+        num_candidates = top_k * rescore_factor if rescore_factor > 1 else top_k
+
+        search_params = None
+        if self.index_type == 'hnsw':
+            search_params = faiss.SearchParametersHNSW()
+            search_params.efSearch = max(self.index_params['hnsw_ef_search'], num_candidates)
+            if self.removed_rows:
+                search_params.sel = self.get_live_rows_selector()
+        elif self.index_type == 'ivf':
+            search_params = faiss.SearchParametersIVF()
+            search_params.nprobe = self.index_params['ivf_nprobe']
+        similarities, indices = self.index.search(query_vectors_array, num_candidates, params=search_params)
+        if self.index.metric_type == faiss.METRIC_L2:
+            # some index types (e.g. HNSW with PQ) only support L2 distance, which ranks normalized vectors in the same order as the inner product
+            similarities = 1 - similarities / 2
+
+        if rescore_factor > 0:
+            return self.rescore(query_vectors_array, indices, top_k)
+        return similarities, indices
+
+    def rescore(self, query_vectors_array: np.ndarray, candidate_indices: np.ndarray, top_k=10):
+        """
+        Compute the exact similarities for the candidates returned by the index (only the candidate rows of the matrix get read) and keep the top_k for each query.
+        """
+        valid_candidates = candidate_indices >= 0 # faiss pads with -1 when there are fewer candidates than requested
+        candidate_vectors = self.vectors[np.where(valid_candidates, candidate_indices, 0)]
+        similarities = np.einsum('qkd,qd->qk', candidate_vectors, query_vectors_array)
+        similarities[~valid_candidates] = -np.inf
+        order = np.argsort(-similarities, axis=1, kind='stable')[:, :top_k]
+        top_indices = np.take_along_axis(np.where(valid_candidates, candidate_indices, -1), order, axis=1)
+        return np.take_along_axis(similarities, order, axis=1), top_indices
 
     def remove_document(self, doc_id):
-        i = 0
-        while i < len(self.metadata):
-            if self.metadata[i]['doc_id'] == doc_id:
-                del self.vectors[i]
-                del self.metadata[i]
-            else:
-                i += 1
-        self.save()
+        if self._remove_document(doc_id):
+            self.append_to_log(('remove', doc_id))
+
+    def _remove_document(self, doc_id) -> bool:
+        rows = [i for i, meta in enumerate(self.metadata) if meta is not None and meta['doc_id'] == doc_id]
+        if not rows:
+            return False
+        # the rows stay in the matrix (so the other rows keep their IDs in the index) until the next compaction
+        self.removed_rows.update(rows)
+        for i in rows:
+            self.metadata[i] = None
+        if self.index is not None and self.index.is_trained and self.can_remove_from_index():
+            self.index.remove_ids(np.array(rows, dtype=np.int64))
+        self.live_rows_selector = None
+        return True
+
+    def append_to_log(self, record: tuple):
+        os.makedirs(self.vector_storage_directory, exist_ok=True)  # Ensure the directory exists
+        self.log_size = append_record(self.get_log_path(self.generation), record)
+        if self.should_compact():
+            self.compact()
+
+    def should_compact(self) -> bool:
+        # the log only holds metadata, so it's compared to the metadata snapshot, and the rows of removed documents are compared to the rest of the rows
+        row_size = 4 * (self.dimension or 0)
+        return should_compact(self.log_size, self.snapshot_size) or should_compact(len(self.removed_rows) * row_size, self.get_num_live_vectors() * row_size)
+
+    def compact(self):
+        """
+        Merge the log into a new snapshot of the metadata. If documents have been removed since the last compaction, a new vectors file is written without their rows.
+        """
+        os.makedirs(self.vector_storage_directory, exist_ok=True)  # Ensure the directory exists
+        new_generation = self.generation + 1
+        if self.removed_rows or self.vectors_generation is None:
+            # drop the removed rows, which moves the other rows, so the index is rebuilt (once for all of the documents removed since the last compaction)
+            live_rows = self.get_live_rows()
+            with open(self.get_vectors_path(new_generation), 'wb') as f:
+                for block_start in range(0, len(live_rows), ROW_BLOCK_SIZE):
+                    f.write(np.ascontiguousarray(self.vectors[live_rows[block_start:block_start + ROW_BLOCK_SIZE]]).tobytes())
+            rows_moved = bool(self.removed_rows)
+            self.metadata = [self.metadata[i] for i in live_rows]
+            self.num_vectors = len(live_rows)
+            self.removed_rows = set()
+            self.vectors_generation = new_generation
+            self.map_vectors()
+            if rows_moved and self.index is not None:
+                self.rebuild_index()
+        if self.index is not None:
+            import faiss
+            faiss.write_index(self.index, self.get_index_path(new_generation))
+            self.saved_index_size = self.index_size
+        # swapping in the new metadata file commits the snapshot - a crash before this point leaves the previous snapshot and its log intact
+        with open(self.metadata_path + '.tmp', 'wb') as f:
+            pickle.dump({'generation': new_generation, 'vectors_generation': self.vectors_generation, 'dimension': self.dimension, 'metadata': self.metadata, 'index_training_size': self.index_training_size}, f)
+        os.replace(self.metadata_path + '.tmp', self.metadata_path)
+        self.generation = new_generation
+        self.log_size = 0
+        self.snapshot_size = get_file_size(self.metadata_path)
+
+        # clean up the files from previous generations (processes that still have the old vectors memory-mapped keep access to them)
+        old_paths = glob.glob(os.path.join(self.vector_storage_directory, 'vectors_*.f32')) + glob.glob(os.path.join(self.vector_storage_directory, 'log_*.pkl')) + glob.glob(os.path.join(self.vector_storage_directory, 'index_*.faiss'))
+        for path in old_paths:
+            if path not in (self.get_vectors_path(self.vectors_generation), self.get_index_path(new_generation)):
+                os.remove(path)
+        # the legacy pickle has been migrated to the new format
+        if os.path.exists(self.legacy_vector_storage_path):
+            os.remove(self.legacy_vector_storage_path)
 
     def save(self):
-        os.makedirs(os.path.dirname(self.vector_storage_path), exist_ok=True)  # Ensure the directory exists
-        with open(self.vector_storage_path, 'wb') as f:
-            pickle.dump((self.vectors, self.metadata), f)
+        self.compact()
 
     def load(self):
-        if os.path.exists(self.vector_storage_path):
-            with open(self.vector_storage_path, 'rb') as f:
-                self.vectors, self.metadata = pickle.load(f)
-        else:
-            self.vectors = []
-            self.metadata = []
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self.num_vectors = 0
+        self.dimension = None
+        self.metadata = []
+        self.generation = 0
+        self.vectors_generation = 0 # generation of the vectors file, which only changes when a compaction drops rows
+        self.snapshot_size = 0
+        self.index = None
+        self.index_size = 0 # number of rows of the matrix that have been added to the index
+        self.index_training_size = 0 # number of vectors there were when the index was last trained
+        self.saved_index_size = 0 # number of rows in the index when it was last saved
+        self.removed_rows = set() # rows of removed documents that are still in the matrix (and in an HNSW index), until the next compaction
+        self.live_rows_selector = None
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            self.generation = snapshot['generation']
+            self.vectors_generation = snapshot['vectors_generation']
+            self.dimension = snapshot['dimension']
+            self.metadata = snapshot['metadata']
+            self.index_training_size = snapshot['index_training_size']
+            self.snapshot_size = get_file_size(self.metadata_path)
+        elif os.path.exists(self.legacy_vector_storage_path):
+            # older versions pickled (vectors, metadata) into a single file, with the vectors as a list of lists; they're kept in memory until compact() below writes them in the new format
+            with open(self.legacy_vector_storage_path, 'rb') as f:
+                vectors, self.metadata = pickle.load(f)
+            if len(vectors) > 0:
+                self._vectors = normalize_vectors(np.array(vectors, dtype=np.float32).reshape(len(vectors), -1))
+                self.dimension = self._vectors.shape[1]
+            self.vectors_generation = None
+        self.num_vectors = len(self.metadata)
+        num_snapshot_vectors = self.num_vectors
+
+        # replay the changes that were made since the snapshot was taken
+        log_path = self.get_log_path(self.generation)
+        records, self.log_size = read_records(log_path)
+        index_record = None
+        for record in records:
+            if record[0] == 'add':
+                self.dimension = record[1]
+                self.metadata.extend(record[2])
+                self.num_vectors += len(record[2])
+            elif record[0] == 'remove':
+                self._remove_document(record[1])
+            elif record[0] == 'index':
+                index_record = record
+        truncate_log(log_path, self.log_size)
+        if self.vectors_generation is not None:
+            # rows appended to the vectors file without a log record to commit them (e.g. because of a crash in between) are cut off, so the next rows are appended in the right place
+            vectors_path = self.get_vectors_path(self.vectors_generation)
+            if get_file_size(vectors_path) > 4 * self.num_vectors * (self.dimension or 0):
+                os.truncate(vectors_path, 4 * self.num_vectors * self.dimension)
+            self.map_vectors()
+
+        # load the last saved index (or build it if there isn't one, e.g. because the index_type was changed); the rows that were added and removed since it was saved are brought up to date below
+        if self.uses_index():
+            index_path, index_size = self.get_index_path(self.generation), num_snapshot_vectors
+            if index_record is not None:
+                index_path, index_size, self.index_training_size = self.get_index_path(self.generation, index_record[1]), index_record[1], index_record[2]
+            if os.path.exists(index_path):
+                import faiss
+                self.index = faiss.read_index(index_path)
+                if self.index_type == 'flat' and not isinstance(self.index, faiss.IndexIDMap2):
+                    self.index = None # saved by an older version, without an ID map
+                elif self.index.is_trained:
+                    self.index_size = self.saved_index_size = index_size
+                    # a snapshot has no removed rows, so its index has all of its rows (as does an HNSW index, which never has rows removed from it); an index saved between compactions has already had some of the removed rows removed, which removing again doesn't affect
+                    if (index_record is None or not self.can_remove_from_index()) and self.index.ntotal != index_size:
+                        self.rebuild_index()
+                    elif self.removed_rows and self.can_remove_from_index():
+                        self.index.remove_ids(np.array(sorted(self.removed_rows), dtype=np.int64))
+            self.update_index()
+
+        if self.vectors_generation is None:
+            self.compact()
 
     def to_dict(self):
         return {
@@ -140,4 +582,7 @@ class BasicVectorDB(VectorDB):
             'kb_id': self.kb_id,
             'storage_directory': self.storage_directory,
             'use_faiss': False,
-        }
\ No newline at end of file
+            'index_type': self.index_type,
+            'index_params': self.index_params,
+            'quantization': self.quantization,
+        }
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag.embedding import Embedding
+from sprag.reranker import Reranker
+from sprag.llm import LLM
+
+
+# offline stand-ins for the models, shared by the unit tests (each class can only be registered once in the subclass registries that from_dict uses)
+
+class FakeEmbedding(Embedding):
+    """
+    Deterministic random embeddings seeded by a hash of each text, so the same text always gets the same embedding
+    """
+    max_batch_size = 32
+
+    def __init__(self, model: str = "fake-model", dimension: int = 16, normalize_embeddings: bool = True):
+        super().__init__(dimension)
+        self.model = model
+        self.normalize_embeddings = normalize_embeddings
+        self.num_texts_embedded = 0
+        self.num_calls = 0
+
+    def get_embeddings(self, text, input_type=None):
+        texts = [text] if isinstance(text, str) else text
+        assert len(texts) <= self.max_batch_size
+        self.num_texts_embedded += len(texts)
+        self.num_calls += 1
+        embeddings = []
+        for t in texts:
+            rng = np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16))
+            embeddings.append(rng.normal(size=self.dimension).tolist())
+        return embeddings[0] if isinstance(text, str) else embeddings
+
+    def to_dict(self):
+        base_dict = super().to_dict()
+        base_dict.update({
+            'model': self.model,
+            'normalize_embeddings': self.normalize_embeddings,
+        })
+        return base_dict
+
+class FakeReranker(Reranker):
+    """
+    Scores a chunk as relevant if it contains the first word of the query
+    """
+    def __init__(self, model: str = "fake-model", max_length: int = 512, calibration_center: float = 0.0):
+        self.model = model
+        self.max_length = max_length
+        self.calibration_center = calibration_center
+        self.num_calls = 0
+
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        self.num_calls += 1
+        return [1.0 if query.split()[0] in result['metadata']['chunk_text'] else 0.1 for result in search_results]
+
+    def to_dict(self):
+        base_dict = super().to_dict()
+        base_dict.update({
+            'model': self.model,
+            'max_length': self.max_length,
+            'calibration_center': self.calibration_center,
+        })
+        return base_dict
+
+class FakeLLM(LLM):
+    def __init__(self):
+        self.model = "fake-llm"
+        self.num_calls = 0
+
+    def make_llm_call(self, chat_messages: list[dict]) -> str:
+        self.num_calls += 1
+        return "This document is: a test document."
@@ -0,0 +1,56 @@
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+import tiktoken
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag import auto_context
+from sprag.auto_context import truncate_content
+
+# same pre-tokenization pattern as cl100k_base
+PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+
+def get_test_encoder():
+    """
+    Small byte-level BPE encoder with the cl100k_base pre-tokenization pattern, so the test doesn't need to download a real tokenizer
+    """
+    mergeable_ranks = {bytes([i]): i for i in range(256)}
+    for merge in [b'th', b'he', b'the', b' the', b'in', b'ing', b' a', b'an', b'. ', b'\n\n', b'  ', b'er', b' w', b'or', b'12', b'ou']:
+        mergeable_ranks[merge] = len(mergeable_ranks)
+    return tiktoken.Encoding(name='test', pat_str=PATTERN, mergeable_ranks=mergeable_ranks, special_tokens={})
+
+TEST_ENCODER = get_test_encoder()
+
+
+class TestAutoContext(unittest.TestCase):
+    def truncate_by_encoding_everything(self, content: str, max_tokens: int):
+        tokens = TEST_ENCODER.encode(content, disallowed_special=())
+        return TEST_ENCODER.decode(tokens[:max_tokens]), min(len(tokens), max_tokens)
+
+    @mock.patch.object(auto_context, 'get_token_encoder', lambda: TEST_ENCODER)
+    def test__truncate_content(self):
+        rng = random.Random(42)
+        pieces = ["the", "thing", "an", "or", "w", " ", " ", "  ", ".", ",", "\n", "\n\n", "'s", "12", "345", "é", "-", "\t"]
+        for _ in range(500):
+            content = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 2000)))
+            max_tokens = rng.randint(1, 300)
+            initial_chars_per_token = rng.choice([1, 2, 4, 8])
+            self.assertEqual(truncate_content(content, max_tokens, initial_chars_per_token), self.truncate_by_encoding_everything(content, max_tokens))
+
+    @mock.patch.object(auto_context, 'get_token_encoder', lambda: TEST_ENCODER)
+    def test__truncate_long_content(self):
+        content = "the thing in the other thing. " * 100_000
+        with mock.patch.object(TEST_ENCODER, 'encode', wraps=TEST_ENCODER.encode) as encode:
+            truncated_content, num_tokens = truncate_content(content, 6000)
+        self.assertEqual(num_tokens, 6000)
+        self.assertEqual((truncated_content, num_tokens), self.truncate_by_encoding_everything(content, 6000))
+        # only a bounded prefix gets tokenized
+        self.assertLess(sum(len(call.args[0]) for call in encode.call_args_list), len(content) // 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import unittest
+import shutil
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag.cache import SQLiteCache, EmbeddingCache, LRUCache, RerankCache
+from fakes import FakeEmbedding, FakeReranker
+
+
+class LengthScoringReranker(FakeReranker):
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        return [len(result['metadata']['chunk_text']) / 10 for result in search_results]
+
+    def transform(self, x):
+        return x / 2
+
+
+def get_search_results(chunk_texts: list[str]) -> list:
+    return [{'metadata': {'doc_id': 'doc1', 'chunk_index': i, 'chunk_header': 'header', 'chunk_text': chunk_text}, 'similarity': 0.5} for i, chunk_text in enumerate(chunk_texts)]
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_directory = os.path.expanduser('~/test_spRAG/cache')
+        if os.path.exists(self.cache_directory):
+            shutil.rmtree(self.cache_directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        test_storage_directory = os.path.expanduser('~/test_spRAG')
+        if os.path.exists(test_storage_directory):
+            shutil.rmtree(test_storage_directory)
+
+    def test__sqlite_cache(self):
+        path = os.path.join(self.cache_directory, 'test.sqlite')
+        cache = SQLiteCache(path)
+        cache.set_many({'a': 1, 'b': [2, 3]})
+        cache.set('c', {'d': 4})
+        self.assertEqual(cache.get_many(['a', 'b', 'x']), {'a': 1, 'b': [2, 3]})
+        self.assertEqual(cache.get('c'), {'d': 4})
+        self.assertIsNone(cache.get('x'))
+
+        # overwriting a key doesn't add an entry
+        cache.set('a', 5)
+        self.assertEqual(len(cache), 3)
+
+        # the cache persists across instances
+        cache = SQLiteCache(path)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('a'), 5)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+
+    def test__lru_eviction(self):
+        cache = SQLiteCache(os.path.join(self.cache_directory, 'test.sqlite'), max_entries=3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        cache.get('a') # 'a' is now more recently used than 'b'
+        cache.set('d', 4)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get_many(['a', 'b', 'c', 'd']), {'a': 1, 'c': 3, 'd': 4})
+
+    def test__lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3) # evicts 'b', the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'num_entries': 2, 'max_entries': 2, 'ttl': None})
+
+        cache.clear()
+        self.assertEqual(cache.stats()['num_entries'], 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test__lru_cache_ttl(self):
+        cache = LRUCache(max_entries=10, ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test__embedding_cache(self):
+        cache = EmbeddingCache(os.path.join(self.cache_directory, 'embeddings.sqlite'))
+        embedding_model = FakeEmbedding()
+        cache.set_embeddings(embedding_model, ['hello', 'hi'], 'document', [[0.5, 0.5, 0.5, 0.5], [1.0, 0.0, 0.0, 0.0]])
+        self.assertEqual(cache.get_embeddings(embedding_model, ['hi', 'hey', 'hello'], 'document'), [[1.0, 0.0, 0.0, 0.0], None, [0.5, 0.5, 0.5, 0.5]])
+
+        # the input type and the whole model config are part of the key
+        self.assertEqual(cache.get_embeddings(embedding_model, ['hi'], 'query'), [None])
+        self.assertEqual(cache.get_embeddings(FakeEmbedding(model='other-model'), ['hi'], 'document'), [None])
+        self.assertEqual(cache.get_embeddings(FakeEmbedding(dimension=8), ['hi'], 'document'), [None])
+        self.assertEqual(cache.get_embeddings(FakeEmbedding(normalize_embeddings=False), ['hi'], 'document'), [None])
+        self.assertEqual(cache.get_embeddings(FakeEmbedding(), ['hi'], 'document'), [[1.0, 0.0, 0.0, 0.0]])
+
+    def test__rerank_cache(self):
+        path = os.path.join(self.cache_directory, 'rerank.sqlite')
+        cache = RerankCache(max_entries=10, path=path)
+        reranker = LengthScoringReranker()
+        search_results = get_search_results(['a', 'ccc', 'bb'])
+        key = cache.get_key(reranker, 'query', search_results)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, reranker.get_relevance_scores('query', search_results))
+
+        # the transform is applied to the cached scores
+        reranked_search_results = reranker.apply_relevance_scores(get_search_results(['a', 'ccc', 'bb']), cache.get(key))
+        self.assertEqual([result['metadata']['chunk_text'] for result in reranked_search_results], ['ccc', 'bb', 'a'])
+        self.assertEqual([result['similarity'] for result in reranked_search_results], [0.15, 0.1, 0.05])
+
+        # a different query, reranker config, or set of candidates is a different key
+        self.assertNotEqual(cache.get_key(reranker, 'other query', search_results), key)
+        self.assertNotEqual(cache.get_key(LengthScoringReranker(model='other-model'), 'query', search_results), key)
+        self.assertNotEqual(cache.get_key(LengthScoringReranker(max_length=256), 'query', search_results), key)
+        self.assertNotEqual(cache.get_key(reranker, 'query', get_search_results(['a', 'ccc', 'bbb'])), key)
+        # except for the calibration, which only the transform uses
+        self.assertEqual(cache.get_key(LengthScoringReranker(calibration_center=1.0), 'query', search_results), key)
+
+        # the scores are still on disk after the in-memory cache is cleared
+        cache.clear()
+        self.assertEqual(RerankCache(max_entries=10, path=path).get(key), [0.1, 0.3, 0.2])
+
+
+if __name__ == '__main__':
+    unittest.main()
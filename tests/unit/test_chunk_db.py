@@ -1,4 +1,5 @@
 import os
+import pickle
 import sys
 import unittest
 
@@ -67,6 +68,67 @@ class TestChunkDB(unittest.TestCase):
         db2 = BasicChunkDB(self.kb_id, self.storage_directory)
         self.assertIn(doc_id, db2.data)
 
+    def test__log_replay_and_compaction(self):
+        db = BasicChunkDB(self.kb_id, self.storage_directory)
+        db.add_document('doc1', {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}})
+        db.add_document('doc2', {0: {'chunk_header': 'Header 2', 'chunk_text': 'Content of chunk 2'}})
+        db.remove_document('doc1')
+        self.assertFalse(os.path.exists(db.storage_path))
+
+        # the log is replayed on load
+        db2 = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db2.get_all_doc_ids(), ['doc2'])
+
+        # compacting writes a snapshot and clears the log
+        db2.compact()
+        self.assertTrue(os.path.exists(db2.storage_path))
+        self.assertFalse(os.path.exists(db2.get_log_path(db2.generation)))
+        db2.add_document('doc3', {0: {'chunk_header': 'Header 3', 'chunk_text': 'Content of chunk 3'}})
+        db3 = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db3.get_all_doc_ids(), ['doc2', 'doc3'])
+        self.assertEqual(db3.get_chunk_text('doc3', 0), 'Content of chunk 3')
+
+    def test__torn_write_is_truncated(self):
+        db = BasicChunkDB(self.kb_id, self.storage_directory)
+        db.add_document('doc1', {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}})
+        # simulate a crash in the middle of writing a record
+        with open(db.get_log_path(db.generation), 'ab') as f:
+            f.write(b'\x80\x05\x95\x30\x00')
+
+        db2 = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db2.get_all_doc_ids(), ['doc1'])
+        # the records written after the torn one can be read back
+        db2.add_document('doc2', {0: {'chunk_header': 'Header 2', 'chunk_text': 'Content of chunk 2'}})
+        db3 = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db3.get_all_doc_ids(), ['doc1', 'doc2'])
+
+    def test__compaction_keeps_other_kbs_logs(self):
+        db = BasicChunkDB(self.kb_id, self.storage_directory)
+        other_db = BasicChunkDB(f'{self.kb_id}.v2', self.storage_directory)
+        other_db.add_document('doc1', {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}})
+        db.add_document('doc1', {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}})
+        db.compact()
+        other_db = BasicChunkDB(f'{self.kb_id}.v2', self.storage_directory)
+        self.assertEqual(other_db.get_all_doc_ids(), ['doc1'])
+
+    def test__add_documents(self):
+        db = BasicChunkDB(self.kb_id, self.storage_directory)
+        db.add_documents({
+            'doc1': {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}},
+            'doc2': {0: {'chunk_header': 'Header 2', 'chunk_text': 'Content of chunk 2'}, 1: {'chunk_header': 'Header 2', 'chunk_text': 'Content of chunk 3'}},
+        })
+        db2 = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db2.get_all_doc_ids(), ['doc1', 'doc2'])
+        self.assertEqual(db2.get_chunk_text('doc2', 1), 'Content of chunk 3')
+
+    def test__load_legacy_pickle(self):
+        storage_path = os.path.join(os.path.expanduser(self.storage_directory), 'chunk_storage', f'{self.kb_id}.pkl')
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+        with open(storage_path, 'wb') as f:
+            pickle.dump({'doc1': {0: {'chunk_header': 'Header 1', 'chunk_text': 'Content of chunk 1'}}}, f)
+        db = BasicChunkDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db.get_chunk_header('doc1', 0), 'Header 1')
+
     def test__save_and_load_from_dict(self):
         db = BasicChunkDB(self.kb_id, self.storage_directory)
         config = db.to_dict()
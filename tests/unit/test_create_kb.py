@@ -0,0 +1,85 @@
+import os
+import shutil
+import sys
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag import create_kb
+from sprag.create_kb import create_kb_from_directory
+from sprag.knowledge_base import KnowledgeBase
+from sprag.vector_db import BasicVectorDB
+from fakes import FakeEmbedding, FakeReranker, FakeLLM
+
+
+class FailingVectorDB(BasicVectorDB):
+    # rejects any write that includes a document with "bad" in its ID
+    def add_vectors(self, vectors, metadata):
+        if any("bad" in m['doc_id'] for m in metadata):
+            raise ValueError("can't write this document")
+        super().add_vectors(vectors, metadata)
+
+class BrokenProcessPoolExecutor:
+    # what a process pool looks like when its worker processes can't start
+    def __init__(self, max_workers: int = None):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait: bool = True):
+        pass
+
+
+class TestCreateKBFromDirectory(unittest.TestCase):
+    def setUp(self):
+        self.storage_directory = os.path.expanduser('~/test_spRAG')
+        self.directory = os.path.expanduser('~/test_spRAG_documents')
+        for directory in (self.storage_directory, self.directory):
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+        os.makedirs(os.path.join(self.directory, 'subdirectory'))
+        self.doc_ids = []
+        for i, relative_path in enumerate(['doc_0.txt', 'doc_1.md', os.path.join('subdirectory', 'doc_2.txt'), 'bad_doc.txt']):
+            with open(os.path.join(self.directory, relative_path), 'w') as f:
+                f.write(f"Document {i}. " + "This is a sentence about the document. " * 50)
+            self.doc_ids.append('/' + relative_path)
+        with open(os.path.join(self.directory, 'image.png'), 'w') as f:
+            f.write("not a document")
+
+    def tearDown(self):
+        for directory in (self.storage_directory, self.directory):
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    def create_kb(self, vector_db_class=BasicVectorDB):
+        def create_test_kb(kb_id, **kwargs):
+            return KnowledgeBase(kb_id, storage_directory=self.storage_directory, embedding_model=FakeEmbedding(), reranker=FakeReranker(), auto_context_model=FakeLLM(), vector_db=vector_db_class(kb_id, self.storage_directory), **kwargs)
+        return mock.patch.object(create_kb, 'KnowledgeBase', create_test_kb)
+
+    def test__create_kb_from_directory(self):
+        with self.create_kb():
+            kb = create_kb_from_directory('test_kb', self.directory, auto_context=False, max_workers=2, max_parsing_workers=1, write_batch_num_documents=3)
+        self.assertEqual(sorted(kb.chunk_db.get_all_doc_ids()), sorted(self.doc_ids))
+        self.assertEqual(kb.vector_db.num_vectors, sum(len(kb.chunk_db.data[doc_id]) for doc_id in self.doc_ids))
+        self.assertIn("Document 2.", kb.get_chunk_text('/subdirectory/doc_2.txt', 0))
+        # the databases are compacted at the end, so loading the KB doesn't have to replay their logs or rebuild the vector index
+        self.assertEqual((kb.chunk_db.log_size, kb.vector_db.log_size), (0, 0))
+
+    def test__write_errors_only_skip_the_bad_document(self):
+        with self.create_kb(FailingVectorDB):
+            kb = create_kb_from_directory('test_kb', self.directory, auto_context=False, max_workers=2, max_parsing_workers=1)
+        # the failed write is rolled back, so the document isn't left in the chunk database without its vectors
+        self.assertEqual(sorted(kb.chunk_db.get_all_doc_ids()), sorted(doc_id for doc_id in self.doc_ids if "bad" not in doc_id))
+        self.assertEqual({m['doc_id'] for m in kb.vector_db.metadata}, set(kb.chunk_db.get_all_doc_ids()))
+
+    def test__falls_back_to_threads_when_the_process_pool_is_broken(self):
+        with self.create_kb(), mock.patch.object(create_kb, 'ProcessPoolExecutor', BrokenProcessPoolExecutor):
+            kb = create_kb_from_directory('test_kb', self.directory, auto_context=False, max_workers=2)
+        self.assertEqual(sorted(kb.chunk_db.get_all_doc_ids()), sorted(self.doc_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 import sys
 import os
+import asyncio
+import importlib.util
+import threading
+import time
 import unittest
+from unittest import mock
+
+import numpy as np
+import ollama
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
 
@@ -9,6 +17,7 @@ from sprag.embedding import (
     CohereEmbedding,
     VoyageAIEmbedding,
     OllamaEmbedding,
+    SentenceTransformerEmbedding,
     Embedding,
 )
 
@@ -110,5 +119,161 @@ class TestEmbedding(unittest.TestCase):
         self.assertEqual(embedding_instance.dimension, 1024)
 
 
+class FakeOllamaClient:
+    """
+    Stands in for ollama.Client and ollama.AsyncClient, with or without the batch embed endpoint
+    """
+    def __init__(self, has_batch_endpoint: bool = True):
+        self.has_batch_endpoint = has_batch_endpoint
+        self.num_embed_calls = 0
+        self.num_concurrent = 0
+        self.max_concurrent = 0
+        self.lock = threading.Lock()
+
+    def get_embedding(self, text):
+        return [float(len(text)), float(sum(map(ord, text)))]
+
+    def embed(self, model, input):
+        self.num_embed_calls += 1
+        if not self.has_batch_endpoint:
+            raise ollama.ResponseError("404 page not found", 404)
+        return {"embeddings": [self.get_embedding(text) for text in input]}
+
+    def embeddings(self, model, prompt):
+        with self.lock:
+            self.num_concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.num_concurrent)
+        # later texts finish first, so the results come back out of order
+        time.sleep(0.01 / (1 + len(prompt)))
+        with self.lock:
+            self.num_concurrent -= 1
+        return {"embedding": self.get_embedding(prompt)}
+
+class FakeAsyncOllamaClient(FakeOllamaClient):
+    async def embed(self, model, input):
+        return super().embed(model, input)
+
+    async def embeddings(self, model, prompt):
+        self.num_concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.num_concurrent)
+        await asyncio.sleep(0.01 / (1 + len(prompt)))
+        self.num_concurrent -= 1
+        return {"embedding": self.get_embedding(prompt)}
+
+
+@mock.patch("ollama.pull")
+class TestOllamaEmbeddingConcurrency(unittest.TestCase):
+    input_texts = ["text " * i for i in range(40)]
+
+    def get_expected_embeddings(self):
+        return [FakeOllamaClient().get_embedding(text) for text in self.input_texts]
+
+    def test__batch_endpoint(self, _):
+        client = FakeOllamaClient()
+        embedding_provider = OllamaEmbedding("llama3", dimension=2, client=client, async_client=FakeAsyncOllamaClient())
+        self.assertEqual(embedding_provider.get_embeddings(self.input_texts), self.get_expected_embeddings())
+        self.assertEqual(client.num_embed_calls, 1)
+        self.assertEqual(client.max_concurrent, 0)
+
+    def test__concurrent_requests_without_batch_endpoint(self, _):
+        client = FakeOllamaClient(has_batch_endpoint=False)
+        embedding_provider = OllamaEmbedding("llama3", dimension=2, client=client, async_client=FakeAsyncOllamaClient(), max_workers=4)
+        self.assertEqual(embedding_provider.get_embeddings(self.input_texts), self.get_expected_embeddings())
+        self.assertLessEqual(client.max_concurrent, 4)
+        self.assertGreater(client.max_concurrent, 1)
+        # the missing endpoint is only tried once
+        embedding_provider.get_embeddings(self.input_texts)
+        self.assertEqual(client.num_embed_calls, 1)
+
+    def test__async_concurrent_requests_without_batch_endpoint(self, _):
+        async_client = FakeAsyncOllamaClient(has_batch_endpoint=False)
+        embedding_provider = OllamaEmbedding("llama3", dimension=2, client=FakeOllamaClient(), async_client=async_client, max_workers=4)
+        embeddings = asyncio.run(embedding_provider.aget_embeddings(self.input_texts))
+        self.assertEqual(embeddings, self.get_expected_embeddings())
+        self.assertEqual(async_client.max_concurrent, 4)
+
+    def test__missing_model_error_is_raised(self, _):
+        client = FakeOllamaClient()
+        client.embed = mock.Mock(side_effect=ollama.ResponseError("model 'llama3' not found", 404))
+        embedding_provider = OllamaEmbedding("llama3", dimension=2, client=client, async_client=FakeAsyncOllamaClient())
+        with self.assertRaises(ollama.ResponseError):
+            embedding_provider.get_embeddings(self.input_texts)
+        self.assertTrue(embedding_provider.batch_endpoint_available)
+
+    def test__to_dict(self, _):
+        embedding_provider = OllamaEmbedding("llama3", dimension=2, client=FakeOllamaClient(), async_client=FakeAsyncOllamaClient(), max_workers=3, use_batch_endpoint=False)
+        config = embedding_provider.to_dict()
+        self.assertEqual(config["max_workers"], 3)
+        self.assertFalse(config["use_batch_endpoint"])
+        self.assertFalse(embedding_provider.batch_endpoint_available)
+
+
+class FakeSentenceTransformer:
+    # stands in for a sentence_transformers.SentenceTransformer, so the wrapper can be tested without downloading a model
+    prompts = {"query": "query: "}
+
+    def __init__(self):
+        self.encode_calls = []
+
+    def get_sentence_embedding_dimension(self):
+        return 4
+
+    def encode(self, sentences, batch_size=32, prompt_name=None, normalize_embeddings=False, convert_to_numpy=True, show_progress_bar=None):
+        self.encode_calls.append({"num_sentences": len(sentences), "batch_size": batch_size, "prompt_name": prompt_name, "normalize_embeddings": normalize_embeddings})
+        return np.array([[len(sentence), 1.0, 0.0, 0.0] for sentence in sentences], dtype=np.float32)
+
+
+@mock.patch.object(SentenceTransformerEmbedding, "load_model", side_effect=lambda: FakeSentenceTransformer())
+class TestSentenceTransformerEmbeddingWrapper(unittest.TestCase):
+    def test__get_embeddings(self, _):
+        embedding_provider = SentenceTransformerEmbedding(batch_size=8)
+        self.assertEqual(embedding_provider.dimension, 4)
+
+        embedding = embedding_provider.get_embeddings("Hello", input_type="query")
+        self.assertEqual(embedding, [5.0, 1.0, 0.0, 0.0])
+        embeddings = embedding_provider.get_embeddings(["Hello", "Hi"], input_type="document")
+        self.assertEqual(embeddings, [[5.0, 1.0, 0.0, 0.0], [2.0, 1.0, 0.0, 0.0]])
+
+        # the query prompt is used since the model defines one; it doesn't define a document prompt
+        encode_calls = embedding_provider.sentence_transformer.encode_calls
+        self.assertEqual([call["prompt_name"] for call in encode_calls], ["query", None])
+        self.assertTrue(all(call["batch_size"] == 8 and call["normalize_embeddings"] for call in encode_calls))
+
+    def test__initialize_from_config(self, _):
+        embedding_provider = SentenceTransformerEmbedding("BAAI/bge-small-en-v1.5", backend="onnx", batch_size=16, num_threads=2, quantize=True)
+        embedding_instance = Embedding.from_dict(embedding_provider.to_dict())
+        self.assertIsInstance(embedding_instance, SentenceTransformerEmbedding)
+        self.assertEqual(embedding_instance.to_dict(), embedding_provider.to_dict())
+        self.assertEqual(embedding_instance.dimension, 4)
+
+    def test__unknown_backend(self, _):
+        with self.assertRaises(ValueError):
+            SentenceTransformerEmbedding(backend="tensorrt")
+
+
+@unittest.skipUnless(importlib.util.find_spec("sentence_transformers"), "sentence-transformers is not installed")
+class TestSentenceTransformerEmbedding(unittest.TestCase):
+    def test__get_embeddings(self):
+        embedding_provider = SentenceTransformerEmbedding("sentence-transformers/all-MiniLM-L6-v2", num_threads=2)
+        self.assertEqual(embedding_provider.dimension, 384)
+        embedding = embedding_provider.get_embeddings("Hello, world!", input_type="query")
+        self.assertEqual(len(embedding), 384)
+        embeddings = embedding_provider.get_embeddings(["Hello, world!", "Goodbye, world!"] * 50, input_type="document")
+        self.assertEqual(len(embeddings), 100)
+        self.assertAlmostEqual(sum(x * y for x, y in zip(embedding, embeddings[0])), 1.0, places=4)
+
+    def test__quantized_embeddings(self):
+        embedding = SentenceTransformerEmbedding("sentence-transformers/all-MiniLM-L6-v2").get_embeddings("Hello, world!")
+        quantized_embedding = SentenceTransformerEmbedding("sentence-transformers/all-MiniLM-L6-v2", quantize=True).get_embeddings("Hello, world!")
+        self.assertGreater(sum(x * y for x, y in zip(embedding, quantized_embedding)), 0.95)
+
+    def test__initialize_from_config(self):
+        embedding_provider = SentenceTransformerEmbedding("sentence-transformers/all-MiniLM-L6-v2", batch_size=8, num_threads=2)
+        embedding_instance = Embedding.from_dict(embedding_provider.to_dict())
+        self.assertIsInstance(embedding_instance, SentenceTransformerEmbedding)
+        self.assertEqual(embedding_instance.to_dict(), embedding_provider.to_dict())
+        self.assertEqual(embedding_instance.dimension, 384)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
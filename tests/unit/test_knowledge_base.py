@@ -0,0 +1,272 @@
+import asyncio
+import os
+import shutil
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag.knowledge_base import KnowledgeBase
+from fakes import FakeEmbedding, FakeReranker, FakeLLM
+
+
+class RequestTooLargeError(Exception):
+    status_code = 400
+
+class FakeTokenLimitedEmbedding(FakeEmbedding):
+    """
+    Advertises a higher token limit than the one it actually enforces
+    """
+    max_batch_size = 100
+    max_tokens_per_request = 2000
+
+    def __init__(self, dimension: int = 16, actual_max_tokens_per_request: int = 2000):
+        super().__init__(dimension=dimension)
+        self.actual_max_tokens_per_request = actual_max_tokens_per_request
+        self.batch_token_counts = []
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        return [len(text.split()) for text in texts]
+
+    def get_embeddings(self, text, input_type=None):
+        num_tokens = sum(self.count_tokens([text] if isinstance(text, str) else text))
+        if num_tokens > self.actual_max_tokens_per_request:
+            if isinstance(text, str) or len(text) == 1:
+                raise RequestTooLargeError(f"This model's maximum context length is {self.actual_max_tokens_per_request} tokens, however you requested {num_tokens} tokens")
+            raise RequestTooLargeError(f"Requested {num_tokens} tokens, max {self.actual_max_tokens_per_request} tokens per request")
+        self.batch_token_counts.append(num_tokens)
+        return super().get_embeddings(text, input_type)
+
+class SlowReranker(FakeReranker):
+    """
+    Sleeps for a different amount of time for each query, raises for queries that start with "fail", and tracks how many queries are reranked at once
+    """
+    def __init__(self, delays: dict[str, float]):
+        super().__init__()
+        self.delays = delays
+        self.lock = threading.Lock()
+        self.num_running = 0
+        self.max_running = 0
+
+    def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+        with self.lock:
+            self.num_running += 1
+            self.max_running = max(self.max_running, self.num_running)
+        try:
+            time.sleep(self.delays.get(query, 0))
+            if query.startswith("fail"):
+                raise ValueError("reranker error")
+            return super().get_relevance_scores(query, search_results)
+        finally:
+            with self.lock:
+                self.num_running -= 1
+
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu".split()
+
+def get_document_text(n: int) -> str:
+    return "\n\n".join(" ".join(WORDS[(i + n) % len(WORDS)] for _ in range(80)) + f" paragraph {i}" for i in range(20))
+
+
+class TestKnowledgeBase(unittest.TestCase):
+    def setUp(self):
+        self.storage_directory = os.path.expanduser('~/test_spRAG')
+        if os.path.exists(self.storage_directory):
+            shutil.rmtree(self.storage_directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        storage_directory = os.path.expanduser('~/test_spRAG')
+        if os.path.exists(storage_directory):
+            shutil.rmtree(storage_directory)
+
+    def create_kb(self, kb_id: str = 'test_kb', cache_params: dict = None) -> KnowledgeBase:
+        kb = KnowledgeBase(kb_id, storage_directory=self.storage_directory, embedding_model=FakeEmbedding(), reranker=FakeReranker(), auto_context_model=FakeLLM(), cache_params=cache_params)
+        for n in range(3):
+            kb.add_document(f'doc{n}', get_document_text(n), auto_context=False, chunk_header=f'Document {n}')
+        return kb
+
+    def test__add_documents(self):
+        kb = self.create_kb()
+        num_calls = kb.embedding_model.num_calls
+        expected_results = kb.query(["alpha beta", "gamma"])
+
+        kb2 = KnowledgeBase('test_kb_bulk', storage_directory=self.storage_directory, embedding_model=FakeEmbedding(), reranker=FakeReranker(), auto_context_model=FakeLLM())
+        documents = [{'doc_id': f'doc{n}', 'text': get_document_text(n), 'chunk_header': f'Document {n}'} for n in range(3)]
+        kb2.add_documents(iter(documents + documents[:1]), write_batch_size=50) # the duplicate document is skipped
+
+        # chunks from different documents get packed into the same embedding requests
+        num_chunks = kb2.vector_db.num_vectors
+        self.assertEqual(kb2.embedding_model.num_texts_embedded, num_chunks)
+        self.assertLess(kb2.embedding_model.num_calls, num_calls)
+        self.assertEqual(kb2.query(["alpha beta", "gamma"]), expected_results)
+
+        kb3 = KnowledgeBase('test_kb_bulk', storage_directory=self.storage_directory)
+        self.assertEqual(sorted(kb3.chunk_db.get_all_doc_ids()), ['doc0', 'doc1', 'doc2'])
+        self.assertEqual(kb3.vector_db.num_vectors, num_chunks)
+        # the KB was never compacted, but its vectors are still memory-mapped rather than loaded into memory
+        self.assertIsInstance(kb3.vector_db._vectors, np.memmap)
+
+    def test__token_aware_embedding_batches(self):
+        kb = KnowledgeBase('test_kb', storage_directory=self.storage_directory, embedding_model=FakeTokenLimitedEmbedding(), reranker=FakeReranker(), auto_context_model=FakeLLM())
+        texts = [" ".join(["word"] * (10 + i % 90)) for i in range(500)]
+        batches = kb.get_embedding_batches(texts)
+        self.assertEqual(batches[0][0], 0)
+        self.assertEqual(batches[-1][1], len(texts))
+        for (start, end), (next_start, _) in zip(batches, batches[1:]):
+            self.assertEqual(end, next_start)
+            # each batch is packed as full as possible
+            self.assertLessEqual(sum(kb.embedding_model.count_tokens(texts[start:end])), 2000)
+            self.assertGreater(sum(kb.embedding_model.count_tokens(texts[start:end + 1])), 2000)
+
+        embeddings = kb.embed_chunks(texts)
+        self.assertEqual(len(embeddings), len(texts))
+        self.assertEqual(len(kb.embedding_model.batch_token_counts), len(batches))
+
+    def test__embedding_batches_shrink_when_rejected(self):
+        embedding_model = FakeTokenLimitedEmbedding(actual_max_tokens_per_request=700)
+        kb = KnowledgeBase('test_kb', storage_directory=self.storage_directory, embedding_model=embedding_model, reranker=FakeReranker(), auto_context_model=FakeLLM())
+        texts = [" ".join(["word"] * 50) for i in range(100)]
+        embeddings = kb.embed_chunks(texts)
+        self.assertEqual(embeddings, [FakeEmbedding().get_embeddings(text) for text in texts])
+        self.assertTrue(all(num_tokens <= 700 for num_tokens in embedding_model.batch_token_counts))
+        self.assertLess(embedding_model.max_tokens_per_request, 2000)
+
+        # later batches are packed with the lower limit, so they aren't rejected
+        num_batches = len(embedding_model.batch_token_counts)
+        kb.embed_chunks(texts)
+        self.assertEqual(len(embedding_model.batch_token_counts), 2 * num_batches)
+
+        # a single text that's too long is raised, and doesn't lower the limits for the other requests
+        max_batch_size, max_tokens_per_request = embedding_model.max_batch_size, embedding_model.max_tokens_per_request
+        with self.assertRaises(RequestTooLargeError):
+            kb.embed_chunks([" ".join(["word"] * 800)] + texts[:5])
+        self.assertEqual((embedding_model.max_batch_size, embedding_model.max_tokens_per_request), (max_batch_size, max_tokens_per_request))
+
+    def test__query_result_cache(self):
+        kb = self.create_kb(cache_params={'query_result_cache_max_entries': 10, 'rerank_cache_max_entries': 0})
+        results = kb.query(["alpha beta", "gamma"])
+        self.assertGreater(len(results), 0)
+        self.assertEqual(kb.reranker.num_calls, 2)
+
+        # whitespace differences in the queries still hit the cache, and mutating the returned results doesn't change the cached ones
+        results[0]['text'] = ""
+        self.assertEqual(kb.query([" alpha  beta", "gamma "])[0]['text'], kb.query(["alpha beta", "gamma"])[0]['text'])
+        self.assertNotEqual(kb.query(["alpha beta", "gamma"])[0]['text'], "")
+        self.assertEqual(kb.reranker.num_calls, 2)
+
+        # different RSE parameters are a different key
+        kb.query(["alpha beta", "gamma"], rse_params={'max_length': 5})
+        self.assertEqual(kb.reranker.num_calls, 4)
+
+        # changing the KB invalidates the cache
+        version = kb.version
+        kb.delete_document('doc0')
+        self.assertGreater(kb.version, version)
+        results = kb.query(["alpha beta", "gamma"])
+        self.assertEqual(kb.reranker.num_calls, 6)
+        self.assertNotIn('doc0', [result['doc_id'] for result in results])
+
+        self.assertEqual(kb.get_cache_stats()['query_result_cache']['num_entries'], 3)
+        kb.clear_caches()
+        self.assertEqual(kb.get_cache_stats()['query_result_cache']['num_entries'], 0)
+
+    def test__queries_are_embedded_in_one_call(self):
+        kb = self.create_kb(cache_params={'query_embedding_cache_max_entries': 0, 'rerank_cache_max_entries': 0})
+        queries = ["alpha beta", "gamma", "delta epsilon"]
+        with mock.patch.object(kb.embedding_model, 'get_embeddings', wraps=kb.embedding_model.get_embeddings) as get_embeddings:
+            results = kb.query(queries)
+        self.assertGreater(len(results), 0)
+        get_embeddings.assert_called_once()
+        self.assertEqual(list(get_embeddings.call_args.args[0]), queries)
+
+    def test__concurrent_reranking(self):
+        kb = self.create_kb(cache_params={'rerank_cache_max_entries': 0})
+        queries = ["alpha", "beta", "gamma", "delta", "epsilon"]
+        expected_results = [kb.get_all_ranked_results([query])[0] for query in queries]
+
+        # the earlier queries take the longest, so they finish last, but the results still come back in query order
+        kb.reranker = SlowReranker({query: 0.05 * (len(queries) - i) for i, query in enumerate(queries)})
+        self.assertEqual(kb.get_all_ranked_results(queries, max_rerank_workers=2), expected_results)
+        self.assertEqual(kb.reranker.num_calls, len(queries))
+        self.assertEqual(kb.reranker.max_running, 2)
+
+        kb.reranker = SlowReranker({"alpha": 0.1})
+        with self.assertRaises(RuntimeError) as context:
+            kb.get_all_ranked_results(["alpha", "fail beta", "gamma"], max_rerank_workers=2)
+        self.assertIn("'fail beta'", str(context.exception))
+        self.assertIsInstance(context.exception.__cause__, ValueError)
+
+    def test__async_api(self):
+        kb = self.create_kb()
+        asyncio.run(kb.aadd_document('doc3', get_document_text(3), auto_context=False, chunk_header='Document 3'))
+        self.assertIn('doc3', kb.chunk_db.get_all_doc_ids())
+        self.assertEqual(kb.get_chunk_header('doc3', 0), 'Document 3')
+
+        self.assertEqual(asyncio.run(kb.asearch("delta", top_k=5)), kb.search("delta", top_k=5))
+        self.assertEqual(asyncio.run(kb.aquery(["alpha beta", "gamma"])), kb.query(["alpha beta", "gamma"]))
+        self.assertEqual(asyncio.run(kb.aquery([])), kb.query([]))
+
+    def test__concurrent_aadd_document_with_the_same_doc_id(self):
+        kb = self.create_kb()
+        num_vectors = kb.vector_db.num_vectors
+
+        async def add_twice():
+            await asyncio.gather(*[kb.aadd_document('doc3', get_document_text(3), auto_context=False, chunk_header='Document 3') for _ in range(2)])
+
+        asyncio.run(add_twice())
+        self.assertEqual(kb.chunk_db.get_all_doc_ids().count('doc3'), 1)
+        self.assertEqual(kb.vector_db.num_vectors - num_vectors, len(kb.chunk_db.data['doc3']))
+        self.assertEqual(len([meta for meta in kb.vector_db.metadata if meta['doc_id'] == 'doc3']), len(kb.chunk_db.data['doc3']))
+
+    def test__searches_during_writes(self):
+        kb = self.create_kb()
+        documents = [kb.prepare_document(f'doc{n}', get_document_text(n), auto_context=False, chunk_header=f'Document {n}') for n in range(3, 6)]
+        for document in documents:
+            document["chunk_embeddings"] = kb.embed_document_chunks(document["chunks"], document["chunk_header"])
+        query_vectors = kb.get_embeddings(["alpha", "beta gamma"], input_type="query")
+
+        def write_documents():
+            for _ in range(10):
+                for document in documents:
+                    kb.write_documents([dict(document)])
+                for document in documents:
+                    kb.delete_document(document["doc_id"])
+
+        writer = threading.Thread(target=write_documents)
+        writer.start()
+        num_searches = 0
+        while writer.is_alive() or num_searches == 0:
+            for results in kb.search_vector_db_batch(query_vectors, 200):
+                # the metadata of each result lines up with its vector, even while rows are being added and removed
+                for result in results:
+                    self.assertEqual(result['metadata']['chunk_header'], f"Document {result['metadata']['doc_id'][3:]}")
+            num_searches += 1
+        writer.join()
+        self.assertEqual(sorted(kb.chunk_db.get_all_doc_ids()), ['doc0', 'doc1', 'doc2'])
+        self.assertEqual(kb.vector_db.get_num_live_vectors(), sum(len(kb.chunk_db.data[doc_id]) for doc_id in ['doc0', 'doc1', 'doc2']))
+
+    # skip tokenization, which needs to download the tokenizer
+    @mock.patch('sprag.auto_context.truncate_content', lambda content, max_tokens: (content[:max_tokens], len(content[:max_tokens])))
+    def test__auto_context_cache(self):
+        auto_context_model = FakeLLM()
+        for kb_id in ['test_kb', 'test_kb_rebuilt']:
+            kb = KnowledgeBase(kb_id, storage_directory=self.storage_directory, embedding_model=FakeEmbedding(), reranker=FakeReranker(), auto_context_model=auto_context_model, cache_params={'auto_context_cache': True})
+            kb.add_document('doc0', get_document_text(0))
+            kb.add_document('doc1', get_document_text(1), auto_context_guidance="Focus on the Greek letters")
+        self.assertEqual(auto_context_model.num_calls, 2)
+        self.assertEqual(kb.get_chunk_header('doc0', 0), "Document context: the following excerpt is from doc0. This document is: a test document.")
+
+        # a change to the document text or the guidance is a cache miss
+        kb.add_document('doc2', get_document_text(0) + " more text")
+        kb.add_document('doc3', get_document_text(1), auto_context_guidance="Focus on the paragraph numbers")
+        self.assertEqual(auto_context_model.num_calls, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
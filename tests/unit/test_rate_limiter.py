@@ -0,0 +1,211 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+from sprag import rate_limiter
+from sprag.rate_limiter import RateLimiter, call_with_retry, is_request_too_large_error, is_retryable_error, set_rate_limit, rate_limited, temporary_rate_limit
+from sprag.llm import LLM
+
+
+class APIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+class FlakyLLM(LLM):
+    def __init__(self, errors: list = None):
+        self.model = "fake-model"
+        self.max_tokens = 10
+        self.errors = errors or []
+        self.calls = 0
+        self.retry_params = {'initial_delay': 0.01, 'max_delay': 0.01}
+
+    def make_llm_call(self, chat_messages: list[dict]) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "response"
+
+class FakeAsyncLLM(FlakyLLM):
+    async def amake_llm_call(self, chat_messages: list[dict]) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "async response"
+
+class FakeOverridingLLM(FlakyLLM):
+    # a user subclass that overrides a wrapped method and calls super()
+    def make_llm_call(self, chat_messages: list[dict]) -> str:
+        return super().make_llm_call(chat_messages).upper()
+
+
+class TestRateLimiter(unittest.TestCase):
+    def tearDown(self):
+        rate_limiter.rate_limiters.clear()
+        rate_limiter.temporary_rate_limiters.clear()
+
+    def test__burst_then_wait(self):
+        limiter = RateLimiter(requests_per_minute=600) # 10 requests per second
+        start_time = time.monotonic()
+        for _ in range(600):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        limiter.acquire(2)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+
+    def test__tokens_per_minute(self):
+        limiter = RateLimiter(tokens_per_minute=6000) # 100 tokens per second
+        limiter.acquire(num_tokens=6000)
+        start_time = time.monotonic()
+        limiter.acquire(num_tokens=20)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+
+    def test__no_limit(self):
+        limiter = RateLimiter()
+        start_time = time.monotonic()
+        for _ in range(10000):
+            limiter.acquire(num_tokens=1000)
+        self.assertLess(time.monotonic() - start_time, 0.5)
+
+    def test__is_retryable_error(self):
+        self.assertTrue(is_retryable_error(APIError(429)))
+        self.assertTrue(is_retryable_error(APIError(503)))
+        self.assertFalse(is_retryable_error(APIError(400)))
+        self.assertFalse(is_retryable_error(ValueError("bad input")))
+        RateLimitError = type("RateLimitError", (Exception,), {})
+        self.assertTrue(is_retryable_error(RateLimitError()))
+
+    def test__is_request_too_large_error(self):
+        def get_error(status_code, message):
+            error = APIError(status_code)
+            error.args = (message,)
+            return error
+
+        self.assertTrue(is_request_too_large_error(APIError(413)))
+        self.assertTrue(is_request_too_large_error(get_error(400, "Requested 400000 tokens, max 300000 tokens per request")))
+        self.assertTrue(is_request_too_large_error(get_error(400, "The max allowed tokens per submitted batch is 120000. Your batch has 130000 tokens after truncation.")))
+        self.assertTrue(is_request_too_large_error(get_error(400, "invalid request: total number of texts must be at most 96 - received 100")))
+        # a single input that's too long can't be fixed by splitting the request
+        self.assertFalse(is_request_too_large_error(get_error(400, "This model's maximum context length is 8192 tokens, however you requested 9000 tokens")))
+        self.assertFalse(is_request_too_large_error(get_error(400, "Input exceeds the limit")))
+        self.assertFalse(is_request_too_large_error(APIError(400)))
+        # rate limit errors are retried as is, not split up
+        self.assertFalse(is_request_too_large_error(get_error(429, "Rate limit exceeded: too many tokens per request")))
+        self.assertFalse(is_request_too_large_error(ValueError("bad input")))
+
+    def test__call_with_retry(self):
+        errors = [APIError(429), APIError(500)]
+        def func():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+        self.assertEqual(call_with_retry(func, retry_params={'initial_delay': 0.01}), "ok")
+
+        with self.assertRaises(APIError):
+            call_with_retry(lambda: (_ for _ in ()).throw(APIError(429)), retry_params={'max_retries': 2, 'initial_delay': 0.01})
+
+    def test__subclass_methods_are_wrapped(self):
+        llm = FlakyLLM(errors=[APIError(429), APIError(502)])
+        self.assertEqual(llm.make_llm_call([{"role": "user", "content": "hi"}]), "response")
+        self.assertEqual(llm.calls, 3)
+
+        llm = FlakyLLM(errors=[APIError(401)])
+        with self.assertRaises(APIError):
+            llm.make_llm_call([{"role": "user", "content": "hi"}])
+        self.assertEqual(llm.calls, 1)
+
+        # wrapping is idempotent
+        self.assertIs(rate_limited(FlakyLLM.make_llm_call), FlakyLLM.make_llm_call)
+
+    def test__provider_and_model_limits(self):
+        set_rate_limit("FlakyLLM", requests_per_minute=100)
+        set_rate_limit("FlakyLLM", model="fake-model", tokens_per_minute=1000)
+        self.assertEqual(len(rate_limiter.get_rate_limiters("FlakyLLM", "fake-model")), 2)
+        self.assertEqual(len(rate_limiter.get_rate_limiters("FlakyLLM", "other-model")), 1)
+
+        llm = FlakyLLM()
+        llm.make_llm_call([{"role": "user", "content": "a" * 400}])
+        model_limiter = rate_limiter.rate_limiters[("FlakyLLM", "fake-model")]
+        # 101 input tokens + 10 output tokens
+        self.assertAlmostEqual(model_limiter.token_bucket.available, 1000 - 111, delta=1)
+
+        set_rate_limit("FlakyLLM")
+        self.assertEqual(len(rate_limiter.get_rate_limiters("FlakyLLM", "fake-model")), 1)
+
+    def test__async_methods(self):
+        # the default async method runs the sync method in a worker thread
+        llm = FlakyLLM(errors=[APIError(429)])
+        self.assertEqual(asyncio.run(llm.amake_llm_call([{"role": "user", "content": "hi"}])), "response")
+        self.assertEqual(llm.calls, 2)
+
+        # async overrides are wrapped too
+        llm = FakeAsyncLLM(errors=[APIError(503), APIError(429)])
+        self.assertEqual(asyncio.run(llm.amake_llm_call([{"role": "user", "content": "hi"}])), "async response")
+        self.assertEqual(llm.calls, 3)
+
+    def test__overrides_that_call_super_are_limited_once(self):
+        set_rate_limit("FakeOverridingLLM", requests_per_minute=100)
+        llm = FakeOverridingLLM()
+        self.assertEqual(llm.make_llm_call([{"role": "user", "content": "hi"}]), "RESPONSE")
+        limiter = rate_limiter.rate_limiters[("FakeOverridingLLM", None)]
+        self.assertAlmostEqual(limiter.request_bucket.available, 99, delta=0.1)
+
+        # retries aren't multiplied by the nested wrappers
+        llm = FakeOverridingLLM(errors=[APIError(429), APIError(429)])
+        llm.retry_params['max_retries'] = 1
+        with self.assertRaises(APIError):
+            llm.make_llm_call([{"role": "user", "content": "hi"}])
+        self.assertEqual(llm.calls, 2)
+
+        # the default async method calls the sync one in a worker thread, which also only counts once
+        available = limiter.request_bucket.available
+        self.assertEqual(asyncio.run(FakeOverridingLLM().amake_llm_call([{"role": "user", "content": "hi"}])), "RESPONSE")
+        self.assertAlmostEqual(limiter.request_bucket.available, available - 1, delta=0.1)
+
+    def test__temporary_rate_limit(self):
+        set_rate_limit("FlakyLLM", requests_per_minute=1000)
+        set_rate_limit("FlakyLLM", model="fake-model", requests_per_minute=100)
+        configured_limiters = rate_limiter.get_rate_limiters("FlakyLLM", "fake-model")
+        # the temporary limit applies on top of the configured ones
+        with temporary_rate_limit("FlakyLLM", "fake-model", requests_per_minute=10):
+            limiters = rate_limiter.get_rate_limiters("FlakyLLM", "fake-model")
+            self.assertEqual([limiter.requests_per_minute for limiter in limiters], [1000, 100, 10])
+        self.assertEqual(rate_limiter.get_rate_limiters("FlakyLLM", "fake-model"), configured_limiters)
+
+        with temporary_rate_limit("FlakyLLM", "other-model", requests_per_minute=10):
+            self.assertEqual(len(rate_limiter.get_rate_limiters("FlakyLLM", "other-model")), 2)
+        self.assertEqual(len(rate_limiter.get_rate_limiters("FlakyLLM", "other-model")), 1)
+
+        # no limit leaves the configured ones as they are
+        with temporary_rate_limit("FlakyLLM", "fake-model"):
+            self.assertEqual(rate_limiter.get_rate_limiters("FlakyLLM", "fake-model"), configured_limiters)
+
+    def test__temporary_rate_limit_without_a_model(self):
+        # e.g. create_kb_from_directory with a model object that has no model attribute
+        set_rate_limit("FlakyLLM", requests_per_minute=100)
+        provider_limiter = rate_limiter.rate_limiters[("FlakyLLM", None)]
+        with temporary_rate_limit("FlakyLLM", None, requests_per_minute=10):
+            # the provider-level limit is still there, and both are used
+            self.assertIs(rate_limiter.rate_limiters[("FlakyLLM", None)], provider_limiter)
+            limiters = rate_limiter.get_rate_limiters("FlakyLLM", None)
+            self.assertEqual([limiter.requests_per_minute for limiter in limiters], [100, 10])
+            FlakyLLM().make_llm_call([{"role": "user", "content": "hi"}])
+            for limiter in limiters:
+                self.assertAlmostEqual(limiter.request_bucket.available, limiter.requests_per_minute - 1, delta=0.1)
+        self.assertEqual(rate_limiter.get_rate_limiters("FlakyLLM", None), [provider_limiter])
+
+    def test__async_acquire(self):
+        limiter = RateLimiter(requests_per_minute=600)
+        async def acquire_all():
+            await asyncio.gather(*[limiter.aacquire() for _ in range(602)])
+        start_time = time.monotonic()
+        asyncio.run(acquire_all())
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 import sys
 import os
+import importlib.util
 import unittest
+from unittest import mock
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
-from sprag.reranker import CohereReranker, Reranker, NoReranker
+from sprag.reranker import CohereReranker, CrossEncoderReranker, Reranker, NoReranker
 
 
 class TestReranker(unittest.TestCase):
@@ -57,6 +59,90 @@ class TestReranker(unittest.TestCase):
         self.assertEqual(reranked_search_results[0]["metadata"]["chunk_text"], "Hello, world!")
         self.assertEqual(reranked_search_results[1]["metadata"]["chunk_text"], "Goodbye, world!")
 
+    def test_subclass_must_implement_a_scoring_method(self):
+        with self.assertRaises(TypeError):
+            class IncompleteReranker(Reranker):
+                pass
+        self.assertNotIn("IncompleteReranker", Reranker.subclasses)
+
+        class LengthReranker(Reranker):
+            def get_relevance_scores(self, query: str, search_results: list) -> list[float]:
+                return [len(result["metadata"]["chunk_text"]) for result in search_results]
+
+        search_results = [{"metadata": {"chunk_header": "", "chunk_text": chunk_text}} for chunk_text in ["a", "abc", "ab"]]
+        reranked_search_results = LengthReranker().rerank_search_results("query", search_results)
+        self.assertEqual([result["similarity"] for result in reranked_search_results], [3, 2, 1])
+
+
+class FakeCrossEncoder:
+    # stands in for a sentence_transformers.CrossEncoder: the logit is the number of query words in the document, minus 2
+    def __init__(self):
+        self.predict_calls = []
+
+    def predict(self, sentences, batch_size=32, show_progress_bar=None, activation_fn=None, convert_to_numpy=True):
+        self.predict_calls.append({"num_pairs": len(sentences), "batch_size": batch_size})
+        logits = [len(set(query.lower().split()) & set(document.lower().split())) - 2.0 for query, document in sentences]
+        return [activation_fn(logit) for logit in logits]
+
+
+@mock.patch.object(CrossEncoderReranker, "load_model", side_effect=lambda: FakeCrossEncoder())
+class TestCrossEncoderRerankerWrapper(unittest.TestCase):
+    def get_search_results(self, chunk_texts):
+        return [{"metadata": {"chunk_header": "", "chunk_text": chunk_text}, "similarity": 0.5} for chunk_text in chunk_texts]
+
+    def test_rerank_search_results(self, _):
+        reranker = CrossEncoderReranker(batch_size=2, max_candidates=3)
+        search_results = self.get_search_results(["bananas are yellow", "the capital of france is paris", "paris is in france", "the capital of france"])
+        reranked_search_results = reranker.rerank_search_results("what is the capital of france", search_results)
+        self.assertEqual(reranker.cross_encoder.predict_calls, [{"num_pairs": 3, "batch_size": 2}])
+
+        # the raw logits are calibrated with the temperature-scaled sigmoid
+        self.assertEqual([result["metadata"]["chunk_text"] for result in reranked_search_results], ["the capital of france is paris", "paris is in france", "bananas are yellow", "the capital of france"])
+        self.assertAlmostEqual(reranked_search_results[0]["similarity"], reranker.transform(3.0))
+        self.assertAlmostEqual(reranked_search_results[0]["similarity"], 0.7311, places=4)
+        self.assertAlmostEqual(reranked_search_results[2]["similarity"], 0.3392, places=4)
+        # results past max_candidates aren't scored, and go last
+        self.assertEqual(reranked_search_results[3]["similarity"], 0.0)
+
+    def test_save_and_load_from_dict(self, _):
+        reranker = CrossEncoderReranker(batch_size=8, max_candidates=50, calibration_center=1.0, calibration_temperature=2.0)
+        reranker_instance = Reranker.from_dict(reranker.to_dict())
+        self.assertIsInstance(reranker_instance, CrossEncoderReranker)
+        self.assertEqual(reranker_instance.to_dict(), reranker.to_dict())
+        self.assertAlmostEqual(reranker_instance.transform(1.0), 0.5)
+
+
+@unittest.skipUnless(importlib.util.find_spec("sentence_transformers"), "sentence-transformers is not installed")
+class TestCrossEncoderReranker(unittest.TestCase):
+    def get_search_results(self, chunk_texts):
+        return [{"metadata": {"chunk_header": "", "chunk_text": chunk_text}, "similarity": 0.5} for chunk_text in chunk_texts]
+
+    def test_rerank_search_results(self):
+        reranker = CrossEncoderReranker(num_threads=2, batch_size=2)
+        search_results = self.get_search_results(["Paris is a city in Europe.", "The capital of France is Paris.", "Bananas are yellow."])
+        reranked_search_results = reranker.rerank_search_results("What is the capital of France?", search_results)
+        self.assertEqual(reranked_search_results[0]["metadata"]["chunk_text"], "The capital of France is Paris.")
+        self.assertEqual(reranked_search_results[-1]["metadata"]["chunk_text"], "Bananas are yellow.")
+        self.assertTrue(all(0 <= result["similarity"] <= 1 for result in reranked_search_results))
+        self.assertGreater(reranked_search_results[0]["similarity"], 0.5)
+        self.assertLess(reranked_search_results[-1]["similarity"], 0.5)
+
+    def test_max_candidates(self):
+        reranker = CrossEncoderReranker(max_candidates=2)
+        search_results = self.get_search_results(["Bananas are yellow.", "Apples are red.", "The capital of France is Paris."])
+        relevance_scores = reranker.get_relevance_scores("What is the capital of France?", search_results)
+        self.assertEqual(len(relevance_scores), 3)
+        self.assertEqual(relevance_scores[2], float("-inf"))
+        reranked_search_results = reranker.rerank_search_results("What is the capital of France?", search_results)
+        self.assertEqual(reranked_search_results[-1]["metadata"]["chunk_text"], "The capital of France is Paris.")
+        self.assertEqual(reranked_search_results[-1]["similarity"], 0.0)
+
+    def test_save_and_load_from_dict(self):
+        reranker = CrossEncoderReranker(batch_size=8, max_candidates=50, calibration_temperature=2.0)
+        reranker_instance = Reranker.from_dict(reranker.to_dict())
+        self.assertIsInstance(reranker_instance, CrossEncoderReranker)
+        self.assertEqual(reranker_instance.to_dict(), reranker.to_dict())
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
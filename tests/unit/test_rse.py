@@ -0,0 +1,118 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from sprag.rse import get_best_segments, get_meta_document, get_relevance_values, get_chunk_value
+
+
+def reference_get_best_segments(all_relevance_values, document_splits, max_length, overall_max_length, minimum_value):
+    """
+    Straightforward brute force version of get_best_segments, used to check that the optimized version returns exactly the same results.
+    """
+    best_segments = []
+    scores = []
+    total_length = 0
+    rv_index = 0
+    bad_rv_indices = []
+    while total_length < overall_max_length:
+        if rv_index >= len(all_relevance_values):
+            rv_index = 0
+        if len(bad_rv_indices) >= len(all_relevance_values):
+            break
+        if rv_index in bad_rv_indices:
+            rv_index += 1
+            continue
+        relevance_values = all_relevance_values[rv_index]
+        best_segment = None
+        best_value = -1000
+        for start in range(len(relevance_values)):
+            if relevance_values[start] < 0:
+                continue
+            for end in range(start+1, min(start+max_length+1, len(relevance_values)+1)):
+                if relevance_values[end-1] < 0:
+                    continue
+                if any(start < seg_end and end > seg_start for seg_start, seg_end in best_segments):
+                    continue
+                if any(start < split and end > split for split in document_splits):
+                    continue
+                if total_length + end - start > overall_max_length:
+                    continue
+                segment_value = sum(relevance_values[start:end])
+                if segment_value > best_value:
+                    best_value = segment_value
+                    best_segment = (start, end)
+        if best_segment is None or best_value < minimum_value:
+            bad_rv_indices.append(rv_index)
+            rv_index += 1
+            continue
+        best_segments.append(best_segment)
+        scores.append(best_value)
+        total_length += best_segment[1] - best_segment[0]
+        rv_index += 1
+    return best_segments, scores
+
+
+class TestRSE(unittest.TestCase):
+    def test__get_best_segments(self):
+        all_relevance_values = [[-0.2, 0.5, 0.6, -0.1, 0.4, -0.3, 1.0, 0.5]]
+        document_splits = [4, 8]
+        best_segments, scores = get_best_segments(all_relevance_values, document_splits, max_length=3, overall_max_length=10, minimum_value=0.3)
+        self.assertEqual(best_segments, [(6, 8), (1, 3), (4, 5)])
+        self.assertEqual([round(score, 4) for score in scores], [1.5, 1.1, 0.4])
+
+    def test__get_best_segments_matches_reference(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            num_documents = rng.integers(1, 5)
+            document_lengths = rng.integers(1, 30, size=num_documents)
+            document_splits = [int(split) for split in np.cumsum(document_lengths)]
+            num_queries = rng.integers(1, 4)
+            # rounding the values creates lots of ties, which exercises the tie-breaking order
+            all_relevance_values = [[float(value) for value in np.round(rng.normal(0, 0.5, size=document_splits[-1]), 1)] for _ in range(num_queries)]
+            max_length = int(rng.integers(1, 12))
+            overall_max_length = int(rng.integers(1, 40))
+            minimum_value = float(rng.uniform(-0.5, 1.0))
+
+            expected = reference_get_best_segments(all_relevance_values, document_splits, max_length, overall_max_length, minimum_value)
+            actual = get_best_segments(all_relevance_values, document_splits, max_length, overall_max_length, minimum_value)
+            self.assertEqual(actual[0], expected[0])
+            self.assertEqual(actual[1], expected[1])
+
+    def test__get_best_segments_empty(self):
+        self.assertEqual(get_best_segments([[]], [], max_length=5, overall_max_length=10, minimum_value=0.5), ([], []))
+        self.assertEqual(get_best_segments([[-0.5, -0.1]], [2], max_length=5, overall_max_length=10, minimum_value=0.5), ([], []))
+
+
+    def test__get_meta_document(self):
+        all_ranked_results = [
+            [self.make_result('doc1', 3), self.make_result('doc2', 0), self.make_result('doc3', 7)],
+            [self.make_result('doc2', 4), self.make_result('doc1', 5)],
+        ]
+        document_splits, document_start_points, unique_document_ids = get_meta_document(all_ranked_results, top_k_for_document_selection=2)
+        # doc3 isn't in the top 2 results for any query, so it isn't part of the meta-document
+        self.assertEqual(unique_document_ids, ['doc1', 'doc2'])
+        self.assertEqual(document_splits, [6, 11])
+        self.assertEqual(document_start_points, {'doc1': 0, 'doc2': 6})
+
+    def test__get_relevance_values(self):
+        all_ranked_results = [
+            [self.make_result('doc1', 1, similarity=0.9, chunk_text='a' * 700), self.make_result('doc3', 0, similarity=0.8), self.make_result('doc2', 0, similarity=0.5, chunk_text='b' * 350)],
+        ]
+        document_start_points = {'doc1': 0, 'doc2': 2}
+        all_relevance_values = get_relevance_values(all_ranked_results, meta_document_length=3, document_start_points=document_start_points, unique_document_ids=['doc1', 'doc2'], irrelevant_chunk_penalty=0.2, decay_rate=30)
+        expected_relevance_values = [
+            get_chunk_value({}, 0.2, 30) * 0.0, # chunk that wasn't in the results
+            get_chunk_value({'rank': 0, 'absolute_relevance_value': 0.9}, 0.2, 30) * 1.0,
+            get_chunk_value({'rank': 2, 'absolute_relevance_value': 0.5}, 0.2, 30) * 0.5,
+        ]
+        self.assertEqual(len(all_relevance_values), 1)
+        np.testing.assert_allclose(all_relevance_values[0], expected_relevance_values)
+
+    @staticmethod
+    def make_result(doc_id, chunk_index, similarity=0.5, chunk_text='text'):
+        return {'metadata': {'doc_id': doc_id, 'chunk_index': chunk_index, 'chunk_header': '', 'chunk_text': chunk_text}, 'similarity': similarity}
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import numpy as np
 import os
+import pickle
+import shutil
 import sys
 import unittest
+from unittest import mock
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 from sprag.vector_db import BasicVectorDB, VectorDB
@@ -14,9 +17,9 @@ class TestVectorDB(unittest.TestCase):
         return super().setUp()
 
     def tearDown(self):
-        storage_path = os.path.join(self.storage_directory, 'vector_storage', f'{self.kb_id}.pkl')
+        storage_path = os.path.join(self.storage_directory, 'vector_storage', self.kb_id)
         if os.path.exists(storage_path):
-            os.remove(storage_path)
+            shutil.rmtree(storage_path)
         return super().tearDown()
 
     def test__add_vectors_and_search(self):
@@ -32,6 +35,7 @@ class TestVectorDB(unittest.TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0]['metadata']['doc_id'], '1')
         self.assertGreaterEqual(results[0]['similarity'], 0.99)
+        self.assertEqual(db.search_batch([], top_k=1), [])
 
     def test__remove_document(self):
         db = BasicVectorDB(self.kb_id, self.storage_directory)
@@ -41,11 +45,262 @@ class TestVectorDB(unittest.TestCase):
         
         db.add_vectors(vectors, metadata)
         db.remove_document('1')
-        
-        print(db.metadata)
+        self.assertEqual([result['metadata']['doc_id'] for result in db.search(np.array([1, 0]), top_k=2)], ['2'])
+
+        db.compact()
         self.assertEqual(len(db.metadata), 1)
         self.assertEqual(db.metadata[0]['doc_id'], '2')
 
+    def test__add_vectors_and_compact_after_remove(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory, use_faiss=False)
+        for doc_index in range(10):
+            vectors = [np.array([doc_index, 1.0, i]) for i in range(5)]
+            metadata = [{'doc_id': str(doc_index), 'chunk_index': i, 'chunk_header': '', 'chunk_text': ''} for i in range(5)]
+            db.add_vectors(vectors, metadata)
+        self.assertEqual(db.vectors.shape, (50, 3))
+        # added vectors are appended to the file, which is mapped again rather than copied into memory
+        self.assertIsInstance(db._vectors, np.memmap)
+
+        # the removed rows stay in the matrix until the next compaction, but they're never returned
+        db.remove_document('3')
+        self.assertEqual(db.vectors.shape, (50, 3))
+        self.assertEqual(len(db.search(np.array([3, 1, 0]), top_k=45)), 45)
+        self.assertNotIn('3', [result['metadata']['doc_id'] for result in db.search(np.array([3, 1, 0]), top_k=45)])
+
+        db.compact()
+        self.assertIsInstance(db._vectors, np.memmap)
+        self.assertEqual(db.vectors.shape, (45, 3))
+        self.assertEqual(len(db.metadata), 45)
+        self.assertNotIn('3', [meta['doc_id'] for meta in db.metadata])
+        # vectors and metadata must stay aligned after compaction
+        for vector, meta in zip(db.vectors, db.metadata):
+            self.assertAlmostEqual(vector[0] / vector[1], float(meta['doc_id']), places=5)
+            self.assertAlmostEqual(vector[2] / vector[1], meta['chunk_index'], places=5)
+
+    def test__similarity_scores(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(50, 8))
+        metadata = [{'doc_id': str(i), 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''} for i in range(50)]
+        db.add_vectors(vectors, metadata)
+        query_vector = rng.normal(size=8)
+        expected_similarities = vectors @ query_vector / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector))
+
+        faiss_results = db.search(query_vector, top_k=10)
+        db.use_faiss = False
+        non_faiss_results = db.search(query_vector, top_k=10)
+
+        self.assertEqual([result['metadata'] for result in faiss_results], [result['metadata'] for result in non_faiss_results])
+        for faiss_result, non_faiss_result in zip(faiss_results, non_faiss_results):
+            i = int(faiss_result['metadata']['doc_id'])
+            self.assertAlmostEqual(faiss_result['similarity'], expected_similarities[i], places=5)
+            self.assertAlmostEqual(non_faiss_result['similarity'], expected_similarities[i], places=5)
+
+    def test__approximate_indexes(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(400, 16))
+        metadata = [{'doc_id': str(i // 10), 'chunk_index': i % 10, 'chunk_header': '', 'chunk_text': ''} for i in range(400)]
+        query_indices = [1, 15, 27, 100, 333]
+        query_vectors = vectors[query_indices] + rng.normal(scale=0.01, size=(5, 16))
+
+        for index_type in ['hnsw', 'ivf']:
+            storage_path = os.path.join(self.storage_directory, 'vector_storage', self.kb_id)
+            if os.path.exists(storage_path):
+                shutil.rmtree(storage_path)
+            db = BasicVectorDB(self.kb_id, self.storage_directory, index_type=index_type, index_params={'ivf_nlist': 4, 'ivf_nprobe': 4})
+            db.add_vectors(vectors[:200], metadata[:200])
+            db.add_vectors(vectors[200:], metadata[200:])
+            self.assertTrue(db.is_index_ready())
+            self.assertEqual(db.index.ntotal, 400)
+            results = db.search_batch(query_vectors, top_k=1)
+            self.assertEqual([result[0]['metadata'] for result in results], [metadata[i] for i in query_indices])
+
+            # removing a document doesn't rebuild the index: IVF removes the vectors by ID, and HNSW filters them out at search time
+            db.remove_document('0')
+            self.assertEqual(db.index.ntotal, 390 if index_type == 'ivf' else 400)
+            self.assertEqual(db.vectors.shape[0], 400)
+            results = db.search(query_vectors[0], top_k=20)
+            self.assertEqual(len(results), 20)
+            self.assertNotIn('0', [result['metadata']['doc_id'] for result in results])
+            self.assertEqual(db.search(query_vectors[1], top_k=1)[0]['metadata'], metadata[15])
+
+            # the removal is replayed from the log on load
+            loaded_db = VectorDB.from_dict(db.to_dict())
+            self.assertTrue(loaded_db.is_index_ready())
+            self.assertNotIn('0', [result['metadata']['doc_id'] for result in loaded_db.search(query_vectors[0], top_k=20)])
+
+            # compaction drops the removed rows and rebuilds the index once
+            db.compact()
+            self.assertEqual(db.index.ntotal, 390)
+            self.assertEqual(db.vectors.shape[0], 390)
+            self.assertNotIn(None, db.metadata)
+            self.assertEqual(db.search(query_vectors[1], top_k=1)[0]['metadata'], metadata[15])
+
+            # the index is saved alongside the vectors and the settings round trip through to_dict
+            self.assertTrue(os.path.exists(db.get_index_path(db.generation)))
+            config = db.to_dict()
+            self.assertEqual(config['index_type'], index_type)
+            new_db = VectorDB.from_dict(config)
+            self.assertTrue(new_db.is_index_ready())
+            self.assertEqual(new_db.search(query_vectors[1], top_k=1)[0]['metadata'], metadata[15])
+
+    def test__ivf_index_waits_for_enough_training_vectors(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory, index_type='ivf', index_params={'ivf_nlist': 4, 'min_training_vectors_per_centroid': 10})
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(50, 8))
+        metadata = [{'doc_id': str(i), 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''} for i in range(50)]
+        db.add_vectors(vectors[:20], metadata[:20])
+        self.assertFalse(db.is_index_ready())
+        self.assertEqual(db.search(vectors[3], top_k=1)[0]['metadata'], metadata[3]) # falls back to exhaustive search
+        db.add_vectors(vectors[20:], metadata[20:])
+        self.assertTrue(db.is_index_ready())
+
+    def test__index_is_saved_without_compaction(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(400, 16))
+        metadata = [{'doc_id': str(i // 10), 'chunk_index': i % 10, 'chunk_header': '', 'chunk_text': ''} for i in range(400)]
+
+        for index_type in ['hnsw', 'ivf']:
+            storage_path = os.path.join(self.storage_directory, 'vector_storage', self.kb_id)
+            if os.path.exists(storage_path):
+                shutil.rmtree(storage_path)
+            db = BasicVectorDB(self.kb_id, self.storage_directory, index_type=index_type, index_params={'ivf_nlist': 4, 'ivf_nprobe': 4})
+            for i in range(0, 400, 50):
+                db.add_vectors(vectors[i:i + 50], metadata[i:i + 50])
+            db.remove_document('3')
+            self.assertEqual(db.generation, 0) # never compacted
+            # the index is saved each time it doubles in size, so the last save has at least half of the rows
+            self.assertGreaterEqual(db.saved_index_size, 200)
+            self.assertTrue(os.path.exists(db.get_index_path(db.generation, db.saved_index_size)))
+            self.assertEqual(len(os.listdir(storage_path)), 3) # only the latest index is kept
+
+            # a load reads the saved index and only adds the rows after it, instead of rebuilding it
+            with mock.patch.object(BasicVectorDB, 'rebuild_index') as rebuild_index, mock.patch.object(BasicVectorDB, 'train_index') as train_index:
+                loaded_db = VectorDB.from_dict(db.to_dict())
+            rebuild_index.assert_not_called()
+            train_index.assert_not_called()
+            self.assertTrue(loaded_db.is_index_ready())
+            self.assertEqual(loaded_db.index.ntotal, db.index.ntotal)
+            for i in [1, 55, 250, 399]:
+                self.assertEqual(loaded_db.search(vectors[i], top_k=1)[0]['metadata'], metadata[i])
+            self.assertNotIn('3', [result['metadata']['doc_id'] for result in loaded_db.search(vectors[35], top_k=20)])
+
+    def test__quantization(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(1000, 16))
+        metadata = [{'doc_id': str(i // 10), 'chunk_index': i % 10, 'chunk_header': '', 'chunk_text': ''} for i in range(1000)]
+        query_indices = [1, 15, 270, 503, 999]
+        query_vectors = vectors[query_indices] + rng.normal(scale=0.01, size=(5, 16))
+        exact_db = BasicVectorDB('exact_test_db', self.storage_directory)
+        exact_db.add_vectors(vectors, metadata)
+        exact_results = exact_db.search_batch(query_vectors, top_k=5)
+        shutil.rmtree(exact_db.vector_storage_directory)
+
+        for index_type, quantization in [('flat', 'int8'), ('flat', 'pq'), ('hnsw', 'int8'), ('hnsw', 'pq'), ('ivf', 'pq')]:
+            storage_path = os.path.join(self.storage_directory, 'vector_storage', self.kb_id)
+            if os.path.exists(storage_path):
+                shutil.rmtree(storage_path)
+            db = BasicVectorDB(self.kb_id, self.storage_directory, index_type=index_type, quantization=quantization, index_params={'ivf_nlist': 4, 'ivf_nprobe': 4, 'pq_m': 8, 'pq_nbits': 4, 'rescore_factor': 10, 'min_training_vectors_per_centroid': 2})
+            db.add_vectors(vectors, metadata)
+            self.assertTrue(db.is_index_ready())
+            results = db.search_batch(query_vectors, top_k=5)
+            for query_results, query_exact_results in zip(results, exact_results):
+                # the top result is found and, thanks to re-scoring, its similarity is exact
+                self.assertEqual(query_results[0]['metadata'], query_exact_results[0]['metadata'])
+                self.assertAlmostEqual(query_results[0]['similarity'], query_exact_results[0]['similarity'], places=5)
+
+            # without re-scoring the (approximate) similarities come straight from the index
+            db.index_params['rescore_factor'] = 0
+            self.assertEqual(db.search(query_vectors[0], top_k=1)[0]['metadata'], metadata[1])
+
+            config = db.to_dict()
+            self.assertEqual(config['quantization'], quantization)
+            db.compact()
+            new_db = VectorDB.from_dict(config)
+            self.assertTrue(new_db.is_index_ready())
+            self.assertEqual(new_db.search(query_vectors[2], top_k=1)[0]['metadata'], metadata[270])
+
+            # removed vectors are never returned, with or without re-scoring
+            new_db.remove_document('0')
+            self.assertNotEqual(new_db.search(query_vectors[0], top_k=1)[0]['metadata']['doc_id'], '0')
+            new_db.index_params['rescore_factor'] = 0
+            self.assertNotIn('0', [result['metadata']['doc_id'] for result in new_db.search(query_vectors[0], top_k=20)])
+
+    def test__quantized_vectors_stay_on_disk(self):
+        import faiss
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(2000, 64))
+        metadata = [{'doc_id': str(i // 10), 'chunk_index': i % 10, 'chunk_header': '', 'chunk_text': ''} for i in range(2000)]
+        full_precision_size = vectors.shape[0] * vectors.shape[1] * 4
+
+        def assert_resident_size_is_compressed(db):
+            # the full-precision matrix is only memory-mapped, and the index only has the compressed codes
+            self.assertIsInstance(db._vectors, np.memmap)
+            for name, value in vars(db).items():
+                if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+                    self.assertLess(value.nbytes, full_precision_size / 4, name)
+            self.assertLess(faiss.serialize_index(db.index).nbytes, full_precision_size / 4)
+            # re-scoring reads the candidates' full-precision vectors back from the file, so the similarities are exact
+            result = db.search(vectors[1234], top_k=1)[0]
+            self.assertEqual(result['metadata'], metadata[1234])
+            self.assertAlmostEqual(result['similarity'], 1.0, places=5)
+
+        db = BasicVectorDB(self.kb_id, self.storage_directory, quantization='pq', index_params={'pq_m': 8, 'pq_nbits': 4, 'min_training_vectors_per_centroid': 2})
+        for i in range(0, 2000, 100):
+            db.add_vectors(vectors[i:i + 100], metadata[i:i + 100])
+        self.assertTrue(db.is_index_ready())
+        assert_resident_size_is_compressed(db)
+        assert_resident_size_is_compressed(VectorDB.from_dict(db.to_dict()))
+
+    def test__int8_quantizer_is_trained_on_the_whole_kb(self):
+        # each document is a separate cluster, so a quantizer trained on the first document alone clips the values of the others
+        rng = np.random.default_rng(0)
+        num_docs, chunks_per_doc, dimension = 40, 100, 64
+        centers = rng.normal(size=(num_docs, dimension))
+        vectors = np.concatenate([center + rng.normal(scale=0.5, size=(chunks_per_doc, dimension)) for center in centers])
+        metadata = [{'doc_id': str(i // chunks_per_doc), 'chunk_index': i % chunks_per_doc, 'chunk_header': '', 'chunk_text': ''} for i in range(len(vectors))]
+        query_vectors = vectors[rng.choice(len(vectors), 50)] + rng.normal(scale=0.3, size=(50, dimension))
+        exact_db = BasicVectorDB('exact_test_db', self.storage_directory)
+        exact_db.add_vectors(vectors, metadata)
+        exact_results = exact_db.search_batch(query_vectors, top_k=10)
+        shutil.rmtree(exact_db.vector_storage_directory)
+
+        db = BasicVectorDB(self.kb_id, self.storage_directory, quantization='int8', index_params={'rescore_factor': 0, 'min_training_vectors_per_centroid': 1})
+        db.add_vectors(vectors[:chunks_per_doc], metadata[:chunks_per_doc])
+        self.assertFalse(db.is_index_ready()) # 100 vectors aren't enough to train on
+        for doc_index in range(1, num_docs):
+            db.add_vectors(vectors[doc_index * chunks_per_doc:(doc_index + 1) * chunks_per_doc], metadata[doc_index * chunks_per_doc:(doc_index + 1) * chunks_per_doc])
+        self.assertTrue(db.is_index_ready())
+        # retrained each time the KB doubled in size
+        self.assertGreaterEqual(db.index_training_size, len(vectors) // 2)
+
+        results = db.search_batch(query_vectors, top_k=10)
+        get_ids = lambda query_results: {(result['metadata']['doc_id'], result['metadata']['chunk_index']) for result in query_results}
+        recall = np.mean([len(get_ids(query_results) & get_ids(query_exact_results)) / 10 for query_results, query_exact_results in zip(results, exact_results)])
+        self.assertGreater(recall, 0.9)
+
+        # the training size is saved with the snapshot
+        db.compact()
+        self.assertEqual(VectorDB.from_dict(db.to_dict()).index_training_size, db.index_training_size)
+
+    def test__search_batch(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        vectors = [np.array([1, 0]), np.array([0, 1]), np.array([1, 1])]
+        metadata = [{'doc_id': str(i), 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''} for i in range(3)]
+        db.add_vectors(vectors, metadata)
+        query_vectors = [np.array([1, 0]), np.array([0, 1])]
+
+        for use_faiss in [True, False]:
+            db.use_faiss = use_faiss
+            batch_results = db.search_batch(query_vectors, top_k=2)
+            self.assertEqual(len(batch_results), 2)
+            self.assertEqual([result['metadata']['doc_id'] for result in batch_results[0]], ['0', '2'])
+            self.assertEqual([result['metadata']['doc_id'] for result in batch_results[1]], ['1', '2'])
+            for query_vector, results in zip(query_vectors, batch_results):
+                self.assertEqual(results, db.search(query_vector, top_k=2))
+
+        self.assertEqual(BasicVectorDB('empty_test_db', self.storage_directory).search_batch(query_vectors), [[], []])
+
     def test__empty_search(self):
         db = BasicVectorDB(self.kb_id, self.storage_directory)
         query_vector = np.array([1, 0])
@@ -69,6 +324,93 @@ class TestVectorDB(unittest.TestCase):
         self.assertEqual(new_db.metadata[0]['doc_id'], '1')
         self.assertEqual(new_db.metadata[1]['doc_id'], '2')
 
+    def test__load_is_memory_mapped(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        vectors = [np.array([1, 0]), np.array([0, 1])]
+        metadata = [{'doc_id': '1', 'chunk_index': 0, 'chunk_header': 'Header1', 'chunk_text': 'Text1'},
+                    {'doc_id': '2', 'chunk_index': 1, 'chunk_header': 'Header2', 'chunk_text': 'Text2'}]
+        db.add_vectors(vectors, metadata)
+
+        # a DB that was never compacted is memory-mapped too, since the added vectors are in the vectors file and only their metadata is in the log
+        new_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertFalse(os.path.exists(new_db.metadata_path))
+        self.assertIsInstance(new_db._vectors, np.memmap)
+        np.testing.assert_array_equal(new_db.vectors, db.vectors)
+
+        # modifying a memory-mapped DB should work and persist, and keep it memory-mapped
+        new_db.compact()
+        new_db.add_vectors([np.array([1, 1])], [{'doc_id': '3', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}])
+        new_db.remove_document('1')
+        self.assertIsInstance(new_db._vectors, np.memmap)
+        reloaded_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertIsInstance(reloaded_db._vectors, np.memmap)
+        self.assertEqual([meta['doc_id'] for meta in reloaded_db.metadata if meta is not None], ['2', '3'])
+        reloaded_db.compact()
+        self.assertEqual([meta['doc_id'] for meta in reloaded_db.metadata], ['2', '3'])
+        np.testing.assert_allclose(reloaded_db.vectors, np.array([[0, 1], [np.sqrt(0.5), np.sqrt(0.5)]]), rtol=1e-6)
+        self.assertIsInstance(BasicVectorDB(self.kb_id, self.storage_directory)._vectors, np.memmap)
+
+    def test__changes_are_logged_and_compacted(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        metadata = [{'doc_id': '1', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}]
+        db.add_vectors([np.array([1, 0])], metadata)
+        db.compact()
+        snapshot_mtime = os.path.getmtime(db.metadata_path)
+
+        # adds and removes only append to the log, they don't rewrite the snapshot
+        db.add_vectors([np.array([0, 1])], [{'doc_id': '2', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}])
+        db.add_vectors([np.array([1, 1])], [{'doc_id': '3', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}])
+        db.remove_document('1')
+        self.assertEqual(os.path.getmtime(db.metadata_path), snapshot_mtime)
+        self.assertGreater(db.log_size, 0)
+
+        # the log is replayed on load
+        new_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertEqual(new_db.metadata, db.metadata)
+        self.assertEqual([meta['doc_id'] for meta in new_db.metadata if meta is not None], ['2', '3'])
+        np.testing.assert_array_equal(new_db.vectors, db.vectors)
+
+        # compacting merges the log into a new snapshot
+        new_db.compact()
+        self.assertEqual(new_db.log_size, 0)
+        self.assertFalse(os.path.exists(new_db.get_log_path(new_db.generation)))
+        compacted_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertEqual([meta['doc_id'] for meta in compacted_db.metadata], ['2', '3'])
+        np.testing.assert_array_equal(compacted_db.vectors, db.vectors[1:])
+
+    def test__torn_write_is_truncated(self):
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        db.add_vectors([np.array([1, 0])], [{'doc_id': '1', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}])
+        # simulate a crash after the vectors were appended to the file, in the middle of writing their log record
+        with open(db.get_vectors_path(db.vectors_generation), 'ab') as f:
+            f.write(np.array([[0.6, 0.8]], dtype=np.float32).tobytes())
+        with open(db.get_log_path(db.generation), 'ab') as f:
+            f.write(b'\x80\x05\x95\x30\x00')
+
+        new_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertEqual([meta['doc_id'] for meta in new_db.metadata], ['1'])
+        # the records written after the torn one can be read back
+        new_db.add_vectors([np.array([0, 1])], [{'doc_id': '2', 'chunk_index': 0, 'chunk_header': '', 'chunk_text': ''}])
+        reloaded_db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertEqual([meta['doc_id'] for meta in reloaded_db.metadata], ['1', '2'])
+        np.testing.assert_array_equal(reloaded_db.vectors, np.array([[1, 0], [0, 1]]))
+
+    def test__load_legacy_pickle(self):
+        legacy_path = os.path.join(self.storage_directory, 'vector_storage', f'{self.kb_id}.pkl')
+        os.makedirs(os.path.dirname(legacy_path), exist_ok=True)
+        metadata = [{'doc_id': '1', 'chunk_index': 0, 'chunk_header': 'Header1', 'chunk_text': 'Text1'}]
+        with open(legacy_path, 'wb') as f:
+            pickle.dump(([[1.0, 0.0]], metadata), f)
+
+        db = BasicVectorDB(self.kb_id, self.storage_directory)
+        self.assertEqual(db.metadata, metadata)
+        np.testing.assert_array_equal(db.vectors, np.array([[1, 0]], dtype=np.float32))
+
+        # saving migrates the KB to the new format
+        db.save()
+        self.assertFalse(os.path.exists(legacy_path))
+        self.assertEqual(BasicVectorDB(self.kb_id, self.storage_directory).metadata, metadata)
+
     def test__load_from_dict(self):
         config = {
             'subclass_name': 'BasicVectorDB',